@@ -0,0 +1,62 @@
+"""
+Production gunicorn settings, used by the Dockerfile: ``gunicorn -c gunicorn.conf.py``.
+
+Serves the WSGI app on threaded workers by default. ``GUNICORN_WORKER_CLASS=uvicorn``
+serves the ASGI app on uvicorn workers instead, for ``/research/llm-engine/stream``.
+
+A turn spends tens of milliseconds of CPU and seconds waiting on OpenAI, so there
+is one process per core, to get past the GIL, and many threads per process to
+overlap the waiting. The app is preloaded and ``llm_startup`` finishes in the
+master before it forks, so workers share the clients, tokenizer and memory-mapped
+index copy-on-write. Workers are recycled after ``max_requests`` to cap slow leaks.
+"""
+import gc
+import multiprocessing
+import os
+
+cores = multiprocessing.cpu_count()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", cores))
+
+if os.environ.get("GUNICORN_WORKER_CLASS", "gthread") == "uvicorn":
+    worker_class = "uvicorn.workers.UvicornWorker"
+    wsgi_app = "llm_django_backend.asgi:application"
+else:
+    worker_class = "gthread"
+    wsgi_app = "llm_django_backend.wsgi:application"
+    threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+preload_app = True
+
+# recycle workers, staggered so they do not all restart at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = max_requests // 10
+
+# LLM turns are slow; let in-flight ones finish on reload and shutdown
+timeout = 120
+graceful_timeout = 60
+keepalive = 5
+
+# heartbeat files on tmpfs, a disk-backed /tmp can stall workers in containers
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def when_ready(server):
+    """Finish the preloaded app's warm-up in the master, then freeze it for copy-on-write."""
+    from django.conf import settings
+    from research.startup import LLMNotReady, ensure_llm_ready
+
+    if settings.LLM_WARMUP_ON_STARTUP:
+        try:
+            ensure_llm_ready()
+        except LLMNotReady as e:
+            server.log.warning("LLM stack not ready before forking, workers start their own: %s", e)
+    # keep the refcount and GC bookkeeping of everything built so far from dirtying shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # database connections must not be shared with the master or between workers
+    from django.db import connections
+    connections.close_all()
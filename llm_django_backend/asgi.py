@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llm_django_backend.settings")
 
-application = get_asgi_application()
+from research.handlers import api_asgi_application  # noqa: E402
+
+# get_asgi_application(), with /research/ on the slim middleware chain of LLM_API_MODE
+application = api_asgi_application()
+
+from django.conf import settings  # noqa: E402
+from research.startup import start_warmup  # noqa: E402
+
+if settings.LLM_WARMUP_ON_STARTUP:
+    start_warmup()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -26,6 +27,136 @@ SECRET_KEY = "django-insecure-f0yghls#r&p1x*yh!jgibz^d@fh$g257s$$7iln1(dzh=2qg%e
 DEBUG = True
 
 ALLOWED_HOSTS = ["*"]
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
+PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY", "")
+
+# Conversation memory: the prompt gets the most recent messages within
+# MAX_TOKENS plus a summary of older ones, written in the background
+# (research/memory.py). At most MAX_PENDING_MESSAGES wait to be summarized.
+LLM_MEMORY = {
+    "MAX_TOKENS": 1500,
+    "MAX_PENDING_MESSAGES": 40,
+}
+
+# Per-request phase timings (research/tracing.py), exported at /research/metrics.
+# SAMPLE_RATE of the traces, and every one slower than SLOW_REQUEST_SECONDS,
+# are logged to the "research.trace" logger off the request thread.
+LLM_TRACING = {
+    "ENABLED": True,
+    "PATH_PREFIX": "/research/",
+    "SAMPLE_RATE": 0.01,
+    "SLOW_REQUEST_SECONDS": 5.0,
+}
+
+# Admission control for llm-engine (research/admission.py). Token buckets in
+# requests a second, per conversation and per process; over either is a 429.
+LLM_RATE_LIMIT = {
+    "ENABLED": True,
+    "SESSION_RATE": 1.0,
+    "SESSION_BURST": 5,
+    "PROCESS_RATE": 50.0,
+    "PROCESS_BURST": 100,
+}
+
+# At most MAX_CALLS OpenAI calls at once per process; MAX_QUEUED more wait up
+# to QUEUE_TIMEOUT seconds before a 503. Rate limits and server errors are
+# retried with exponential backoff, MAX_TRIES attempts within MAX_RETRY_TIME.
+LLM_CONCURRENCY = {
+    "MAX_CALLS": 16,
+    "MAX_QUEUED": 64,
+    "QUEUE_TIMEOUT": 10.0,
+    "MAX_TRIES": 4,
+    "MAX_RETRY_TIME": 20.0,
+}
+
+# Model tiers (research/tiering.py): short, single requests and replies to the
+# agent's follow-up questions go to the FAST model, long or multi-part turns to
+# the STRONG one, and so do fast-tier tool calls that fail to parse or validate.
+# Costs are dollars per 1000 prompt (INPUT) and completion (OUTPUT) tokens.
+# Off by default: both tiers are the deployed gpt-3.5-turbo, so tiering would
+# only add escalations. Enabling it with gpt-4-turbo ($0.01 / $0.03) as STRONG
+# makes every strong-tier turn about 20 times as expensive as it is today.
+LLM_MODEL_TIERS = {
+    "ENABLED": False,
+    "FAST_MAX_WORDS": 24,
+    "FAST": {"MODEL": "gpt-3.5-turbo", "INPUT_COST": 0.0005, "OUTPUT_COST": 0.0015},
+    "STRONG": {"MODEL": "gpt-3.5-turbo", "INPUT_COST": 0.0005, "OUTPUT_COST": 0.0015},
+}
+
+# /research/llm-engine/batch: at most MAX_ITEMS messages per request, the
+# conversations of all batches answered by CONCURRENCY threads per process
+LLM_BATCH = {
+    "MAX_ITEMS": 1000,
+    "CONCURRENCY": 8,
+}
+
+# The hotels this deployment serves, see research/tenancy.py. A request names
+# its hotel with "hotel" (DEFAULT when left out) and its room with "room".
+# Each hotel gets its own agent, offering only the tools in TOOLS (all when
+# left out); it is built on first use and dropped after IDLE_TTL idle seconds.
+LLM_HOTELS = {
+    "DEFAULT": "default",
+    "IDLE_TTL": 30 * 60,
+    "MAX_AGENTS": 64,
+    "HOTELS": {
+        "default": {"NAME": "the hotel", "TIME_ZONE": "UTC"},
+    },
+}
+
+# The ledger of guest service requests, see research/service_requests.py. Rows
+# are written by a background thread every FLUSH_INTERVAL seconds, or once
+# MAX_BATCH are waiting; set BUFFERED to False to save each one as it is made.
+LLM_SERVICE_REQUESTS = {
+    "BUFFERED": True,
+    "MAX_BATCH": 500,
+    "FLUSH_INTERVAL": 0.5,
+    "ID_BLOCK": 100,  # request numbers a worker reserves at a time
+}
+
+# Deterministic fast path for unambiguous amenity, maintenance and
+# housekeeping requests, tried before the agent (research/router.py)
+LLM_INTENT_ROUTER = {
+    "ENABLED": True,
+    "MAX_WORDS": 16,
+}
+
+# Answers reused for repeated questions, see research/response_cache.py. Turns
+# that fire a stateful tool such as book_room are never cached.
+LLM_RESPONSE_CACHE = {
+    "ENABLED": True,
+    "MAX_ENTRIES": 2048,
+    "TTL": 10 * 60,
+    "SIMILARITY_THRESHOLD": 0.97,
+}
+
+# Where retrieval looks hotel knowledge up: "pinecone" for the hosted index or
+# "memmap" for the local memory-mapped index in PATH, see research/vectorstores.py
+LLM_VECTORSTORE = {
+    "BACKEND": os.environ.get("LLM_VECTORSTORE_BACKEND", "pinecone"),
+    "INDEX_NAME": "llama-2-rag",
+    "PATH": BASE_DIR / "vectorstore",
+    "DIMENSION": 1536,
+    "N_PROBE": 8,  # IVF lists scanned per query once MemmapVectorIndex.build_ivf() has run
+}
+
+# Hotel knowledge looked up in the vector index for every turn, see
+# research/retrieval.py. Query embeddings are cached and batched.
+LLM_RETRIEVAL = {
+    "ENABLED": True,
+    "TOP_K": 3,
+    "MIN_SCORE": 0.75,
+    "TIMEOUT": 2.0,  # seconds a turn waits for retrieval before answering without it
+    "EMBEDDING_CACHE_SIZE": 4096,
+    "EMBEDDING_BATCH_SIZE": 64,
+    "EMBEDDING_BATCH_WAIT": 0.005,
+}
+
+# Build the OpenAI and Pinecone clients in the background as soon as a server
+# process loads the WSGI/ASGI application, see research/startup.py
+LLM_WARMUP_ON_STARTUP = True
+# seconds a request waits for that warm-up before answering 503
+LLM_STARTUP_TIMEOUT = 30
 # settings.py
 
 CACHES = {
@@ -35,6 +166,28 @@ CACHES = {
     }
 }
 
+# Conversation memory per chat session_id, see research/sessions.py.
+# LocalSessionStore is private to each worker process; with more than one worker use
+#   {"BACKEND": "research.sessions.CacheSessionStore", "OPTIONS": {"CACHE": "default", "TTL": 3600}}
+# on a shared cache such as django.core.cache.backends.redis.RedisCache, or
+#   {"BACKEND": "research.sessions.DatabaseSessionStore", "OPTIONS": {"TTL": 3600}}
+# to keep them in the ChatSession table of DATABASES (SQLite runs in WAL mode).
+LLM_SESSION_STORE = {
+    "BACKEND": "research.sessions.LocalSessionStore",
+    "OPTIONS": {
+        "MAX_ENTRIES": 10000,
+        "MAX_BYTES": 64 * 1024 * 1024,
+        "TTL": 60 * 60,  # seconds a session may sit idle
+        "HOT_ENTRIES": 256,
+    },
+}
+if os.environ.get("LLM_SESSION_STORE") == "database":
+    # set by the Dockerfile, where gunicorn runs several workers
+    LLM_SESSION_STORE = {
+        "BACKEND": "research.sessions.DatabaseSessionStore",
+        "OPTIONS": {"TTL": 60 * 60},
+    }
+
 
 # Application definition
 
@@ -50,6 +203,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "research.middleware.TracingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -59,6 +213,19 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
+# API mode (research/handlers.py): requests under PREFIX, apart from those under
+# EXCLUDE, skip the session, CSRF, auth and message middleware above and only run these
+LLM_API_MODE = {
+    "ENABLED": True,
+    "PREFIX": "/research/",
+    # the staff-only service request list needs the session and auth middleware
+    "EXCLUDE": ["/research/admin/", "/research/service-requests"],
+    "MIDDLEWARE": [
+        "research.middleware.TracingMiddleware",
+        "django.middleware.security.SecurityMiddleware",
+    ],
+}
+
 ROOT_URLCONF = "llm_django_backend.urls"
 
 TEMPLATES = [
@@ -86,7 +253,8 @@ WSGI_APPLICATION = "llm_django_backend.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        # the Dockerfile points this at its volume
+        "NAME": os.environ.get("SQLITE_PATH", BASE_DIR / "db.sqlite3"),
     }
 }
 
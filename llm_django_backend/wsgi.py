@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/wsgi/
 
 import os
 
-from django.core.wsgi import get_wsgi_application
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "llm_django_backend.settings")
 
-application = get_wsgi_application()
+from research.handlers import api_wsgi_application  # noqa: E402
+
+# get_wsgi_application(), with /research/ on the slim middleware chain of LLM_API_MODE
+application = api_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+from research.startup import start_warmup  # noqa: E402
+
+if settings.LLM_WARMUP_ON_STARTUP:
+    start_warmup()
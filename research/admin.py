@@ -1,3 +1,12 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ServiceRequest
+
+
+@admin.register(ServiceRequest)
+class ServiceRequestAdmin(admin.ModelAdmin):
+    list_display = ("id", "service", "room_number", "status", "created_at", "updated_at")
+    list_editable = ("status",)
+    list_filter = ("status", "service")
+    search_fields = ("=id", "=room_number")
+    ordering = ("-id",)
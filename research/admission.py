@@ -0,0 +1,344 @@
+"""
+Admission control in front of the llm-engine views and the OpenAI calls they make.
+
+``RateLimiter`` keeps a token bucket per session and one for the process,
+and turns away a request over either with ``429 Too Many Requests``.
+``LLMGate`` caps how many model calls run at once. Calls over the cap wait in
+a bounded FIFO queue for at most ``queue_timeout`` seconds; a full queue or an
+expired wait is answered with ``503 Service Unavailable``. Both errors carry a
+``Retry-After``, so a burst degrades into short waits and fast refusals
+instead of piling up on OpenAI.
+
+``GatedModel`` holds a gate slot for each attempt at a model call, and retries
+rate limits, timeouts and server errors of the OpenAI API with ``backoff``,
+giving the slot back while it waits. Configured
+with the ``LLM_RATE_LIMIT`` and ``LLM_CONCURRENCY`` settings.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any
+
+import backoff
+from django.conf import settings
+from langchain_core.runnables import RunnableSerializable
+
+from .tracing import record
+
+
+class RateLimited(Exception):
+    http_status = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    http_status = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+class TokenBucket:
+    """``rate`` tokens a second, up to ``burst`` saved up. Not thread-safe, the owner locks."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Take a token; returns 0, or the seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+
+    def __init__(self, enabled=True, session_rate=1.0, session_burst=5, process_rate=50.0, process_burst=100,
+                 max_sessions=10000):
+        self.enabled = enabled
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.max_sessions = max_sessions
+        self._process = TokenBucket(process_rate, process_burst, time.monotonic())
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.limited = 0
+
+    def check(self, session_id):
+        """Admit one request of ``session_id``, or raise ``RateLimited``."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._sessions.get(session_id)
+            if bucket is None:
+                bucket = self._sessions[session_id] = TokenBucket(self.session_rate, self.session_burst, now)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            wait = bucket.take(now)
+            if wait:
+                self.limited += 1
+                raise RateLimited("Too many messages in this conversation, slow down", wait)
+            wait = self._process.take(now)
+            if wait:
+                # the session's token is not spent on a request that was turned away
+                bucket.tokens += 1
+                self.limited += 1
+                raise RateLimited("The assistant is receiving too many messages, retry shortly", wait)
+            self.admitted += 1
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "sessions": len(self._sessions),
+                    "admitted": self.admitted, "limited": self.limited}
+
+
+def upstream_errors():
+    """OpenAI errors worth retrying: rate limits, timeouts, connection and server errors."""
+    from openai import error
+    return (error.RateLimitError, error.ServiceUnavailableError, error.Timeout,
+            error.APIConnectionError, error.TryAgain, error.APIError)
+
+
+class LLMGate:
+    """
+    At most ``max_calls`` model calls at a time, with a FIFO queue of ``max_queued`` waiters.
+
+    Waiters are ``concurrent.futures.Future`` objects, so threads and event
+    loops queue together; a freed slot is handed straight to the oldest one.
+    """
+
+    def __init__(self, max_calls=16, max_queued=64, queue_timeout=10.0, max_tries=4, max_retry_time=20.0):
+        self.max_calls = max_calls
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.max_tries = max_tries
+        self.max_retry_time = max_retry_time
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.retries = 0
+
+    def _enqueue(self):
+        """``None`` when a slot was free, else the ``Future`` that will hand one over."""
+        with self._lock:
+            if self._active < self.max_calls and not self._waiters:
+                self._active += 1
+                self.admitted += 1
+                return None
+            if len(self._waiters) >= self.max_queued:
+                self.rejected += 1
+                raise Overloaded("The assistant is busy, retry shortly", self.queue_timeout)
+            waiter = Future()
+            self._waiters.append(waiter)
+            self.queued += 1
+            return waiter
+
+    def _expired(self, waiter):
+        """The wait timed out; raise unless the slot was handed over meanwhile."""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self.timeouts += 1
+                raise Overloaded("The assistant is busy, retry shortly", self.queue_timeout)
+
+    def acquire(self):
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        start = time.perf_counter()
+        try:
+            waiter.result(timeout=self.queue_timeout)
+        except TimeoutError:
+            self._expired(waiter)
+        finally:
+            record("llm_queue", time.perf_counter() - start)
+
+    async def aacquire(self):
+        waiter = self._enqueue()
+        if waiter is None:
+            return
+        start = time.perf_counter()
+        try:
+            # shield, so a timeout or disconnect does not cancel the slot out from under release()
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter)), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._expired(waiter)
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            self.release()
+            raise
+        finally:
+            record("llm_queue", time.perf_counter() - start)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # the slot goes to the oldest waiter, the active count stays the same
+                self.admitted += 1
+                self._waiters.popleft().set_result(True)
+            else:
+                self._active -= 1
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _on_backoff(self, details):
+        with self._lock:
+            self.retries += 1
+
+    def _retrying(self, func):
+        return backoff.on_exception(backoff.expo, upstream_errors(), max_tries=self.max_tries,
+                                    max_time=self.max_retry_time, on_backoff=self._on_backoff)(func)
+
+    def call(self, func, *args, **kwargs):
+        """``func`` with backoff retries; upstream errors that outlast them become ``Overloaded``."""
+        try:
+            return self._retrying(func)(*args, **kwargs)
+        except upstream_errors() as e:
+            raise Overloaded(f"The language model is unavailable: {e}", self.max_retry_time) from e
+
+    async def acall(self, func, *args, **kwargs):
+        try:
+            return await self._retrying(func)(*args, **kwargs)
+        except upstream_errors() as e:
+            raise Overloaded(f"The language model is unavailable: {e}", self.max_retry_time) from e
+
+    def stats(self):
+        with self._lock:
+            return {"active": self._active, "waiting": len(self._waiters), "max_calls": self.max_calls,
+                    "admitted": self.admitted, "queued": self.queued, "rejected": self.rejected,
+                    "timeouts": self.timeouts, "retries": self.retries}
+
+
+_END = object()
+
+
+class GatedModel(RunnableSerializable):
+    """
+    The agent's model behind an ``LLMGate``, with ``backoff`` retries.
+
+    Each attempt takes a slot of its own, so a call waiting to retry does not
+    hold one. A stream is retried until its first chunk arrives, never after
+    a chunk has been passed on. It runs no run of its own, so callbacks see each
+    attempt as the model's own call.
+    """
+
+    bound: Any
+    gate: Any
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __repr__(self):
+        # serialized on every chain start, keep it short
+        return "GatedModel()"
+
+    def invoke(self, input, config=None, **kwargs):
+        def attempt():
+            with self.gate.slot():
+                return self.bound.invoke(input, config, **kwargs)
+
+        return self.gate.call(attempt)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        async def attempt():
+            async with self.gate.aslot():
+                return await self.bound.ainvoke(input, config, **kwargs)
+
+        return await self.gate.acall(attempt)
+
+    def stream(self, input, config=None, **kwargs):
+        def start():
+            # the slot is kept for the rest of the stream once the first chunk is in
+            self.gate.acquire()
+            try:
+                chunks = iter(self.bound.stream(input, config, **kwargs))
+                return chunks, next(chunks, _END)
+            except BaseException:
+                self.gate.release()
+                raise
+
+        chunks, first = self.gate.call(start)
+        try:
+            if first is not _END:
+                yield first
+                yield from chunks
+        finally:
+            self.gate.release()
+
+    async def astream(self, input, config=None, **kwargs):
+        async def start():
+            await self.gate.aacquire()
+            try:
+                chunks = self.bound.astream(input, config, **kwargs).__aiter__()
+                try:
+                    return chunks, await chunks.__anext__()
+                except StopAsyncIteration:
+                    return chunks, _END
+            except BaseException:
+                self.gate.release()
+                raise
+
+        chunks, first = await self.gate.acall(start)
+        try:
+            if first is not _END:
+                yield first
+                async for chunk in chunks:
+                    yield chunk
+        finally:
+            self.gate.release()
+
+
+def load_rate_limiter(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_RATE_LIMIT", {})
+    return RateLimiter(**{key.lower(): value for key, value in config.items()})
+
+
+def load_llm_gate(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_CONCURRENCY", {})
+    return LLMGate(**{key.lower(): value for key, value in config.items()})
@@ -0,0 +1,138 @@
+import contextvars
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.db import close_old_connections
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentFinish, AgentStep
+from langchain_core.pydantic_v1 import root_validator
+
+from .methods import ToolResult, ToolResults
+
+logger = logging.getLogger(__name__)
+
+# tools wait on the network (weather, hotel services), so a few threads go a long way
+tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-tools")
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """
+    ``AgentExecutor`` that runs the tool calls of one model response concurrently.
+
+    With OpenAI tool calling the model can ask for several tools at once
+    ("bring towels and a club sandwich"). The base class runs them one after
+    the other on the sync path; here every call is submitted to
+    ``tool_executor`` before any is waited on, so the step takes as long as
+    its slowest tool. The async path already gathers them.
+
+    When every tool called is ``return_direct`` the turn ends with all their
+    results as one ``ToolResults``, instead of going back to the model. With
+    ``concurrent_tools=False`` the calls run one by one, as in the base class.
+
+    A tool that raises becomes a ``ToolResult`` with ``error`` set, so one
+    failing call does not throw away the others of its turn. Errors with an
+    ``http_status`` (a guest without a room, admission) are about the request
+    rather than the tool, and still propagate.
+    """
+
+    concurrent_tools: bool = True
+
+    @root_validator()
+    def validate_return_direct_tool(cls, values):
+        # the base class refuses return_direct tools for multi-action agents,
+        # since it cannot return several results; _return_all does
+        return values
+
+    def _iter_next_step(self, *args, **kwargs):
+        # the base class performs each action as it is consumed; consuming them
+        # all first starts every tool before waiting on the first one
+        for output in list(super()._iter_next_step(*args, **kwargs)):
+            yield output.result() if isinstance(output, Future) else output
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, *args, **kwargs):
+        if not self.concurrent_tools:
+            return self._perform_tool_call(name_to_tool_map, color_mapping, agent_action, *args, **kwargs)
+        context = contextvars.copy_context()
+        return tool_executor.submit(context.run, self._perform_pooled_tool_call,
+                                    name_to_tool_map, color_mapping, agent_action, *args, **kwargs)
+
+    def _perform_pooled_tool_call(self, *args, **kwargs):
+        # tools acting for the guest reserve request numbers through the ORM, and
+        # no request cycle closes the connections of the pool's threads
+        close_old_connections()
+        try:
+            return self._perform_tool_call(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    def _perform_tool_call(self, name_to_tool_map, color_mapping, agent_action, *args, **kwargs):
+        try:
+            return super()._perform_agent_action(name_to_tool_map, color_mapping, agent_action, *args, **kwargs)
+        except Exception as e:
+            return self._failed_step(agent_action, e)
+
+    async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, *args, **kwargs):
+        try:
+            return await super()._aperform_agent_action(
+                name_to_tool_map, color_mapping, agent_action, *args, **kwargs)
+        except Exception as e:
+            return self._failed_step(agent_action, e)
+
+    @staticmethod
+    def _failed_step(agent_action, error):
+        if hasattr(error, "http_status"):
+            raise error
+        logger.exception("Tool %s failed", agent_action.tool)
+        parameters = agent_action.tool_input if isinstance(agent_action.tool_input, dict) else {}
+        return AgentStep(action=agent_action, observation=ToolResult(
+            agent_action.tool, "Sorry, that request could not be completed, please try again.",
+            parameters, error=str(error) or type(error).__name__))
+
+    def _take_next_step(self, name_to_tool_map, *args, **kwargs):
+        return self._return_all(name_to_tool_map, super()._take_next_step(name_to_tool_map, *args, **kwargs))
+
+    async def _atake_next_step(self, name_to_tool_map, *args, **kwargs):
+        return self._return_all(name_to_tool_map, await super()._atake_next_step(name_to_tool_map, *args, **kwargs))
+
+    def _return_all(self, name_to_tool_map, output):
+        # a single return_direct call is already returned by the base class
+        if isinstance(output, AgentFinish) or len(output) < 2:
+            return output
+        if all(action.tool in name_to_tool_map and name_to_tool_map[action.tool].return_direct
+               for action, _ in output):
+            key = self.agent.return_values[0] if self.agent.return_values else "output"
+            return AgentFinish({key: ToolResults(observation for _, observation in output)}, "")
+        return output
+
+
+class SharedAgentExecutor:
+    """
+    One ``AgentExecutor`` built per worker and shared by every request.
+
+    ``AgentExecutor`` keeps no per-run state, but it owns its ``memory``, so
+    building one per request (to attach the session's memory) re-validates the
+    tool list and callbacks on the hot path. Here the executor is built once
+    without memory, and each call loads and saves the session's memory itself,
+    the way ``Chain.prep_inputs`` / ``Chain.prep_outputs`` would.
+
+    ``context`` is the turn's retrieved passages, or the ``PendingRetrieval``
+    still producing them. The output may be a ``ToolResult`` or
+    ``ToolResults``; memory keeps their answer text.
+    """
+
+    def __init__(self, agent_chain, tools, **kwargs):
+        self.executor = ParallelAgentExecutor(agent=agent_chain, tools=tools, **kwargs)
+
+    def invoke(self, question, memory, context=None, config=None):
+        inputs = {"question": question, "context": context, **memory.load_memory_variables({})}
+        output = self.executor.invoke(inputs, config=config)
+        memory.save_context({"question": question}, {"output": str(output["output"])})
+        return output
+
+    async def ainvoke(self, question, memory, context=None, config=None):
+        # conversation memories are plain in-process buffers, so their sync
+        # methods are cheaper than the executor hop of aload_memory_variables
+        inputs = {"question": question, "context": context, **memory.load_memory_variables({})}
+        output = await self.executor.ainvoke(inputs, config=config)
+        memory.save_context({"question": question}, {"output": str(output["output"])})
+        return output
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ResearchConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'research'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .sessions import enable_sqlite_wal
+
+        # before any connection is opened, so each of them is switched to WAL
+        connection_created.connect(enable_sqlite_wal, dispatch_uid="research-sqlite-wal")
@@ -0,0 +1,141 @@
+"""
+Many guest messages in one request, for kiosk backlogs, SMS gateway replays
+and offline evaluation.
+
+``BatchRunner`` groups the items by session. Sessions run concurrently on a
+pool of ``concurrency`` threads shared by every batch of the worker, and the
+turns of one session run one after the other, in the order they were sent,
+each seeing the memory the previous one left. Results are handed back as
+soon as each turn finishes, tagged with the item's index, so the view can
+stream them as NDJSON. Configured with the ``LLM_BATCH`` setting.
+"""
+import contextvars
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class InvalidBatch(Exception):
+    http_status = 400
+
+
+class BatchTooLarge(Exception):
+    http_status = 413
+
+
+def group_by_session(items):
+    """``{session_id: [(index, item), ...]}`` in the order the items came."""
+    sessions = OrderedDict()
+    for index, item in enumerate(items):
+        sessions.setdefault(item.get("session_id"), []).append((index, item))
+    return sessions
+
+
+_DONE = object()
+
+
+class BatchResults:
+    """
+    The ``(index, result, error)`` of a batch's turns, in the order they finish.
+
+    ``close``, e.g. when the client goes away, stops every session at its
+    next turn and waits for those still in a turn, so the memories they
+    write to are complete once it returns.
+    """
+
+    def __init__(self, sessions):
+        self.stopped = threading.Event()
+        self.remaining = sessions
+        self._results = queue.SimpleQueue()
+
+    def put(self, result):
+        self._results.put(result)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.remaining:
+            result = self._results.get()
+            if result is _DONE:
+                self.remaining -= 1
+            else:
+                return result
+        raise StopIteration
+
+    def close(self):
+        self.stopped.set()
+        while self.remaining:
+            if self._results.get() is _DONE:
+                self.remaining -= 1
+
+
+class BatchRunner:
+
+    def __init__(self, concurrency=8, max_items=1000):
+        self.concurrency = concurrency
+        self.max_items = max_items
+        self._executor = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix="llm-batch")
+        return self._executor
+
+    def check(self, items):
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise InvalidBatch("Send a JSON array of {query, session_id, room} objects")
+        if len(items) > self.max_items:
+            raise BatchTooLarge(f"At most {self.max_items} items per batch, got {len(items)}")
+
+    def run(self, sessions, turn):
+        """
+        Start ``turn(session_id, item)`` for every item of ``sessions``; returns their ``BatchResults``.
+
+        The sessions are submitted straight away, in the caller's context.
+        """
+        results = BatchResults(len(sessions))
+
+        def run_session(session_id, session_items):
+            # pool threads are outside the request cycle that closes request threads' connections
+            close_old_connections()
+            try:
+                for index, item in session_items:
+                    if results.stopped.is_set():
+                        return
+                    try:
+                        results.put((index, turn(session_id, item), None))
+                    except Exception as e:
+                        results.put((index, None, e))
+            finally:
+                close_old_connections()
+                results.put(_DONE)
+
+        with self._lock:
+            self.batches += 1
+            self.items += sum(len(session_items) for session_items in sessions.values())
+        # each session carries the request's context (its trace) into the pool
+        for session_id, session_items in sessions.items():
+            self.executor.submit(contextvars.copy_context().run, run_session, session_id, session_items)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {"concurrency": self.concurrency, "max_items": self.max_items,
+                    "batches": self.batches, "items": self.items}
+
+
+def load_batch_runner(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_BATCH", {})
+    return BatchRunner(**{key.lower(): value for key, value in config.items()})
@@ -0,0 +1,653 @@
+"""
+Offline benchmarks for the llm-engine hot path.
+
+Every benchmark runs against ``research.fakes.FakeChatModel`` so it needs no
+API keys or network access. Run them with ``python manage.py bench <name>``.
+"""
+import asyncio
+import gc
+import json
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import orjson
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.test import AsyncRequestFactory, RequestFactory
+
+from . import views
+from .admission import LLMGate
+from .agent import ParallelAgentExecutor, SharedAgentExecutor
+from .fakes import FakeChatModel, FakeOpenMeteoServer
+from .handlers import APIWSGIHandler, api_asgi_application, api_wsgi_application
+from .router import IntentRouter
+from .sessions import new_memory
+from .singleflight import flights
+from .tenancy import hotels
+from .tiering import ModelTiers
+from .weather import WeatherClient, weather_client
+
+INTENT_FIXTURES = Path(__file__).resolve().parent / "intentDataset.jsonl"
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def summarize(samples):
+    """p50/p95/p99 and mean of ``samples`` (seconds), reported in milliseconds."""
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))] * 1000
+
+    return {"p50_ms": round(percentile(50), 3),
+            "p95_ms": round(percentile(95), 3),
+            "p99_ms": round(percentile(99), 3),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3)}
+
+
+@contextmanager
+def fake_agent_chain(response_cache=False, single_flight=False, rate_limit=False, fast=None, **model_kwargs):
+    """
+    Temporarily point the views at an agent built on ``FakeChatModel``, and yield the model.
+
+    The response cache and the model's single-flight are switched off unless
+    asked for, since benchmarks send the same question over and over, and so
+    is the rate limiter, which would turn most of a benchmark away. ``fast``
+    are the keyword arguments of a second ``FakeChatModel`` for the fast
+    tier, ``views.fast_model``; without it every turn goes to the one model.
+    """
+    previous = views.agent_model, views.fast_model, views.response_cache.enabled, views.rate_limiter.enabled
+    model = FakeChatModel(**model_kwargs)
+    views.set_agent_model(model, FakeChatModel(**fast) if fast is not None else None)
+    flights["model"].enabled = single_flight
+    views.response_cache.enabled = response_cache
+    views.rate_limiter.enabled = rate_limit
+    try:
+        yield model
+    finally:
+        previous_model, previous_fast, views.response_cache.enabled, views.rate_limiter.enabled = previous
+        views.set_agent_model(previous_model, previous_fast)
+
+
+@benchmark("ttfb")
+def bench_ttfb(requests=50, concurrency=10, latency=0.5):
+    """Time to first byte, first token and full answer of ``llm-engine/stream``."""
+    factory = AsyncRequestFactory()
+    first_byte, first_token, total = [], [], []
+
+    async def one(n, semaphore):
+        body = json.dumps({"query": "hello", "session_id": f"bench-ttfb-{n}", "room": 101})
+        async with semaphore:
+            start = time.perf_counter()
+            request = factory.post("/research/llm-engine/stream", body,
+                                   content_type="application/json")
+            response = await views.chatbot_engine_stream(request)
+            seen_token = False
+            async for chunk in response.streaming_content:
+                if chunk.startswith(b": "):
+                    first_byte.append(time.perf_counter() - start)
+                elif chunk.startswith(b"event: token") and not seen_token:
+                    seen_token = True
+                    first_token.append(time.perf_counter() - start)
+            total.append(time.perf_counter() - start)
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(one(n, semaphore) for n in range(requests)))
+
+    with fake_agent_chain(latency=latency, token_latency=0.01):
+        asyncio.run(run())
+
+    return {"first_byte": summarize(first_byte),
+            "first_token": summarize(first_token),
+            "total": summarize(total)}
+
+
+@benchmark("executor")
+def bench_executor(requests=500, concurrency=1, latency=0.0):
+    """Per-request cost of building an executor per call versus the shared one."""
+    agent_chain = views.build_agent_chain(FakeChatModel(latency=latency))
+    shared = SharedAgentExecutor(agent_chain, views.tools)
+
+    def per_request(memory):
+        ParallelAgentExecutor(agent=agent_chain, tools=views.tools, memory=memory).invoke({"question": "hello"})
+
+    def reused(memory):
+        shared.invoke("hello", memory)
+
+    result = {}
+    for name, run in (("per_request", per_request), ("shared", reused)):
+        run(new_memory())  # warm up
+        samples = []
+        for _ in range(requests):
+            memory = new_memory()
+            start = time.perf_counter()
+            run(memory)
+            samples.append(time.perf_counter() - start)
+        result[name] = summarize(samples)
+
+    construct = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        ParallelAgentExecutor(agent=agent_chain, tools=views.tools, memory=new_memory())
+        construct.append(time.perf_counter() - start)
+    result["construction_only"] = summarize(construct)
+    return result
+
+
+@benchmark("weather")
+def bench_weather(requests=200, concurrency=8, latency=0.05, locations=10):
+    """``get_current_temperature`` lookups against a local Open-Meteo, with and without the forecast cache."""
+    # a handful of hotels, each with guests a few metres apart
+    coordinates = [(6.9271 + i + j * 0.0001, 79.8612 + i) for j in range(requests) for i in range(locations)][:requests]
+
+    result = {}
+    with FakeOpenMeteoServer(latency=latency) as server:
+        for name, ttl in (("uncached", 0), ("cached", 60 * 60)):
+            client = WeatherClient(base_url=server.url, ttl=ttl)
+            served = server.requests
+
+            def lookup(coordinate):
+                start = time.perf_counter()
+                client.current_temperature(*coordinate)
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                samples = list(executor.map(lookup, coordinates))
+            elapsed = time.perf_counter() - start
+            result[name] = {**summarize(samples),
+                            "seconds": round(elapsed, 3),
+                            "upstream_requests": server.requests - served,
+                            **client.stats()}
+    return result
+
+
+@benchmark("router")
+def bench_router(requests=200, concurrency=1, latency=0.5):
+    """
+    Accuracy and latency of the intent router on the labelled ``intentDataset.jsonl``.
+
+    ``wrong`` counts messages routed to the wrong tool or arguments, the
+    costly mistake; ``missed`` counts requests left to the agent. ``turn``
+    compares a whole ``chatbot_engine`` call answered by the router with one
+    answered by the agent on a model that takes ``latency`` seconds.
+    """
+    with open(INTENT_FIXTURES) as f:
+        fixtures = [json.loads(line) for line in f if line.strip()]
+    router = IntentRouter()
+
+    counts = {"correct": 0, "wrong": 0, "missed": 0, "fallback": 0}
+    samples = []
+    for _ in range(max(1, requests // len(fixtures))):
+        for fixture in fixtures:
+            start = time.perf_counter()
+            route = router.route(fixture["text"])
+            samples.append(time.perf_counter() - start)
+            if route is None:
+                counts["missed" if fixture["tool"] else "fallback"] += 1
+            elif route.tool == fixture["tool"] and fixture["arguments"] in (None, route.arguments):
+                counts["correct"] += 1
+            else:
+                counts["wrong"] += 1
+    labelled = sum(1 for fixture in fixtures if fixture["tool"])
+    result = {"fixtures": len(fixtures),
+              "precision": round(counts["correct"] / max(1, counts["correct"] + counts["wrong"]), 3),
+              "coverage": round(counts["correct"] / max(1, labelled * (len(samples) // len(fixtures))), 3),
+              **counts,
+              "route": summarize(samples)}
+
+    factory = RequestFactory()
+    routed = [fixture["text"] for fixture in fixtures if router.route(fixture["text"])]
+    with fake_agent_chain(latency=latency):
+        for name, enabled in (("turn_routed", True), ("turn_agent", False)):
+            previous, views.intent_router.enabled = views.intent_router.enabled, enabled
+            try:
+                turns = []
+                for i in range(min(requests, 20)):
+                    body = json.dumps({"query": routed[i % len(routed)], "session_id": f"bench-router-{i}",
+                                       "room": 101})
+                    start = time.perf_counter()
+                    views.chatbot_engine(factory.post("/research/llm-engine", body, content_type="application/json"))
+                    turns.append(time.perf_counter() - start)
+                result[name] = summarize(turns)
+            finally:
+                views.intent_router.enabled = previous
+    return result
+
+
+@benchmark("parallel_tools")
+def bench_parallel_tools(requests=20, concurrency=3, latency=0.2):
+    """
+    One turn in which the model calls ``concurrency`` tools at once.
+
+    The tools are uncached weather lookups against a local Open-Meteo that
+    takes ``latency`` seconds. ``sequential`` runs the calls one by one,
+    ``parallel`` runs them together; both answer with all the results.
+    """
+    calls = [{"name": "get_current_temperature", "arguments": {"latitude": 6.9 + i, "longitude": 79.8 + i}}
+             for i in range(concurrency)]
+    inputs = {"question": "what is the weather at our hotels", "context": None, "chat_history": []}
+    agent_chain = views.build_agent_chain(FakeChatModel(responses=[calls]))
+    executors = {
+        "sequential": ParallelAgentExecutor(agent=agent_chain, tools=views.tools, concurrent_tools=False),
+        "parallel": ParallelAgentExecutor(agent=agent_chain, tools=views.tools),
+    }
+
+    result = {}
+    previous = weather_client.base_url, weather_client.ttl
+    with FakeOpenMeteoServer(latency=latency) as server:
+        weather_client.base_url, weather_client.ttl = server.url, 0
+        try:
+            for name, executor in executors.items():
+                samples = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    executor.invoke(inputs)
+                    samples.append(time.perf_counter() - start)
+                result[name] = summarize(samples)
+
+            async def run_async():
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    await executors["parallel"].ainvoke(inputs)
+                    samples.append(time.perf_counter() - start)
+
+            samples = []
+            asyncio.run(run_async())
+            result["parallel_async"] = summarize(samples)
+        finally:
+            weather_client.base_url, weather_client.ttl = previous
+    return result
+
+
+@benchmark("coalesce")
+def bench_coalesce(requests=50, concurrency=10, latency=0.5):
+    """
+    Bursts of ``concurrency`` guests sending the same first question to ``chatbot_engine``.
+
+    ``model_calls`` counts the completions the fake model served, with and
+    without single-flight in front of it.
+    """
+    factory = RequestFactory()
+    result = {}
+    for name, single_flight in (("separate", False), ("single_flight", True)):
+        with fake_agent_chain(single_flight=single_flight, latency=latency) as model:
+            def turn(n):
+                body = json.dumps({"query": "what can I do around the hotel this evening",
+                                   "session_id": f"bench-coalesce-{name}-{n}"})
+                start = time.perf_counter()
+                response = views.chatbot_engine(factory.post("/research/llm-engine", body,
+                                                             content_type="application/json"))
+                assert response.status_code == 200, response.content
+                return time.perf_counter() - start
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                samples = list(executor.map(turn, range(requests)))
+            result[name] = {**summarize(samples), "model_calls": model.i}
+    return result
+
+
+@benchmark("admission")
+def bench_admission(requests=200, concurrency=50, latency=0.5, max_calls=8, max_queued=16):
+    """
+    A burst of ``concurrency`` guests against a gate of ``max_calls`` model calls and ``max_queued`` waiters.
+
+    Requests beyond what the gate holds are answered with 503 and a
+    ``Retry-After`` right away instead of queueing behind the model; compare
+    the latency of the served requests with that of the refused ones.
+    """
+    factory = RequestFactory()
+    gate = views.llm_gate
+    views.llm_gate = LLMGate(max_calls=max_calls, max_queued=max_queued, queue_timeout=latency * 4)
+    served, refused = [], []
+    try:
+        with fake_agent_chain(latency=latency):
+            def turn(n):
+                body = json.dumps({"query": "hello", "session_id": f"bench-admission-{n}"})
+                start = time.perf_counter()
+                response = views.chatbot_engine(factory.post("/research/llm-engine", body,
+                                                             content_type="application/json"))
+                elapsed = time.perf_counter() - start
+                if response.status_code == 200:
+                    served.append(elapsed)
+                else:
+                    assert response.status_code == 503 and response.has_header("Retry-After"), response.content
+                    refused.append(elapsed)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(turn, range(requests)))
+            elapsed = time.perf_counter() - start
+        stats = views.llm_gate.stats()
+    finally:
+        views.llm_gate = gate
+    return {"served": {"count": len(served), **summarize(served)},
+            "refused": {"count": len(refused), **summarize(refused)},
+            "requests_per_second": round(len(served) / elapsed, 1),
+            "gate": stats}
+
+
+# a conversation of plain answers, a cacheable lookup and a stateful request
+LOAD_QUESTIONS = [
+    "hello",
+    "can you recommend me a room under 1000 per day",
+    "remind me about the meeting tomorrow at 4PM",
+    "when is breakfast served",
+]
+LOAD_RESPONSES = [
+    "Hello! I am the hotel assistant. How can I help you today?",
+    {"name": "room_recommendation", "arguments": {"budget_highest": 1000}},
+    {"name": "request_reminder", "arguments": {
+        "reminder_message": "meeting", "reminder_date": "tomorrow", "reminder_time": "4:00PM"}},
+    "Breakfast is served from 7 to 10 in the lobby restaurant.",
+]
+
+
+def rss_bytes():
+    """Current resident set size, or the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_body(run, session, turn):
+    return json.dumps({"query": LOAD_QUESTIONS[turn % len(LOAD_QUESTIONS)],
+                       "session_id": f"bench-load-{run}-{session}",
+                       "room": 100 + session % 50}).encode()
+
+
+def drive_wsgi(path, run, sessions, turns, concurrency):
+    """``sessions`` conversations of ``turns`` requests through the WSGI handler, ``concurrency`` threads."""
+    application = api_wsgi_application()
+    factory = RequestFactory()
+
+    def conversation(session):
+        samples, errors = [], 0
+        for turn in range(turns):
+            environ = factory.post(path, load_body(run, session, turn),
+                                   content_type="application/json").environ
+            status = []
+            start = time.perf_counter()
+            response = application(environ, lambda status_line, headers, exc_info=None: status.append(status_line))
+            try:
+                b"".join(response)
+            finally:
+                response.close()
+            samples.append(time.perf_counter() - start)
+            errors += not status[0].startswith("200")
+        return samples, errors
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(conversation, range(sessions)))
+
+
+def drive_asgi(path, run, sessions, turns, concurrency):
+    """The same conversations through the ASGI handler, ``concurrency`` at a time on one event loop."""
+    application = api_asgi_application()
+
+    async def request(body):
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+                 "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(),
+                 "root_path": "", "query_string": b"", "client": ("127.0.0.1", 0),
+                 "server": ("testserver", 80),
+                 "headers": [(b"host", b"testserver"), (b"content-type", b"application/json"),
+                             (b"content-length", str(len(body)).encode())]}
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        finished = asyncio.Event()
+        status = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+            elif not message.get("more_body"):
+                finished.set()
+
+        await application(scope, receive, send)
+        finished.set()
+        return status[0]
+
+    async def conversation(session, semaphore):
+        samples, errors = [], 0
+        async with semaphore:
+            for turn in range(turns):
+                start = time.perf_counter()
+                status = await request(load_body(run, session, turn))
+                samples.append(time.perf_counter() - start)
+                errors += status != 200
+        return samples, errors
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*(conversation(session, semaphore) for session in range(sessions)))
+
+    return asyncio.run(main())
+
+
+@benchmark("batch")
+def bench_batch(requests=200, concurrency=1, latency=0.5, turns=4):
+    """
+    A backlog of ``requests`` messages, ``turns`` per session, replayed one request at a time
+    with ``concurrency`` clients, against the same backlog sent as one ``llm-engine/batch`` request.
+
+    Both go through the WSGI handler; ``first_line_ms`` is when the batch's
+    first NDJSON line arrived.
+    """
+    sessions = max(1, requests // turns)
+    result = {"messages": sessions * turns, "sessions": sessions}
+    with fake_agent_chain(responses=LOAD_RESPONSES, latency=latency):
+        start = time.perf_counter()
+        conversations = drive_wsgi("/research/llm-engine", 0, sessions, turns, concurrency)
+        elapsed = time.perf_counter() - start
+        result["one_by_one"] = {"seconds": round(elapsed, 3),
+                                "messages_per_second": round(sessions * turns / elapsed, 1),
+                                "errors": sum(errors for _, errors in conversations)}
+
+        items = [json.loads(load_body(1, session, turn)) for turn in range(turns) for session in range(sessions)]
+        environ = RequestFactory().post("/research/llm-engine/batch", json.dumps(items),
+                                        content_type="application/json").environ
+        start = time.perf_counter()
+        response = api_wsgi_application()(environ, lambda status_line, headers, exc_info=None: None)
+        lines, first_line = [], None
+        try:
+            for chunk in response:
+                first_line = first_line or time.perf_counter() - start
+                lines.extend(json.loads(line) for line in chunk.splitlines())
+        finally:
+            response.close()
+        elapsed = time.perf_counter() - start
+        # turns of one session must come back in the order they were sent
+        by_session = {}
+        for line in lines:
+            by_session.setdefault(line["session_id"], []).append(line["index"])
+        in_order = all(indexes == sorted(indexes) for indexes in by_session.values())
+        result["batch"] = {"seconds": round(elapsed, 3),
+                           "messages_per_second": round(len(lines) / elapsed, 1),
+                           "first_line_ms": round(first_line * 1000, 3),
+                           "errors": sum(not line["success"] for line in lines),
+                           "in_session_order": in_order,
+                           "concurrency": views.batch_runner.concurrency}
+    return result
+
+
+# (kind, history, question, fast model's response, strong model's response)
+TIER_SCENARIOS = [
+    ("simple", [], "Hi there", "Hello! How can I help you today?", "Hello! How can I help you today?"),
+    ("simple", [], "I want a room under 3000 a night",
+     {"name": "room_recommendation", "arguments": {"budget_highest": 3000}},
+     {"name": "room_recommendation", "arguments": {"budget_highest": 3000}}),
+    ("follow_up", [("I'd like some food", "What would you like to order, how many, and where should we serve it?")],
+     "Two club sandwiches to my room",
+     {"name": "order_resturant_item",
+      "arguments": {"item_name": "club sandwich", "item_quantity": 2, "dine_in_type": "dine-in-room"}},
+     {"name": "order_resturant_item",
+      "arguments": {"item_name": "club sandwich", "item_quantity": 2, "dine_in_type": "dine-in-room"}}),
+    # the fast model gets the quantity wrong and is escalated
+    ("escalated", [], "Order a few pizzas to my room",
+     {"name": "order_resturant_item",
+      "arguments": {"item_name": "pizza", "item_quantity": "a few", "dine_in_type": "dine-in-room"}},
+     "How many pizzas would you like?"),
+    ("several_requests", [], "Bring two pillows and clean my room",
+     [{"name": "request_room_amenity", "arguments": {"requested_amenity": "pillow"}},
+      {"name": "housekeeping_service_request", "arguments": {"reason": "room cleaning"}}],
+     [{"name": "request_room_amenity", "arguments": {"requested_amenity": "pillow"}},
+      {"name": "housekeeping_service_request", "arguments": {"reason": "room cleaning"}}]),
+]
+
+
+# what a tiered deployment would run as its strong model
+TIERED_STRONG = {"MODEL": "gpt-4-turbo", "INPUT_COST": 0.01, "OUTPUT_COST": 0.03}
+
+
+@benchmark("tiers")
+def bench_tiers(requests=100, concurrency=1, latency=0.5):
+    """
+    Latency and estimated cost of ``TIER_SCENARIOS`` with every turn on the strong model, and tiered.
+
+    The strong model takes ``latency`` seconds, the fast one a quarter of
+    that; costs use counted tokens, the ``LLM_MODEL_TIERS`` price of the fast
+    tier and ``TIERED_STRONG``'s for the strong one, since both tiers default
+    to the same model. The turns run one at a time, since each sets the
+    replies of both models.
+    """
+    config = {**{key.lower(): value for key, value in settings.LLM_MODEL_TIERS.items()}, "strong": TIERED_STRONG}
+    guest = hotels.guest(None, 101)
+    result = {}
+    previous = views.model_tiers, views.intent_router.enabled
+    # the router would answer some of the scenarios without either model
+    views.intent_router.enabled = False
+    try:
+        for name, enabled in (("strong_only", False), ("tiered", True)):
+            views.model_tiers = tiers = ModelTiers(**{**config, "enabled": enabled})
+            with fake_agent_chain(latency=latency, fast={"latency": latency / 4}) as strong:
+                fast = views.fast_model
+                turns = {}
+                for n in range(requests):
+                    kind, history, question, fast_reply, strong_reply = TIER_SCENARIOS[n % len(TIER_SCENARIOS)]
+                    fast.responses, strong.responses = [fast_reply], [strong_reply]
+                    memory = new_memory()
+                    for asked, answered in history:
+                        memory.save_context({"question": asked}, {"output": answered})
+                    start = time.perf_counter()
+                    views.run_turn(question, guest, memory)
+                    turns.setdefault(kind, []).append(time.perf_counter() - start)
+            stats = tiers.stats()
+            cost = sum(tier["cost"] for tier in stats["tiers"].values())
+            result[name] = {"turn": summarize([sample for samples in turns.values() for sample in samples]),
+                            "turn_p50_ms": {kind: summarize(samples)["p50_ms"] for kind, samples in turns.items()},
+                            **stats,
+                            "cost_per_1000_turns": round(cost / requests * 1000, 4)}
+    finally:
+        views.model_tiers, views.intent_router.enabled = previous
+        views.hotel_agents.clear()
+    return result
+
+
+@benchmark("overhead")
+def bench_overhead(requests=2000):
+    """
+    CPU an llm-engine request costs outside the model, through the full ``MIDDLEWARE`` stack and API mode.
+
+    Every request is an exact response cache hit, so no agent runs and what
+    is left is Django, middleware, body parsing, the session, the cache and
+    encoding. The requests run one at a time and ``cpu_us`` is the process
+    CPU time per request.
+    """
+    factory = RequestFactory()
+    body = {"query": "hello", "room": 101}
+    result = {}
+    with fake_agent_chain(response_cache=True, responses=["Hello! I am the hotel assistant. How can I help you today?"]):
+        for name, application, middleware in (
+                ("full_stack", WSGIHandler(), settings.MIDDLEWARE),
+                ("api_mode", APIWSGIHandler(), settings.LLM_API_MODE["MIDDLEWARE"])):
+            environs = [factory.post("/research/llm-engine", json.dumps({**body, "session_id": f"bench-overhead-{name}-{n}"}),
+                                     content_type="application/json").environ
+                        for n in range(requests + 1)]
+            statuses = []
+
+            def start_response(status_line, headers, exc_info=None):
+                statuses.append(status_line)
+
+            def serve(environ):
+                response = application(environ, start_response)
+                try:
+                    b"".join(response)
+                finally:
+                    response.close()
+
+            # the first request fills the response cache
+            serve(environs.pop())
+            gc.collect()
+            cpu, wall = time.process_time(), time.perf_counter()
+            for environ in environs:
+                serve(environ)
+            cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+            result[name] = {"middleware": len(middleware),
+                            "cpu_us": round(cpu / requests * 1e6, 1),
+                            "wall_us": round(wall / requests * 1e6, 1),
+                            "errors": sum(not status.startswith("200") for status in statuses)}
+
+    raw = json.dumps({**body, "session_id": "bench-overhead"}).encode()
+    for name, loads in (("json_loads_us", json.loads), ("orjson_loads_us", orjson.loads)):
+        start = time.process_time()
+        for _ in range(requests):
+            loads(raw)
+        result[name] = round((time.process_time() - start) / requests * 1e6, 2)
+    return result
+
+
+@benchmark("load")
+def bench_load(requests=200, concurrency=10, latency=0.5, turns=4):
+    """
+    Throughput of the llm-engine endpoints under concurrent conversations.
+
+    ``requests / turns`` simulated sessions, ``concurrency`` of them at a time,
+    each holding a ``turns`` long conversation, are sent through the real WSGI
+    and ASGI handlers (the whole middleware stack) against ``FakeChatModel``.
+    Reports requests per second, latency percentiles and how much the process
+    and the session store grew per session.
+    """
+    sessions = max(1, requests // turns)
+    drivers = [("wsgi", drive_wsgi, "/research/llm-engine"),
+               ("asgi", drive_asgi, "/research/llm-engine"),
+               ("asgi_stream", drive_asgi, "/research/llm-engine/stream")]
+
+    result = {"sessions": sessions, "turns": turns, "concurrency": concurrency}
+    with fake_agent_chain(responses=LOAD_RESPONSES, latency=latency):
+        for run, (name, drive, path) in enumerate(drivers):
+            gc.collect()
+            rss, store_bytes = rss_bytes(), views.session_store.stats().get("bytes", 0)
+            start = time.perf_counter()
+            conversations = drive(path, run, sessions, turns, concurrency)
+            elapsed = time.perf_counter() - start
+            gc.collect()
+            samples = [sample for conversation, _ in conversations for sample in conversation]
+            result[name] = {
+                **summarize(samples),
+                "requests_per_second": round(len(samples) / elapsed, 1),
+                "errors": sum(errors for _, errors in conversations),
+                "rss_bytes_per_session": round((rss_bytes() - rss) / sessions),
+                "session_store_bytes_per_session": round(
+                    (views.session_store.stats().get("bytes", 0) - store_bytes) / sessions),
+            }
+    return result
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Union
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic, offline stand-in for ``ChatOpenAI``.
+
+    ``responses`` are replayed in a loop. A ``str`` becomes a plain answer and a
+    ``{"name": ..., "arguments": {...}}`` dict becomes an OpenAI tool call, and a
+    list of them parallel tool calls, so the agent runs its tools exactly as it
+    would against the real API.
+    ``latency`` is slept before the first token and ``token_latency`` between
+    streamed tokens.
+    """
+
+    responses: List[Union[str, List[dict], dict]] = ["Hello! How can I help you today?"]
+    latency: float = 0.0
+    token_latency: float = 0.0
+    i: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _next_response(self):
+        response = self.responses[self.i % len(self.responses)]
+        self.i += 1
+        return response
+
+    @staticmethod
+    def _tool_calls(response):
+        calls = response if isinstance(response, list) else [response]
+        return [{"id": f"call_{i}", "type": "function",
+                 "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))}}
+                for i, call in enumerate(calls)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        response = self._next_response()
+        time.sleep(self.latency)
+        if isinstance(response, (dict, list)):
+            message = AIMessage(content="", additional_kwargs={"tool_calls": self._tool_calls(response)})
+        else:
+            message = AIMessage(content=response)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _chunks(self, response):
+        if isinstance(response, (dict, list)):
+            # like the API: the name first, then the arguments, tagged with the call's index
+            for i, call in enumerate(self._tool_calls(response)):
+                function = call["function"]
+                yield AIMessageChunk(content="", additional_kwargs={"tool_calls": [
+                    {"index": i, "id": call["id"], "type": "function",
+                     "function": {"name": function["name"], "arguments": ""}}]})
+                yield AIMessageChunk(content="", additional_kwargs={"tool_calls": [
+                    {"index": i, "function": {"arguments": function["arguments"]}}]})
+            return
+        for i, word in enumerate(response.split(" ")):
+            yield AIMessageChunk(content=word if i == 0 else " " + word)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        response = self._next_response()
+        time.sleep(self.latency)
+        for message in self._chunks(response):
+            chunk = ChatGenerationChunk(message=message)
+            if run_manager:
+                run_manager.on_llm_new_token(message.content, chunk=chunk)
+            yield chunk
+            time.sleep(self.token_latency)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        response = self._next_response()
+        await asyncio.sleep(self.latency)
+        for message in self._chunks(response):
+            chunk = ChatGenerationChunk(message=message)
+            if run_manager:
+                await run_manager.on_llm_new_token(message.content, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(self.token_latency)
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Local, deterministic stand-in for ``OpenAIEmbeddings``.
+
+    Texts are embedded as hashed bags of words, so texts sharing words get a
+    high cosine similarity, and identical texts always get the same vector.
+    """
+
+    def __init__(self, size=1536):
+        self.size = size
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode()) % self.size] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class FakeOpenMeteoServer:
+    """
+    Local HTTP server answering like ``api.open-meteo.com/v1/forecast``.
+
+    Returns 24 hourly temperatures for the current UTC day, in the
+    ``timeformat=unixtime`` shape, after ``latency`` seconds. The first
+    ``failures`` requests are answered with a 503 instead. ``requests``
+    counts every request. Use as a context manager and point a
+    ``WeatherClient`` at ``url``.
+    """
+
+    def __init__(self, latency=0.0, failures=0):
+        self.latency = latency
+        self.failures = failures
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, so pooled connections are reused
+
+            def do_GET(self):
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.requests <= server.failures:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                query = parse_qs(urlparse(self.path).query)
+                latitude = float(query.get("latitude", ["0"])[0])
+                midnight = int(time.time()) // 86400 * 86400
+                body = json.dumps({
+                    "latitude": latitude,
+                    "longitude": float(query.get("longitude", ["0"])[0]),
+                    "hourly": {
+                        "time": [midnight + hour * 3600 for hour in range(24)],
+                        "temperature_2m": [round(20 + latitude / 10 + hour / 4, 1) for hour in range(24)],
+                    },
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/forecast"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
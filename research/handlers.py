@@ -0,0 +1,88 @@
+"""
+API mode: the research API served through its own, minimal middleware chain.
+
+``settings.MIDDLEWARE`` is the stack the admin needs: sessions, CSRF, auth
+and messages. The llm-engine views use none of it (CSRF is exempted on every
+one of them), yet each request would pay for all of it. ``wsgi.py`` and
+``asgi.py`` serve ``api_wsgi_application()`` / ``api_asgi_application()``,
+which send requests under ``PREFIX``, apart from those under ``EXCLUDE``, to
+a second Django handler built from ``MIDDLEWARE`` of the ``LLM_API_MODE``
+setting, and everything else to the usual one. Both resolve the same URLconf.
+"""
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+
+
+def api_settings():
+    return getattr(settings, "LLM_API_MODE", {})
+
+
+class APIHandlerMixin:
+    """Builds the handler's middleware chain from ``LLM_API_MODE["MIDDLEWARE"]``."""
+
+    def load_middleware(self, is_async=False):
+        # BaseHandler reads settings.MIDDLEWARE, swap it in while this chain is built at startup
+        full_stack = settings.MIDDLEWARE
+        settings.MIDDLEWARE = api_settings().get("MIDDLEWARE", [])
+        try:
+            super().load_middleware(is_async)
+        finally:
+            settings.MIDDLEWARE = full_stack
+
+
+class APIWSGIHandler(APIHandlerMixin, WSGIHandler):
+    pass
+
+
+class APIASGIHandler(APIHandlerMixin, ASGIHandler):
+    pass
+
+
+class PathDispatcher:
+
+    def __init__(self, application, api_application, prefix="/research/", exclude=()):
+        self.application = application
+        self.api_application = api_application
+        self.prefix = prefix
+        self.exclude = tuple(exclude)
+
+    def is_api(self, path):
+        return path.startswith(self.prefix) and not path.startswith(self.exclude)
+
+
+class WSGIDispatcher(PathDispatcher):
+
+    def __call__(self, environ, start_response):
+        if self.is_api(environ.get("PATH_INFO", "")):
+            return self.api_application(environ, start_response)
+        return self.application(environ, start_response)
+
+
+class ASGIDispatcher(PathDispatcher):
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.is_api(scope["path"]):
+            return await self.api_application(scope, receive, send)
+        return await self.application(scope, receive, send)
+
+
+def api_wsgi_application():
+    """``get_wsgi_application()``, with the API on its own middleware chain when ``LLM_API_MODE`` is enabled."""
+    django.setup(set_prefix=False)
+    config = api_settings()
+    if not config.get("ENABLED", False):
+        return WSGIHandler()
+    return WSGIDispatcher(WSGIHandler(), APIWSGIHandler(),
+                          config.get("PREFIX", "/research/"), config.get("EXCLUDE", ()))
+
+
+def api_asgi_application():
+    """``get_asgi_application()``, with the API on its own middleware chain when ``LLM_API_MODE`` is enabled."""
+    django.setup(set_prefix=False)
+    config = api_settings()
+    if not config.get("ENABLED", False):
+        return ASGIHandler()
+    return ASGIDispatcher(ASGIHandler(), APIASGIHandler(),
+                          config.get("PREFIX", "/research/"), config.get("EXCLUDE", ()))
@@ -0,0 +1,179 @@
+"""
+Bulk loading of hotel documents into the retrieval index.
+
+Documents are streamed from disk, split into chunks, and embedded in batches
+by parallel, rate-limited requests. The vectors are then upserted in batches.
+Every chunk's id is the hash of its text. The hashes of upserted chunks are
+appended to a checkpoint file, so an interrupted run can be restarted and
+unchanged chunks are never embedded twice. The checkpoint belongs to one index
+(``default_checkpoint``): the local index keeps it in its own directory, so
+deleting the index deletes it too. Driven by ``manage.py ingest_documents``.
+"""
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import backoff
+from django.conf import settings
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from .admission import upstream_errors
+
+TEXT_SUFFIXES = {".txt", ".md", ".rst", ".html", ".csv"}
+
+
+def read_documents(paths):
+    """Yield ``(source, text)`` for every file under ``paths``, one at a time."""
+    for path in map(Path, paths):
+        files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+        for file in files:
+            if file.suffix == ".jsonl":
+                # one document per line, like research/testDataset.jsonl
+                with open(file, encoding="utf-8") as f:
+                    for number, line in enumerate(f):
+                        if line.strip():
+                            record = json.loads(line)
+                            yield f"{file}:{number}", record.get("chunk") or record.get("text", "")
+            elif file.suffix in TEXT_SUFFIXES:
+                yield str(file), file.read_text(encoding="utf-8")
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+
+class Checkpoint:
+    """Append-only file of the content hashes already in the index."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.done = set(self.path.read_text().split()) if self.path.exists() else set()
+
+    def __contains__(self, digest):
+        return digest in self.done
+
+    def add(self, digests):
+        with open(self.path, "a") as f:
+            f.write("".join(f"{digest}\n" for digest in digests))
+        self.done.update(digests)
+
+
+def default_checkpoint(config=None):
+    """Where the checkpoint of the index described by ``config`` or ``settings.LLM_VECTORSTORE`` is kept."""
+    if config is None:
+        config = settings.LLM_VECTORSTORE
+    if config["BACKEND"] == "memmap":
+        return Path(config["PATH"]) / "ingest-checkpoint.txt"
+    return settings.BASE_DIR / f".ingest-checkpoint-{config['BACKEND']}-{config['INDEX_NAME']}.txt"
+
+
+class RateLimiter:
+    """Spaces calls out so no more than ``per_minute`` start in any minute."""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Ingestor:
+    """
+    Chunk, embed and upsert documents into ``index``.
+
+    ``workers`` embedding requests of ``embed_batch_size`` chunks run at once,
+    started no faster than ``requests_per_minute``. Rate limits, timeouts,
+    connection and server errors of the OpenAI API are retried with
+    exponential backoff up to ``max_tries`` times; anything else, such as a
+    bad key, stops the run.
+    """
+
+    def __init__(self, index, embeddings, checkpoint, chunk_size=1000, chunk_overlap=100,
+                 embed_batch_size=64, upsert_batch_size=100, workers=4, requests_per_minute=3000, max_tries=6):
+        self.index = index
+        self.embeddings = embeddings
+        self.checkpoint = checkpoint
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.max_tries = max_tries
+        self.stats = {"documents": 0, "chunks": 0, "skipped": 0, "embedded": 0, "upserted": 0}
+
+    def chunks(self, paths):
+        """New, unique chunks as ``(digest, text)``; duplicates and checkpointed ones are skipped."""
+        seen = set()
+        for source, text in read_documents(paths):
+            self.stats["documents"] += 1
+            for chunk in self.splitter.split_text(text):
+                self.stats["chunks"] += 1
+                digest = content_hash(chunk)
+                if digest in seen or digest in self.checkpoint:
+                    self.stats["skipped"] += 1
+                    continue
+                seen.add(digest)
+                yield digest, chunk
+
+    def embed(self, batch):
+        embed_documents = backoff.on_exception(
+            backoff.expo, upstream_errors(), max_tries=self.max_tries)(self._embed_documents)
+        return batch, embed_documents([text for _, text in batch])
+
+    def _embed_documents(self, texts):
+        self.rate_limiter.wait()
+        return self.embeddings.embed_documents(texts)
+
+    def upsert(self, batch, vectors):
+        for start in range(0, len(batch), self.upsert_batch_size):
+            part = batch[start:start + self.upsert_batch_size]
+            self.index.upsert([digest for digest, _ in part],
+                              vectors[start:start + len(part)],
+                              [text for _, text in part])
+            # only checkpoint what the index has accepted
+            self.checkpoint.add([digest for digest, _ in part])
+            self.stats["upserted"] += len(part)
+
+    def run(self, paths):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = set()
+            for batch in batched(self.chunks(paths), self.embed_batch_size):
+                # bound the work queued ahead of the embedding requests
+                if len(in_flight) >= self.workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._finish(finished)
+                in_flight.add(executor.submit(self.embed, batch))
+            self._finish(wait(in_flight).done)
+
+        elapsed = time.perf_counter() - start
+        return {**self.stats,
+                "seconds": round(elapsed, 3),
+                "chunks_per_second": round(self.stats["upserted"] / elapsed, 1) if elapsed else 0.0}
+
+    def _finish(self, futures):
+        for future in futures:
+            batch, vectors = future.result()
+            self.stats["embedded"] += len(batch)
+            self.upsert(batch, vectors)
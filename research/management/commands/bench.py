@@ -0,0 +1,41 @@
+import inspect
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from research.benchmarks import BENCHMARKS
+from research.service_requests import service_request_writer
+
+
+class Command(BaseCommand):
+    help = "Run an offline benchmark of the llm-engine hot path against the fake LLM."
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", help=f"one of: {', '.join(sorted(BENCHMARKS))}")
+        parser.add_argument("--requests", type=int, default=50)
+        parser.add_argument("--concurrency", type=int, default=10)
+        parser.add_argument("--latency", type=float, default=0.5,
+                            help="seconds the fake LLM waits before answering")
+        parser.add_argument("--turns", type=int, default=4,
+                            help="requests per simulated session, for benchmarks that hold conversations")
+
+    def handle(self, *args, **options):
+        if options["name"] not in BENCHMARKS:
+            raise CommandError(f"Unknown benchmark {options['name']!r}")
+
+        bench = BENCHMARKS[options["name"]]
+        parameters = inspect.signature(bench).parameters
+        # a throwaway database for the service requests and sessions the benchmark writes
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            result = bench(**{name: options[name]
+                              for name in ("requests", "concurrency", "latency", "turns")
+                              if name in parameters})
+        finally:
+            # even when the benchmark fails: whatever is still queued would otherwise be
+            # written at exit, to the real database once the throwaway one is gone
+            service_request_writer.flush()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(json.dumps(result, indent=2))
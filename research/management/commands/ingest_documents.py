@@ -0,0 +1,57 @@
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from research.ingest import Checkpoint, Ingestor, default_checkpoint
+from research.vectorstores import load_vectorstore
+
+
+class Command(BaseCommand):
+    help = "Chunk, embed and upsert hotel documents (.txt, .md, .jsonl, ...) into the retrieval index."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="files or directories to ingest")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--chunk-overlap", type=int, default=100)
+        parser.add_argument("--embed-batch-size", type=int, default=64,
+                            help="chunks sent in one embedding request")
+        parser.add_argument("--upsert-batch-size", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=4,
+                            help="embedding requests running in parallel")
+        parser.add_argument("--requests-per-minute", type=int, default=3000)
+        parser.add_argument("--checkpoint",
+                            help="file of the chunk hashes already ingested; defaults to one kept with the index")
+        parser.add_argument("--fake-embeddings", action="store_true",
+                            help="embed with research.fakes.FakeEmbeddings, without calling OpenAI")
+
+    def handle(self, *args, **options):
+        vectorstore_settings = settings.LLM_VECTORSTORE
+        if options["fake_embeddings"]:
+            from research.fakes import FakeEmbeddings
+            embeddings = FakeEmbeddings(size=vectorstore_settings["DIMENSION"])
+        else:
+            if not settings.OPENAI_API_KEY:
+                raise CommandError("Provide OPENAI API KEY")
+            from langchain.embeddings.openai import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings(
+                model="text-embedding-ada-002", openai_api_key=settings.OPENAI_API_KEY)
+
+        try:
+            index = load_vectorstore()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        checkpoint = Checkpoint(options["checkpoint"] or default_checkpoint(vectorstore_settings))
+
+        ingestor = Ingestor(
+            index, embeddings, checkpoint,
+            chunk_size=options["chunk_size"],
+            chunk_overlap=options["chunk_overlap"],
+            embed_batch_size=options["embed_batch_size"],
+            upsert_batch_size=options["upsert_batch_size"],
+            workers=options["workers"],
+            requests_per_minute=options["requests_per_minute"])
+
+        self.stdout.write(json.dumps(ingestor.run(options["paths"]), indent=2))
@@ -0,0 +1,27 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from research.prompts import TOOL_SCHEMAS, build_tool_schemas, read_tool_schemas
+
+
+class Command(BaseCommand):
+    help = "Regenerate research/tool_schemas.json, the OpenAI tool schemas the agent loads at startup."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true",
+                            help="exit with an error if the file is out of date instead of writing it")
+
+    def handle(self, *args, **options):
+        artifact = build_tool_schemas()
+        current = read_tool_schemas()
+        if options["check"]:
+            if artifact != current:
+                raise CommandError(f"{TOOL_SCHEMAS} is out of date (version {current['version']}, "
+                                   f"expected {artifact['version']}), run `python manage.py tool_schemas`")
+            self.stdout.write(f"{TOOL_SCHEMAS} is current (version {artifact['version']})")
+            return
+
+        TOOL_SCHEMAS.write_text(json.dumps(artifact, indent=2) + "\n")
+        self.stdout.write(f"Wrote {len(artifact['tools'])} tool schemas to {TOOL_SCHEMAS} "
+                          f"(version {artifact['version']})")
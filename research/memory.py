@@ -0,0 +1,215 @@
+"""
+Token-budgeted conversation memory with a rolling summary.
+
+``TokenBudgetMemory`` hands the prompt the most recent messages that fit in
+``max_tokens``, preceded by a summary of everything older. Token counts are
+kept per message, so each turn only counts the messages it added.
+
+Messages that no longer fit stay stored until ``MemorySummarizer`` has folded
+them into the summary. The summary is written by the LLM on a background thread
+and applied on the session's next save, so the request path never waits for
+it. The summary is kept as a leading ``SystemMessage``, which lets every session
+store persist it unchanged. Configured with the ``LLM_MEMORY`` setting.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from langchain.memory import ConversationBufferMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.messages import SystemMessage, get_buffer_string
+from langchain_core.pydantic_v1 import PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Summary of the earlier conversation with the guest: "
+
+_encoding = None
+
+
+def load_tokenizer(name="cl100k_base"):
+    """Load the tiktoken encoding; it may be downloaded, so this runs at startup."""
+    global _encoding
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(name)
+    except Exception:
+        logger.warning("Tokenizer %s is unavailable, estimating token counts", name, exc_info=True)
+
+
+def count_tokens(text):
+    if _encoding is None:
+        # about four characters a token for English until the tokenizer is loaded
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+class TokenBudgetMemory(ConversationBufferMemory):
+    """``ConversationBufferMemory`` whose prompt view is the summary plus what fits in ``max_tokens``."""
+
+    max_tokens: int = 1500
+    _counts: dict = PrivateAttr(default_factory=dict)
+
+    @property
+    def summary(self):
+        messages = self.chat_memory.messages
+        return messages[0] if messages and isinstance(messages[0], SystemMessage) else None
+
+    def tokens(self, message):
+        cached = self._counts.get(id(message))
+        if cached is None or cached[0] is not message:
+            # plus the few tokens of per-message framing the chat API adds
+            cached = self._counts[id(message)] = (message, count_tokens(str(message.content)) + 4)
+        return cached[1]
+
+    def split(self):
+        """``(summary, overflow, window)``: the prompt is the summary and ``window``, ``overflow`` awaits summarizing."""
+        messages = self.chat_memory.messages
+        summary = self.summary
+        start = 1 if summary is not None else 0
+        budget = self.max_tokens - (self.tokens(summary) if summary is not None else 0)
+        cut, used = len(messages), 0
+        while cut > start:
+            cost = self.tokens(messages[cut - 1])
+            # the latest message is always kept, however long it is
+            if used + cost > budget and cut < len(messages):
+                break
+            used += cost
+            cut -= 1
+        # never open the window with an answer whose question was cut off
+        while cut < len(messages) - 1 and messages[cut].type != "human":
+            cut += 1
+        return summary, messages[start:cut], messages[cut:]
+
+    @property
+    def buffer_as_messages(self):
+        summary, _, window = self.split()
+        return ([summary] if summary is not None else []) + window
+
+    async def abuffer_as_messages(self):
+        return self.buffer_as_messages
+
+    def fold(self, summarized, text):
+        """
+        Replace the summary and the ``summarized`` messages after it with a new summary.
+
+        Returns ``False``, changing nothing, when the memory no longer starts with them.
+        """
+        messages = self.chat_memory.messages
+        start = 1 if self.summary is not None else 0
+        if messages[start:start + len(summarized)] != summarized:
+            return False
+        self.chat_memory.messages = [SystemMessage(content=SUMMARY_PREFIX + text)] + messages[start + len(summarized):]
+        self._forget(messages[:start + len(summarized)])
+        return True
+
+    def drop(self, count):
+        """Forget the ``count`` oldest unsummarized messages."""
+        start = 1 if self.summary is not None else 0
+        self._forget(self.chat_memory.messages[start:start + count])
+        del self.chat_memory.messages[start:start + count]
+
+    def _forget(self, messages):
+        for message in messages:
+            self._counts.pop(id(message), None)
+
+
+class _Job:
+    __slots__ = ("summary", "messages", "result", "done")
+
+    def __init__(self, summary, messages):
+        self.summary = summary
+        self.messages = messages
+        self.result = None
+        self.done = False
+
+
+class MemorySummarizer:
+    """
+    Folds the overflow of ``TokenBudgetMemory`` sessions into their summary in the background.
+
+    ``compact`` runs on the request path when a session is saved. It applies
+    a finished summary to the memory and queues the next one, and never calls
+    the LLM itself. At most one summary per session is in flight. Without
+    ``llm``, or while summaries keep failing, no more than ``max_pending``
+    unsummarized messages are kept.
+    """
+
+    def __init__(self, llm=None, max_pending=40, max_jobs=10000, workers=1):
+        self.llm = llm
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memory-summarizer")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.summaries = 0
+        self.folds = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def compact(self, session_id, memory):
+        summary, overflow, _ = memory.split()
+        if not overflow:
+            return
+
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if job is not None and job.done:
+                del self._jobs[session_id]
+        if job is not None and job.done and job.result is not None:
+            current = summary.content if summary is not None else ""
+            if job.summary == current and memory.fold(job.messages, job.result):
+                with self._lock:
+                    self.folds += 1
+                summary, overflow, _ = memory.split()
+            job = None
+
+        if len(overflow) > self.max_pending:
+            excess = len(overflow) - self.max_pending
+            memory.drop(excess)
+            overflow = overflow[excess:]
+            with self._lock:
+                self.dropped += excess
+
+        if overflow and job is None and self.llm is not None:
+            job = _Job(summary.content if summary is not None else "", list(overflow))
+            with self._lock:
+                self._jobs[session_id] = job
+                self._jobs.move_to_end(session_id)
+                while len(self._jobs) > self.max_jobs:
+                    self._jobs.popitem(last=False)
+            self._executor.submit(self._summarize, job)
+
+    def _summarize(self, job):
+        try:
+            previous = job.summary[len(SUMMARY_PREFIX):] if job.summary.startswith(SUMMARY_PREFIX) else job.summary
+            prompt = SUMMARY_PROMPT.format(summary=previous, new_lines=get_buffer_string(job.messages))
+            job.result = self.llm.invoke(prompt).content
+            with self._lock:
+                self.summaries += 1
+        except Exception:
+            logger.exception("Summarizing conversation memory failed")
+            with self._lock:
+                self.failures += 1
+        finally:
+            job.done = True
+
+    def stats(self):
+        with self._lock:
+            return {"pending": sum(1 for job in self._jobs.values() if not job.done),
+                    "summaries": self.summaries,
+                    "folds": self.folds,
+                    "failures": self.failures,
+                    "dropped": self.dropped}
+
+
+def memory_settings():
+    return getattr(settings, "LLM_MEMORY", {})
+
+
+def load_memory_summarizer(config=None):
+    if config is None:
+        config = memory_settings()
+    return MemorySummarizer(max_pending=config.get("MAX_PENDING_MESSAGES", 40))
@@ -1,13 +1,72 @@
 from langchain.tools import tool
+import functools
 import requests
+from .service_requests import service_request_writer, status_summary
+from .singleflight import coalesce
+from .tenancy import current_guest
+from .weather import weather_client
 from pydantic import BaseModel, Field, constr
 import datetime
+from dataclasses import dataclass, field
 from datetime import date
+from typing import Optional
 
 
 name = "Shibly"
-ROOM_NUMBER = 101
-TODAY = date.today()
+
+
+@dataclass(frozen=True)
+class ToolResult:
+    """
+    What a tool that acts for the guest returns.
+
+    The agent hands it back untouched (every tool is ``return_direct``), so the
+    view reads ``function``/``parameters`` as they are and the response is
+    serialized once. ``str()`` is the answer, which is what callbacks and the
+    conversation memory see. ``error`` is set when the tool failed, and only
+    then is it part of ``function_info``.
+    """
+    function: str
+    answer: str
+    parameters: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def __str__(self):
+        return self.answer
+
+    def function_info(self):
+        if self.error is not None:
+            return {"function-name": self.function, "parameters": self.parameters, "error": self.error}
+        return {"function-name": self.function, "parameters": self.parameters}
+
+
+class ToolResults(list):
+    """
+    The results of the tools the model called together in one turn.
+
+    When every tool called is ``return_direct`` the agent answers with all of
+    them at once. ``str()`` is their answers, one per line.
+    """
+
+    def __str__(self):
+        return "\n".join(str(result) for result in self)
+
+
+def records_request(func):
+    """
+    Record what a tool acting for the guest returns in the service request ledger, and number it.
+
+    Refused without a room number: the ledger is read back by room.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        guest = current_guest()
+        guest.require_room()
+        return service_request_writer.record_result(func(*args, **kwargs), guest)
+
+    return wrapper
+
 
 class OpenMeteoInput(BaseModel):
     latitude: float = Field(...,
@@ -17,36 +76,12 @@ class OpenMeteoInput(BaseModel):
 
 
 @tool(args_schema=OpenMeteoInput, return_direct=True)
-def get_current_temperature(latitude: float, longitude: float) -> dict:
+@coalesce
+def get_current_temperature(latitude: float, longitude: float) -> str:
     """Fetch current Weather for given cities or coordinates. For example: what is the weather of Colombo ?"""
 
-    BASE_URL = "https://api.open-meteo.com/v1/forecast"
-
-    # Parameters for the request
-    params = {
-        'latitude': latitude,
-        'longitude': longitude,
-        'hourly': 'temperature_2m',
-        'forecast_days': 1,
-    }
-
-    # Make the request
-    response = requests.get(BASE_URL, params=params)
-
-    if response.status_code == 200:
-        results = response.json()
-    else:
-        raise Exception(
-            f"API Request failed with status code: {response.status_code}")
-
-    current_utc_time = datetime.datetime.utcnow()
-    time_list = [datetime.datetime.fromisoformat(time_str.replace(
-        'Z', '+00:00')) for time_str in results['hourly']['time']]
-    temperature_list = results['hourly']['temperature_2m']
-
-    closest_time_index = min(range(len(time_list)), key=lambda i: abs(
-        time_list[i] - current_utc_time))
-    current_temperature = temperature_list[closest_time_index]
+    # pooled session, timeouts, retries and an hourly per-location cache live in weather.py
+    current_temperature = weather_client.current_temperature(latitude, longitude)
 
     return f'The current temperature is {current_temperature}Â°C'
 
@@ -66,7 +101,8 @@ class book_room_input(BaseModel):
 
 
 @tool(args_schema=book_room_input, return_direct=True)
-def book_room(room_type: str, class_type: str, check_in_date: date, check_out_date: date, mobile_no: constr) -> str:
+@records_request
+def book_room(room_type: str, class_type: str, check_in_date: date, check_out_date: date, mobile_no: str) -> ToolResult:
     """
       Book a room with the specified details.
 
@@ -82,43 +118,39 @@ def book_room(room_type: str, class_type: str, check_in_date: date, check_out_da
       """
     # Placeholder logic for booking the room
     # return f"Room has been booked for {room_type} {class_type} class from {check_in_date} to {check_out_date}. Mobile number: {mobile_no}."
-    return f'''{{
-                  "function-name": "book_room",
-                  "answer" : "Room has been booked for {room_type} {class_type} class
-                  "parameters": {{
-                      "room_type": "{room_type}",
-                      "class_type": "{class_type}",
-                      "check_in_date": "{check_in_date}",
-                      "check_out_date": "{check_out_date}",
-                      "mobile_no": "{mobile_no}"
-                  }}
-              }}'''
+    return ToolResult(
+        "book_room",
+        f"Room has been booked for {room_type} {class_type} class from {check_in_date} to {check_out_date}.",
+        {"room_type": room_type,
+         "class_type": class_type,
+         "check_in_date": check_in_date,
+         "check_out_date": check_out_date,
+         "mobile_no": mobile_no})
 
 class HousekeepingServiceEntity(BaseModel):
     reason: str = Field(..., description="The reason for housekeeping service is requested for")
 
 
 @tool(args_schema = HousekeepingServiceEntity, return_direct=True)
-def housekeeping_service_request(reason:str) -> str:
+@records_request
+def housekeeping_service_request(reason:str) -> ToolResult:
     """
     Provides housekeeping service to the hotel room like cleaning.
     """
 
-    return f'''{{
-                  "function-name": "housekeeping_service_request",
-                  "answer" : "Housekeeping service has been requested for {reason}",
-                  "parameters": {{
-                      "room_number": "{ROOM_NUMBER}",
-                      "reason" : "{reason}"
-                  }}
-              }}'''
+    return ToolResult(
+        "housekeeping_service_request",
+        f"Housekeeping service has been requested for {reason}",
+        {"room_number": current_guest().room_number,
+         "reason": reason})
 
 class RoomRecommendation(BaseModel):
     budget_highest: int = Field(..., description="Maximum amount  customer can pay per day for a room.")
 
 
 @tool(args_schema=RoomRecommendation, return_direct=True)
-def room_recommendation(budget_highest: int) -> str:
+@coalesce
+def room_recommendation(budget_highest: int) -> ToolResult:
     """
     Recommend a room for a customer based on his budget which he can pay per day for a room. For example, I want a room that costs less than 1000 per day. 
     Args:
@@ -127,13 +159,10 @@ def room_recommendation(budget_highest: int) -> str:
       str: A message with room suggestions according to budget.
     """
 
-    return f'''{{
-                  "function-name": "room_recommendation",
-                  "answer" : "I recommend you to book a room with a budget of {budget_highest}",
-                  "parameters": {{
-                      "budget_highest": "{budget_highest}"
-                  }}
-              }}'''
+    return ToolResult(
+        "room_recommendation",
+        f"I recommend you to book a room with a budget of {budget_highest}",
+        {"budget_highest": budget_highest})
 
 
 class requestFoodFromRestaurant(BaseModel):
@@ -143,7 +172,8 @@ class requestFoodFromRestaurant(BaseModel):
 
 
 @tool(args_schema=requestFoodFromRestaurant, return_direct=True)
-def order_resturant_item(item_name: str, item_quantity:int,  dine_in_type: str) -> str:
+@records_request
+def order_resturant_item(item_name: str, item_quantity:int,  dine_in_type: str) -> ToolResult:
     """
     Place order to the restaurant for food items with specified details. For example, I want to order a pizza from the restaurant.
 
@@ -163,16 +193,13 @@ def order_resturant_item(item_name: str, item_quantity:int,  dine_in_type: str)
     # else:
     #     return f"Your order have been placed. The parcel will be ready in 45 minutes."
 
-    return f'''{{
-                  "function-name": "order_resturant_item",
-                  "answer" : "Your order have been placed for {item_name} with quantity {item_quantity}.",
-                  "parameters": {{
-                      "item_name": "{item_name}",
-                      "item_quantity" : "{item_quantity}",
-                      "room_number": "{ROOM_NUMBER}",
-                      "dine_in_type": "{dine_in_type}"
-                  }}
-              }}'''
+    return ToolResult(
+        "order_resturant_item",
+        f"Your order have been placed for {item_name} with quantity {item_quantity}.",
+        {"item_name": item_name,
+         "item_quantity": item_quantity,
+         "room_number": current_guest().room_number,
+         "dine_in_type": dine_in_type})
 
 
 class requestBillingChangeRequest(BaseModel):
@@ -180,7 +207,8 @@ class requestBillingChangeRequest(BaseModel):
 
 
 @tool(args_schema=requestBillingChangeRequest, return_direct=True)
-def bill_complain_request(complaint: str, room_number=ROOM_NUMBER) -> str:
+@records_request
+def bill_complain_request(complaint: str, room_number=None) -> ToolResult:
     """
     Complaints about billing with specified details.
     Args:
@@ -190,20 +218,18 @@ def bill_complain_request(complaint: str, room_number=ROOM_NUMBER) -> str:
     """
 
     # return f"We  have received your complain {complaint}  and notified accounts department to handle the issue. Please keep your patience while we resolve. You will be notified from the front-desk once it is resolved"
-    return f'''{{
-                  "function-name": "bill_complain_request",
-                  "answer" : "We  have received your complain {complaint}  and notified accounts department to handle the issue. Please keep your patience while we resolve. You will be notified from the front-desk once it is resolved",
-                  "parameters": {{
-                      "complaint": "{complaint}",
-                      "room_number": "{room_number}"
-                  }}
-              }}'''
+    return ToolResult(
+        "bill_complain_request",
+        f"We  have received your complain {complaint}  and notified accounts department to handle the issue. Please keep your patience while we resolve. You will be notified from the front-desk once it is resolved",
+        {"complaint": complaint,
+         "room_number": room_number if room_number is not None else current_guest().room_number})
 
 class TransportationRecommendationEntity(BaseModel):
     location: str = Field(..., description="The place customer wants to go visit")
 
 @tool(args_schema=TransportationRecommendationEntity, return_direct=True)
-def transportation_recommendation(location: str) -> str:
+@coalesce
+def transportation_recommendation(location: str) -> ToolResult:
     """
     Recommends transportation with specified details
     Args:
@@ -215,13 +241,10 @@ def transportation_recommendation(location: str) -> str:
     # transport = "Private Car"
 
     # return f"I recommend to go there by {transport}"
-    return f'''{{
-                  "function-name": "transportation_recommendation",
-                  "answer" : "Recommendation for transportation to {location} is processing",
-                  "parameters": {{
-                      "location": "{location}"
-                  }}
-              }}'''
+    return ToolResult(
+        "transportation_recommendation",
+        f"Recommendation for transportation to {location} is processing",
+        {"location": location})
 
 class RecommendationExcursion(BaseModel):
     place_type: str = Field(
@@ -229,7 +252,8 @@ class RecommendationExcursion(BaseModel):
 
 
 @tool(args_schema=RecommendationExcursion, return_direct=True)
-def excursion_recommendation(place_type: str) -> str:
+@coalesce
+def excursion_recommendation(place_type: str) -> ToolResult:
     """
     Suggest nice places to visit nearby with specified details
     Args:
@@ -238,15 +262,10 @@ def excursion_recommendation(place_type: str) -> str:
       str: A message with excursion recommendation.
     """
 
-    return f'''
-            {{
-                "function-name": "excursion_recommendation",
-                "answer" : "Recommendation for {place_type} is processing",
-                "parameters": {{
-                    "place_type": "{place_type}"
-                }}
-            }}
-            '''
+    return ToolResult(
+        "excursion_recommendation",
+        f"Recommendation for {place_type} is processing",
+        {"place_type": place_type})
 
 
 
@@ -255,7 +274,8 @@ class RoomAmenitiesRequest(BaseModel):
 
 
 @tool(args_schema=RoomAmenitiesRequest, return_direct=True)
-def request_room_amenity(requested_amenity: str):
+@records_request
+def request_room_amenity(requested_amenity: str) -> ToolResult:
     """
     Request for room amenities like towel, pillow, blanket etc. Order for room amenities like towel, pillow, blanket etc.
 
@@ -265,20 +285,19 @@ def request_room_amenity(requested_amenity: str):
       str: An acknowdelgement that ensures that someone is sent to the room for fixing.
     """
 
-    return f'''{{
-                    "function-name": "request_room_amenity",
-                    "answer" : "Request for {requested_amenity} is processing",
-                    "parameters": {{
-                        "requested_amenity": "{requested_amenity}",
-                        "room_number": "{ROOM_NUMBER}"}}
-              }}'''
+    return ToolResult(
+        "request_room_amenity",
+        f"Request for {requested_amenity} is processing",
+        {"requested_amenity": requested_amenity,
+         "room_number": current_guest().room_number})
 
 class RoomMaintenanceRequestInput(BaseModel):
     issue: str = Field(..., description="The issue for which it needs maintenance service")
 
 
 @tool(args_schema=RoomMaintenanceRequestInput, return_direct=True)
-def request_room_maintenance(issue: str):
+@records_request
+def request_room_maintenance(issue: str) -> ToolResult:
     """
     Resolves room issues regarding hardware like toilteries, furnitures, windows or electric gadgets like FAN, TC, AC etc of hotel room.
 
@@ -288,14 +307,11 @@ def request_room_maintenance(issue: str):
       str: An acknowdelgement that ensures that someone is sent to the room for fixing.
     """
 
-    return f'''{{
-                  "function-name": "request_room_maintenance",
-                  "answer" : "Request for {issue} is processing",
-                  "parameters": {{
-                      "issue": "{issue}",
-                      "room_number": "{ROOM_NUMBER}"
-                  }}
-              }}'''
+    return ToolResult(
+        "request_room_maintenance",
+        f"Request for {issue} is processing",
+        {"issue": issue,
+         "room_number": current_guest().room_number})
 
 
 class ReminderEntity(BaseModel):
@@ -306,7 +322,8 @@ class ReminderEntity(BaseModel):
 
 
 @tool(args_schema=ReminderEntity, return_direct=True)
-def request_reminder(reminder_message: str, reminder_date:str, reminder_time: str):
+@records_request
+def request_reminder(reminder_message: str, reminder_date:str, reminder_time: str) -> ToolResult:
     """
     Set an alarm or reminder alarm or reminder call for the customer to remind about the message at the mentioned time.
     For ex,
@@ -320,16 +337,13 @@ def request_reminder(reminder_message: str, reminder_date:str, reminder_time: st
       str: An acknowdelgement message for the customer.
     """
 
-    return f'''{{
-                  "function-name": "request_reminder",
-                  "answer" : "Reminder for {reminder_message} is set for {reminder_date} at {reminder_time}",
-                  "parameters": {{
-                        "reminder_date" : "{reminder_date}",
-                        "reminder_time": "{reminder_time}",
-                        "reminder_message": "{reminder_message}",
-                        "room_number": "{ROOM_NUMBER}"
-                  }}
-              }}'''
+    return ToolResult(
+        "request_reminder",
+        f"Reminder for {reminder_message} is set for {reminder_date} at {reminder_time}",
+        {"reminder_date": reminder_date,
+         "reminder_time": reminder_time,
+         "reminder_message": reminder_message,
+         "room_number": current_guest().room_number})
 
 
 class ShuttleServiceEntity(BaseModel):
@@ -340,7 +354,8 @@ class ShuttleServiceEntity(BaseModel):
 
 
 @tool(args_schema=ShuttleServiceEntity, return_direct=True)
-def shuttle_service_request(location: str, time: str) -> str:
+@records_request
+def shuttle_service_request(location: str, time: str) -> ToolResult:
     """
     Books a shuttle service that picks up or drops off customer.
 
@@ -352,18 +367,45 @@ def shuttle_service_request(location: str, time: str) -> str:
 
     """
 
-    return f'''{{
-                    "function-name": "shuttle_service_request",
-                    "answer" : "Shuttle service has been requested for {location} at {time}",
-                    "parameters": {{
-                        "location": "{location}",
-                        "time": "{time}"
-                    }}
-                }}'''
+    return ToolResult(
+        "shuttle_service_request",
+        f"Shuttle service has been requested for {location} at {time}",
+        {"location": location,
+         "time": time})
 
 
 class ServiceStatusCheckerEntity(BaseModel):
-    service_id : id = Field(..., description="The name of the service to check the status of")
+    service_id: Optional[int] = Field(None, description="The number of the service request to check the status of. Leave it out to check all recent requests of the customer")
+
+
+@tool(args_schema=ServiceStatusCheckerEntity, return_direct=True)
+def service_status_checker(service_id: Optional[int] = None) -> ToolResult:
+    """
+    Check the status of a service request the customer made before, like a food order, room maintenance, housekeeping or a reminder. For example, what is the status of my request 1042?
+
+    Args:
+      service_id (int) : The number of the service request. Optional, leave it out when the customer does not give one.
+    Returns
+      str: The status of the request, or of the customer's recent requests.
+    """
+
+    guest = current_guest()
+    # without a room every room-less guest of the hotel would read each other's requests
+    guest.require_room()
+    if service_id is not None:
+        row = service_request_writer.get(service_id, guest)
+        rows = [row] if row is not None else []
+        answer = status_summary(row, guest) if row is not None else f"There is no request #{service_id} for your room."
+    else:
+        rows = service_request_writer.recent(guest)
+        answer = "\n".join(status_summary(row, guest) for row in rows) or "You have not made any requests yet."
+
+    return ToolResult(
+        "service_status_checker",
+        answer,
+        {"service_id": service_id,
+         "room_number": guest.room_number,
+         "requests": [{"id": row["id"], "service": row["service"], "status": row["status"]} for row in rows]})
 
 
 tools = [get_current_temperature,
@@ -376,5 +418,16 @@ tools = [get_current_temperature,
          excursion_recommendation,
          request_room_amenity,
          request_room_maintenance,
-         request_reminder
-         ] # Add extra function names here...
\ No newline at end of file
+         request_reminder,
+         service_status_checker
+         ] # Add extra function names here...
+
+# Tools that only look something up and change nothing for the guest. Their
+# answers may be cached and shared, and they are wrapped in @coalesce;
+# every other tool records a request (@records_request), except
+# service_status_checker, whose answers change as the front desk works.
+stateless_tools = [get_current_temperature,
+                   room_recommendation,
+                   transportation_recommendation,
+                   excursion_recommendation
+                   ]
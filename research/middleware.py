@@ -0,0 +1,76 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .tracing import Trace, current_trace, finish_trace, tracing_settings
+
+
+class TracingMiddleware:
+    """
+    Opens a ``research.tracing.Trace`` around every request to the research app.
+
+    Adds a ``Server-Timing`` header with the phase breakdown. Streaming responses
+    are finished when their last chunk has been sent, so their spans include the
+    agent run.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = tracing_settings()
+        self.enabled = config.get("ENABLED", True)
+        self.prefix = config.get("PATH_PREFIX", "/research/")
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self._traced(request):
+            return self.get_response(request)
+        trace = Trace(request.path)
+        token = current_trace.set(trace)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_trace.reset(token)
+        return self._finish(request, response, trace)
+
+    async def __acall__(self, request):
+        if not self._traced(request):
+            return await self.get_response(request)
+        trace = Trace(request.path)
+        token = current_trace.set(trace)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_trace.reset(token)
+        return self._finish(request, response, trace)
+
+    def _traced(self, request):
+        return self.enabled and request.path.startswith(self.prefix)
+
+    def _finish(self, request, response, trace):
+        match = getattr(request, "resolver_match", None)
+        view = match.route if match is not None else None
+        if not response.streaming:
+            response["Server-Timing"] = trace.server_timing()
+            finish_trace(trace, response.status_code, view)
+            return response
+
+        content = response.streaming_content
+        if response.is_async:
+            async def traced_content():
+                try:
+                    async for chunk in content:
+                        yield chunk
+                finally:
+                    finish_trace(trace, response.status_code, view)
+        else:
+            def traced_content():
+                try:
+                    yield from content
+                finally:
+                    finish_trace(trace, response.status_code, view)
+        response.streaming_content = traced_content()
+        return response
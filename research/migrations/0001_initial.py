@@ -0,0 +1,22 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatSession',
+            fields=[
+                ('session_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('messages', models.BinaryField()),
+                ('updated_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-18 11:06
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceRequestSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ServiceRequest',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('service', models.CharField(max_length=64)),
+                ('room_number', models.IntegerField(blank=True, null=True)),
+                ('details', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('in_progress', 'In progress'), ('done', 'Done'), ('cancelled', 'Cancelled')], default='open', max_length=16)),
+                ('created_at', models.DateTimeField(db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room_number', 'created_at'], name='service_request_room'), models.Index(fields=['status', 'id'], name='service_request_status')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.11 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('research', '0002_service_requests'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='servicerequest',
+            name='service_request_room',
+        ),
+        migrations.RemoveIndex(
+            model_name='servicerequest',
+            name='service_request_status',
+        ),
+        migrations.AddField(
+            model_name='servicerequest',
+            name='hotel',
+            field=models.CharField(default='default', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['hotel', 'room_number', 'created_at'], name='service_request_hotel_room'),
+        ),
+        migrations.AddIndex(
+            model_name='servicerequest',
+            index=models.Index(fields=['hotel', 'status', 'id'], name='service_request_hotel_status'),
+        ),
+    ]
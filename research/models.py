@@ -1,3 +1,43 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 # Create your models here.
+
+
+class ChatSession(models.Model):
+    """Conversation memory of one chat session, used by ``DatabaseSessionStore``."""
+    session_id = models.CharField(max_length=255, primary_key=True)
+    messages = models.BinaryField()  # zlib-compressed JSON, see research.sessions.dump_messages
+    updated_at = models.DateTimeField(db_index=True)
+
+
+class ServiceRequest(models.Model):
+    """Something a guest asked the hotel for through one of the tools, see research/service_requests.py."""
+    OPEN = "open"
+    IN_PROGRESS = "in_progress"
+    DONE = "done"
+    CANCELLED = "cancelled"
+    STATUSES = [(OPEN, "Open"), (IN_PROGRESS, "In progress"), (DONE, "Done"), (CANCELLED, "Cancelled")]
+
+    # numbered by the worker before the row is written, see ServiceRequestSequence
+    id = models.BigIntegerField(primary_key=True)
+    hotel = models.CharField(max_length=64, default="default")
+    service = models.CharField(max_length=64)
+    room_number = models.IntegerField(null=True, blank=True)
+    details = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=16, choices=STATUSES, default=OPEN)
+    created_at = models.DateTimeField(db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # a guest's requests, newest first
+            models.Index(fields=["hotel", "room_number", "created_at"], name="service_request_hotel_room"),
+            # a hotel's front desk queue, paged by number
+            models.Index(fields=["hotel", "status", "id"], name="service_request_hotel_status"),
+        ]
+
+
+class ServiceRequestSequence(models.Model):
+    """The last service request number handed out; each worker reserves a block of numbers at a time."""
+    value = models.BigIntegerField(default=0)
@@ -0,0 +1,144 @@
+"""
+The agent's prompt and OpenAI tool schemas, prepared ahead of the request path.
+
+The tool schemas are generated from the tools' pydantic models by
+``python manage.py tool_schemas`` and kept in ``tool_schemas.json``, versioned
+by a hash of their content. Startup reads that file instead of introspecting
+the models; each entry carries a fingerprint of its tool, and a tool that
+changed since is converted again, with a warning to regenerate the file.
+
+``AgentPrompt`` puts each step's messages together directly: the instruction
+is a prebuilt message, and the scratchpad of a run is formatted one step at a
+time instead of from scratch on every step.
+"""
+import functools
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import orjson
+from langchain.agents.output_parsers.openai_tools import OpenAIToolAgentAction
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.pydantic_v1 import PrivateAttr
+from langchain_core.runnables import RunnableSerializable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .methods import tools
+from .retrieval import context_messages
+from .tenancy import current_guest
+
+logger = logging.getLogger(__name__)
+
+TOOL_SCHEMAS = Path(__file__).resolve().parent / "tool_schemas.json"
+
+INSTRUCTIONS = SystemMessage(
+    content="only call the function(s) if all the parameters are procided from the users request, else start "
+            "follow-up questions to clarify missing parameters. Never guess any parameters. ")
+
+
+def tool_fingerprint(tool):
+    """Hash of what a tool's schema is generated from, read off the model without building the schema."""
+    fields = tool.args_schema.__fields__ if tool.args_schema is not None else {}
+    parts = [tool.name, tool.description]
+    parts += [f"{name}:{field.outer_type_}:{field.required}:{field.field_info.description}"
+              for name, field in fields.items()]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+
+def build_tool_schemas(tools=tools):
+    """The artifact written to ``tool_schemas.json``."""
+    entries = [{"fingerprint": tool_fingerprint(tool), "schema": convert_to_openai_tool(tool)} for tool in tools]
+    version = hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()[:12]
+    return {"version": version, "tools": entries}
+
+
+def read_tool_schemas(path=TOOL_SCHEMAS):
+    try:
+        return orjson.loads(Path(path).read_bytes())
+    except FileNotFoundError:
+        return {"version": None, "tools": []}
+
+
+def load_tool_schemas(tools=tools, path=TOOL_SCHEMAS):
+    """OpenAI tool schemas for ``tools``, from the artifact wherever it is current."""
+    stored = {entry["schema"]["function"]["name"]: entry for entry in read_tool_schemas(path)["tools"]}
+    schemas, stale = [], []
+    for tool in tools:
+        entry = stored.get(tool.name)
+        if entry is not None and entry["fingerprint"] == tool_fingerprint(tool):
+            schemas.append(entry["schema"])
+        else:
+            stale.append(tool.name)
+            schemas.append(convert_to_openai_tool(tool))
+    if stale:
+        logger.warning("Tool schemas for %s are missing or out of date in %s, "
+                       "regenerate them with `python manage.py tool_schemas`", ", ".join(stale), path)
+    return schemas
+
+
+@functools.lru_cache(maxsize=1024)
+def hotel_message(hotel_name, today):
+    """Where and when the guest is asking, so the model can place "tonight" or "tomorrow"."""
+    return SystemMessage(content=f"You are the assistant of {hotel_name}. Today is {today:%A, %d %B %Y}.")
+
+
+def step_messages(action, observation):
+    """``(model_messages, tool_message)`` of one step of the scratchpad."""
+    if not isinstance(action, OpenAIToolAgentAction):
+        return [], AIMessage(content=action.log)
+    return action.message_log, ToolMessage(tool_call_id=action.tool_call_id, content=str(observation),
+                                           additional_kwargs={"name": action.tool})
+
+
+class AgentPrompt(RunnableSerializable):
+    """
+    The agent's prompt: history, retrieved context, instruction, hotel and date, question and scratchpad.
+
+    Takes the executor's inputs and returns the message list for the model.
+    ``AgentExecutor`` hands every step of a run the same, growing
+    ``intermediate_steps`` list, so the scratchpad messages formatted for it
+    are kept and only the steps added since are formatted.
+    """
+
+    max_runs: int = 256
+    _scratchpads: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def invoke(self, input, config=None):
+        return self._call_with_config(self.messages, input, config, run_type="prompt")
+
+    def messages(self, inputs):
+        guest = current_guest()
+        return [*inputs["chat_history"],
+                # retrieved hotel knowledge, joined as late as possible so the lookup overlaps the turn
+                *context_messages(inputs.get("context")),
+                INSTRUCTIONS,
+                hotel_message(guest.hotel.name, guest.today()),
+                HumanMessage(content=inputs["question"]),
+                *self.scratchpad(inputs.get("intermediate_steps") or [])]
+
+    def scratchpad(self, steps):
+        if not steps:
+            return []
+        key = id(steps)
+        with self._lock:
+            cached = self._scratchpads.pop(key, None)
+        if cached is None or cached[0] is not steps or cached[1] > len(steps):
+            cached = (steps, 0, [], [])
+        _, done, messages, model_messages = cached
+        for action, observation in steps[done:]:
+            requests, result = step_messages(action, observation)
+            for message in requests:
+                # parallel tool calls each carry the model message that made them
+                if message not in model_messages:
+                    model_messages.append(message)
+                    messages.append(message)
+            messages.append(result)
+        with self._lock:
+            self._scratchpads[key] = (steps, len(steps), messages, model_messages)
+            while len(self._scratchpads) > self.max_runs:
+                self._scratchpads.popitem(last=False)
+        return list(messages)
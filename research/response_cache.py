@@ -0,0 +1,163 @@
+"""
+Two-tier cache of llm-engine answers for repeated guest questions.
+
+Answers are keyed on the normalised question plus the conversation context
+(hotel, room and last exchange). The exact tier is a dict lookup. The semantic tier
+embeds the question and reuses the answer of the most similar cached
+question in the same context once the cosine similarity clears
+``similarity_threshold``.
+
+Configured with the ``LLM_RESPONSE_CACHE`` setting; ``embedder`` is any LangChain
+``Embeddings`` (``views.llm_startup`` plugs in its ``OpenAIEmbeddings``).
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from .methods import stateless_tools
+
+STATELESS_TOOL_NAMES = {tool.name for tool in stateless_tools}
+
+
+def normalize_query(text):
+    text = re.sub(r"[^\w\s]", " ", str(text or "").lower())
+    return " ".join(text.split())
+
+
+def conversation_context(guest, messages):
+    """The part of a session an answer may depend on: the hotel, the room and the last exchange."""
+    return "\x1f".join([guest.key] + [normalize_query(message.content) for message in messages[-2:]])
+
+
+def is_cacheable(response_data):
+    """Plain answers and stateless lookups that worked may be shared, turns that book or order anything may not."""
+    if not response_data.get("success"):
+        return False
+    functions = response_data.get("functions") or []
+    return all(function_info.get("function-name") in STATELESS_TOOL_NAMES and "error" not in function_info
+               for function_info in functions)
+
+
+class _CacheEntry:
+    __slots__ = ("response", "vector", "expires")
+
+    def __init__(self, response, vector, expires):
+        self.response = response
+        self.vector = vector
+        self.expires = expires
+
+
+class ResponseCache:
+
+    def __init__(self, enabled=True, max_entries=2048, ttl=10 * 60, similarity_threshold=0.97, embedder=None):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder
+        self._entries = OrderedDict()
+        self._matrices = {}
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, query, context):
+        """
+        Return ``(response, vector)``.
+
+        ``response`` is the cached value or ``None``; ``vector`` is the
+        question's embedding when one was computed, to be handed to ``put``.
+        """
+        response = self.get_exact(query, context)
+        if response is not None:
+            return response, None
+        return self.get_similar(query, context)
+
+    def get_exact(self, query, context):
+        if not self.enabled:
+            return None
+
+        key = (context, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry.response
+        return None
+
+    def get_similar(self, query, context):
+        """The semantic tier of ``get``; call it after an exact miss."""
+        if not self.enabled:
+            return None, None
+
+        if self.embedder is None:
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        # embedding is a network call for OpenAIEmbeddings, keep it outside the lock
+        vector = self._normalize(self.embedder.embed_query(normalize_query(query)))
+        now = time.monotonic()
+        with self._lock:
+            keys, matrix = self._matrix(context)
+            if keys:
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                entry = self._entries.get(keys[best])
+                if scores[best] >= self.similarity_threshold and entry is not None and entry.expires > now:
+                    self._entries.move_to_end(keys[best])
+                    self.semantic_hits += 1
+                    return entry.response, vector
+            self.misses += 1
+        return None, vector
+
+    def put(self, query, context, response, vector=None):
+        """Cache ``response``; callers check ``is_cacheable`` first."""
+        if not self.enabled:
+            return
+
+        key = (context, normalize_query(query))
+        with self._lock:
+            self._entries[key] = _CacheEntry(response, vector, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            self._matrices.pop(context, None)
+            while len(self._entries) > self.max_entries:
+                (evicted_context, _), _ = self._entries.popitem(last=False)
+                self._matrices.pop(evicted_context, None)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "exact_hits": self.exact_hits,
+                    "semantic_hits": self.semantic_hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _matrix(self, context):
+        # stacked unit vectors of one context, rebuilt only after that context changes
+        if context not in self._matrices:
+            keys = [key for key, entry in self._entries.items()
+                    if key[0] == context and entry.vector is not None]
+            matrix = np.stack([self._entries[key].vector for key in keys]) if keys else None
+            self._matrices[context] = (keys, matrix)
+        return self._matrices[context]
+
+
+def load_response_cache(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_RESPONSE_CACHE", {})
+    return ResponseCache(**{key.lower(): value for key, value in config.items()})
@@ -0,0 +1,161 @@
+"""
+Retrieval stage of the agent: hotel knowledge from the vector index is looked
+up for each question and handed to the prompt as a system message.
+
+Configured with the ``LLM_RETRIEVAL`` setting and built in ``views.llm_startup``.
+"""
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import SystemMessage
+
+from .response_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Wrap an ``Embeddings`` model with an LRU cache of query vectors.
+
+    Cache misses from every thread are queued and sent to the wrapped model's
+    ``embed_documents`` in batches of up to ``batch_size``, waiting at most
+    ``batch_wait`` seconds for a batch to fill. A text already being embedded
+    is not sent twice; later callers wait for the first one's result.
+    """
+
+    def __init__(self, embeddings, cache_size=4096, batch_size=64, batch_wait=0.005):
+        self.embeddings = embeddings
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts):
+        found, futures = {}, {}
+        with self._lock:
+            for text in texts:
+                if text in self._cache:
+                    self._cache.move_to_end(text)
+                    found[text] = self._cache[text]
+                    self.hits += 1
+                elif text not in futures:
+                    if text not in self._pending:
+                        self._pending[text] = Future()
+                        self._queue.put(text)
+                        self.misses += 1
+                    futures[text] = self._pending[text]
+            if futures and (self._worker is None or not self._worker.is_alive()):
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+        for text, future in futures.items():
+            found[text] = future.result()
+        return [found[text] for text in texts]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "batches": self.batches,
+                    "cached": len(self._cache)}
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                vectors, error = self.embeddings.embed_documents(batch), None
+            except Exception as e:
+                vectors, error = None, e
+
+            with self._lock:
+                self.batches += 1
+                futures = [self._pending.pop(text) for text in batch]
+                if error is None:
+                    for text, vector in zip(batch, vectors):
+                        self._cache[text] = vector
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+            for i, future in enumerate(futures):
+                if error is None:
+                    future.set_result(vectors[i])
+                else:
+                    future.set_exception(error)
+
+
+class PendingRetrieval:
+    """A retrieval running in the background; ``passages()`` waits for it."""
+
+    def __init__(self, future, timeout):
+        self.future = future
+        self.timeout = timeout
+
+    def passages(self):
+        try:
+            return self.future.result(timeout=self.timeout)
+        except Exception:
+            # retrieval only adds context, a slow or failing index must not fail the turn
+            logger.warning("Retrieval failed or timed out, answering without context", exc_info=True)
+            return []
+
+    def cancel(self):
+        self.future.cancel()
+
+
+class Retriever:
+    """Top-k passages from ``index`` for a question embedded with ``embeddings``."""
+
+    def __init__(self, embeddings, index, top_k=3, min_score=0.0, timeout=2.0, max_workers=8):
+        self.embeddings = embeddings
+        self.index = index
+        self.top_k = top_k
+        self.min_score = min_score
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+
+    def search(self, question):
+        # same normalisation as the response cache, so both share one cached embedding
+        vector = self.embeddings.embed_query(normalize_query(question))
+        return [text for text, score in self.index.query(vector, self.top_k)
+                if score >= self.min_score]
+
+    def prefetch(self, question):
+        """Start ``search`` in the background so it overlaps with the rest of the turn."""
+        return PendingRetrieval(self._executor.submit(self.search, question), self.timeout)
+
+
+def context_messages(context):
+    """Prompt messages for retrieved passages, given as a list or a ``PendingRetrieval``."""
+    if isinstance(context, PendingRetrieval):
+        context = context.passages()
+    if not context:
+        return []
+    return [SystemMessage(content="Hotel information that may help to answer the guest:\n"
+                                  + "\n".join(f"- {passage}" for passage in context))]
@@ -0,0 +1,225 @@
+"""
+Deterministic fast path in front of the agent for unambiguous service requests.
+
+"send a towel", "the AC is broken" or "please clean my room" map straight onto
+``request_room_amenity``, ``request_room_maintenance`` and
+``housekeeping_service_request``. ``IntentRouter`` recognises them with
+compiled patterns and runs the tool itself, so the turn answers in
+milliseconds instead of after an OpenAI function-calling round trip.
+
+The router only answers when exactly one intent with exactly one slot value
+matches, and the request is the whole message, give or take a "please" or a
+"thanks". Questions, negations, long messages, several intents or items,
+requests with more to them ("get me a new room, the AC is broken", "send a
+towel to room 305", "clean my room tomorrow at 10am") and replies to a
+question the agent just asked all fall back to the agent.
+Configured with the ``LLM_INTENT_ROUTER`` setting.
+"""
+import re
+import threading
+from typing import NamedTuple
+
+from django.conf import settings
+
+from .methods import tools
+from .tenancy import current_guest
+
+AMENITIES = {
+    "towel": r"(?:bath |hand |face )?towels?",
+    "pillow": r"pillows?",
+    "blanket": r"blankets?|duvets?|quilts?",
+    "bed sheet": r"bed ?sheets?|sheets?",
+    "soap": r"soaps?",
+    "shampoo": r"shampoos?",
+    "toothbrush": r"tooth ?brush(?:es)?",
+    "toothpaste": r"tooth ?paste",
+    "toilet paper": r"toilet (?:paper|rolls?)|tissues?",
+    "slippers": r"slippers?",
+    "bathrobe": r"bath ?robes?|robes?",
+    "hanger": r"(?:clothes )?hangers?",
+    "water bottle": r"water bottles?|bottles? of water|drinking water",
+    "iron": r"iron(?: and ironing board)?|ironing board",
+    "hair dryer": r"hair ?dryers?|hair ?driers?",
+}
+
+# not "have" or "get": "I have a towel" and "I got the towels" are not requests
+REQUEST_VERBS = (r"send|bring|need|want|give|deliver|provide|"
+                 r"more|extra|another|additional|fresh|new|spare")
+
+DEVICES = (r"a/?c|air ?con(?:ditioner|ditioning)?|fan|tv|television|lights?|lamp|bulb|toilet|flush|"
+           r"shower|tap|faucet|sink|drain|window|door|lock|heater|geyser|fridge|refrigerator|minibar|"
+           r"wi-?fi|internet|remote|kettle|socket|outlet|safe|elevator|lift")
+
+PROBLEMS = (r"broken|not working|isn'?t working|is not working|doesn'?t work|does not work|"
+            r"won'?t (?:turn on|work|open|close|lock|flush|drain)|stopped working|not turning on|"
+            r"leak(?:s|ing)?|clogged|blocked|stuck|jammed|out of order|dripping|flickering|"
+            r"making (?:a )?(?:strange |weird |loud )?noises?|noisy|dead|tripped")
+
+HOUSEKEEPING = [
+    ("room cleaning", r"(?:clean|tidy|vacuum|make up)(?: up)? (?:my |the |our |this )?(?:room|suite|bathroom|floor)|"
+                      r"(?:room|housekeeping) (?:cleaning|service)|housekeeping|cleaning service"),
+    ("changing the bed sheets", r"change (?:the |my )?(?:bed ?sheets|sheets|linens?|bedding)"),
+    ("turndown service", r"turn ?down service"),
+    ("emptying the trash", r"empty (?:the |my )?(?:trash|bin|garbage|rubbish)|take (?:out )?the (?:trash|garbage)"),
+]
+
+# questions about the hotel, unless phrased as a polite request
+QUESTION = re.compile(r"^\s*(?:how|what|when|where|why|which|who|whose|is there|are there|"
+                      r"is it|do you|does|did|have you)\b", re.I)
+POLITE_REQUEST = re.compile(r"^\s*(?:please\s+)?(?:can|could|would|will)\s+(?:you|i|we|someone|somebody)\b|"
+                            r"^\s*may\s+(?:i|we)\b", re.I)
+NEGATION = re.compile(r"\b(?:not|no|don'?t|doesn'?t|never|cancel|stop|without|instead|"
+                      r"nevermind|never mind)\b", re.I)
+CLAUSE_BREAK = re.compile(r"[,;:!?]|\.(?!\d)|\b(?:and|but|or|because|since|so|then|also|plus)\b", re.I)
+# the only words a request may have outside its slot; any other, like the "room 305"
+# of "send a towel to room 305" or the "tomorrow at 10am" of "clean my room
+# tomorrow at 10am", qualifies the request and is left to the agent
+FRAME_WORDS = frozenset("""
+    i i'd id i'm we we'd me us you someone somebody anyone can could would will may
+    a an the some any my our this these that those more extra another additional fresh new spare
+    send bring need want give deliver provide like have up over is are it it's its has been seems keeps still
+    one two three four five couple few pair of just bathroom bedroom
+    please pls kindly thanks thank thx cheers ok okay hi hello hey sorry excuse good morning afternoon evening
+    so very much lot
+""".split())
+# the guest's own room, which is where every routed request goes anyway
+OWN_ROOM = re.compile(r"\b(?:to|in|into|for) (?:my|our|the|this) room\b", re.I)
+WORD = re.compile(r"[\w']+")
+# clauses that add nothing to the request
+COURTESY = re.compile(r"(?:(?:please|pls|kindly|thanks|thank you|thx|cheers|ok|okay|hi|hello|hey|sorry|"
+                      r"excuse me|good (?:morning|afternoon|evening))\s*)*(?:so much|very much|a lot)?", re.I)
+
+
+def _alternatives(patterns):
+    return re.compile(r"\b(?:%s)\b" % patterns, re.I)
+
+
+AMENITY_PATTERNS = [(name, _alternatives(pattern)) for name, pattern in AMENITIES.items()]
+REQUEST_VERB = _alternatives(REQUEST_VERBS)
+DEVICE = _alternatives(DEVICES)
+PROBLEM = _alternatives(PROBLEMS)
+HOUSEKEEPING_PATTERNS = [(reason, _alternatives(pattern)) for reason, pattern in HOUSEKEEPING]
+
+
+class Route(NamedTuple):
+    # None when the intent is there but not fully specified
+    tool: str
+    arguments: dict
+    # the text the slot came from
+    span: tuple
+
+
+def match_amenity(text):
+    found = {}
+    for name, pattern in AMENITY_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            found[name] = match.span()
+    tool = "request_room_amenity" if len(found) == 1 and REQUEST_VERB.search(text) else None
+    return [Route(tool, {"requested_amenity": name}, span) for name, span in found.items()]
+
+
+def match_maintenance(text):
+    devices = list(DEVICE.finditer(text))
+    problems = list(PROBLEM.finditer(text))
+    if len(devices) == 1 and len(problems) == 1:
+        device, problem = devices[0], problems[0]
+        start, end = min(device.start(), problem.start()), max(device.end(), problem.end())
+        return [Route("request_room_maintenance", {"issue": text[start:end]}, (start, end))]
+    return [Route(None, {}, match.span()) for match in devices + problems]
+
+
+def match_housekeeping(text):
+    routes = []
+    for reason, pattern in HOUSEKEEPING_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            routes.append(Route("housekeeping_service_request", {"reason": reason}, match.span()))
+    return routes
+
+
+MATCHERS = [match_amenity, match_maintenance, match_housekeeping]
+
+
+def _inside(span, other):
+    return other[0] <= span[0] and span[1] <= other[1] and span != other
+
+
+def is_whole_message(text, span):
+    """
+    Whether the clause around ``span`` is all of ``text`` apart from courtesies,
+    and the words outside ``span`` only frame the request.
+    """
+    outside = OWN_ROOM.sub(" ", text[:span[0]] + " " + text[span[1]:])
+    if any(word.lower() not in FRAME_WORDS for word in WORD.findall(outside)):
+        return False
+    # the slot itself may hold a break, as in "iron and ironing board"
+    rest = text[:span[0]] + " _ " + text[span[1]:]
+    return sum(1 for clause in CLAUSE_BREAK.split(rest) if not COURTESY.fullmatch(clause.strip())) == 1
+
+
+class IntentRouter:
+    """
+    Answers unambiguous service requests without the LLM.
+
+    ``route`` returns the ``Route`` for a message, or ``None`` when the agent
+    has to handle it. ``dispatch`` also runs the routed tool through its
+    ``args_schema``, exactly as the agent would have called it.
+    """
+
+    def __init__(self, tools=tools, enabled=True, max_words=16):
+        self.tools = {tool.name: tool for tool in tools}
+        self.enabled = enabled
+        self.max_words = max_words
+        self._lock = threading.Lock()
+        self.routed = 0
+        self.fallbacks = 0
+
+    def route(self, question, messages=()):
+        if not self.enabled or not question:
+            return None
+        text = " ".join(str(question).split())
+        if len(text.split()) > self.max_words:
+            return None
+        # the agent asked something, this message is most likely the answer
+        if messages and messages[-1].type == "ai" and messages[-1].content.rstrip().endswith("?"):
+            return None
+        if QUESTION.search(text) or ("?" in text and not POLITE_REQUEST.search(text)):
+            return None
+
+        routes = [route for matcher in MATCHERS for route in matcher(text)]
+        # "bed sheets" inside "change the bed sheets" is part of the housekeeping request
+        routes = [route for route in routes
+                  if not any(_inside(route.span, other.span) for other in routes if other.tool)]
+        if len(routes) != 1 or routes[0].tool not in self.tools:
+            return None
+        route = routes[0]
+        start, end = route.span
+        if NEGATION.search(text[:start] + " " + text[end:]) or not is_whole_message(text, route.span):
+            return None
+        return route
+
+    def dispatch(self, question, messages=()):
+        """The routed tool's result, or ``None`` to fall back to the agent."""
+        route = self.route(question, messages)
+        if route is not None and not current_guest().hotel.offers(route.tool):
+            # the guest's hotel does not offer it, let its agent answer
+            route = None
+        with self._lock:
+            if route is None:
+                self.fallbacks += 1
+            else:
+                self.routed += 1
+        if route is None:
+            return None
+        return self.tools[route.tool].run(route.arguments)
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "routed": self.routed, "fallbacks": self.fallbacks}
+
+
+def load_intent_router(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_INTENT_ROUTER", {})
+    return IntentRouter(**{key.lower(): value for key, value in config.items()})
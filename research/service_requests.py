@@ -0,0 +1,252 @@
+"""
+The ledger of what guests asked the hotel for.
+
+Every tool that books, orders or requests something records a
+``ServiceRequest`` (research/models.py), and the guest is given its number to
+ask ``service_status_checker`` about later. Recording does not cost an INSERT
+on the request path: ``ServiceRequestWriter`` buffers the rows and a
+background thread writes them every ``flush_interval`` seconds, or as soon as
+``max_batch`` are waiting, with one ``bulk_create``.
+
+Numbers are handed out before the row exists. Each worker reserves a block of
+``id_block`` numbers with a single UPDATE of ``ServiceRequestSequence``, so
+they stay short enough to read out over the phone, and a status check looks
+at the worker's buffer before the table.
+
+The front desk polls ``/research/service-requests``, one indexed range scan
+per page. Configured with the ``LLM_SERVICE_REQUESTS`` setting.
+"""
+import atexit
+import dataclasses
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# what status_summary tells the guest for each status
+STATUS_LABELS = {"open": "received", "in_progress": "being handled", "done": "done", "cancelled": "cancelled"}
+
+LIST_FIELDS = ("id", "hotel", "service", "room_number", "status", "details", "created_at", "updated_at")
+
+
+class ServiceRequestWriter:
+    """
+    Numbers service requests and writes them to the database in batches.
+
+    With ``buffered`` off every request is saved as it is recorded, which is
+    what tests and one-off scripts want.
+    """
+
+    def __init__(self, buffered=True, max_batch=500, flush_interval=0.5, id_block=100, using="default"):
+        self.buffered = buffered
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.id_block = id_block
+        self.using = using
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = iter(())
+        self._ids_pid = None
+        self._id_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+        self.recorded = 0
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def _reserve_ids(self):
+        """The next ``id_block`` numbers, reserved with one UPDATE shared by all workers."""
+        from .models import ServiceRequestSequence
+
+        sequence = ServiceRequestSequence.objects.using(self.using)
+        while True:
+            with transaction.atomic(using=self.using):
+                # the UPDATE takes the write lock first, so the value read back is this worker's
+                if sequence.filter(pk=1).update(value=F("value") + self.id_block):
+                    end = sequence.get(pk=1).value
+                    return iter(range(end - self.id_block + 1, end + 1))
+            try:
+                sequence.create(pk=1, value=0)
+            except IntegrityError:
+                pass  # another worker created it first
+
+    def next_id(self):
+        with self._id_lock:
+            if self._ids_pid != os.getpid():
+                # a forked worker must not hand out the rest of its parent's block
+                self._ids, self._ids_pid = iter(()), os.getpid()
+            number = next(self._ids, None)
+            if number is None:
+                self._ids = self._reserve_ids()
+                number = next(self._ids)
+            return number
+
+    def record(self, hotel, service, room_number, details):
+        """Number a new open request and queue it for writing; returns the unsaved ``ServiceRequest``."""
+        from .models import ServiceRequest
+
+        request = ServiceRequest(id=self.next_id(), hotel=hotel, service=service, room_number=room_number,
+                                 details=details, created_at=timezone.now())
+        if not self.buffered:
+            request.save(using=self.using, force_insert=True)
+            with self._lock:
+                self.recorded += 1
+                self.written += 1
+            return request
+        self._start_flusher()
+        with self._lock:
+            self._pending[request.id] = request
+            self.recorded += 1
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wake.set()
+        return request
+
+    def record_result(self, result, guest):
+        """
+        Record the ``ToolResult`` of a tool that acted for ``guest``, a ``GuestContext``.
+
+        Returns the result with the request's number added to its answer and
+        parameters.
+        """
+        request = self.record(guest.hotel.id, result.function,
+                              result.parameters.get("room_number", guest.room_number), result.parameters)
+        return dataclasses.replace(result, answer=f"{result.answer} Your request number is {request.id}.",
+                                   parameters={**result.parameters, "request_id": request.id})
+
+    def flush(self):
+        """
+        Write everything queued so far.
+
+        When the batch fails it is written again row by row, and the rows that
+        fail on their own are logged and dropped, so one bad row cannot keep
+        the rest queued forever.
+        """
+        from .models import ServiceRequest
+
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.values())
+            if not batch:
+                return 0
+            written, failed, retried = batch, [], False
+            try:
+                ServiceRequest.objects.using(self.using).bulk_create(batch, batch_size=self.max_batch)
+            except Exception:
+                logger.exception("Writing %d service requests failed, writing them one by one", len(batch))
+                # a broken connection is opened afresh for the retry
+                connections[self.using].close()
+                written, retried = [], True
+                for request in batch:
+                    try:
+                        request.save(using=self.using, force_insert=True)
+                        written.append(request)
+                    except Exception:
+                        logger.exception("Dropping service request %d, it could not be written", request.id)
+                        failed.append(request)
+            with self._lock:
+                for request in batch:
+                    self._pending.pop(request.id, None)
+                self.flushes += 1
+                self.written += len(written)
+                self.errors += retried
+                self.dropped += len(failed)
+            return len(written)
+
+    def _start_flusher(self):
+        """The background flush thread, once per worker process."""
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            # a forked worker inherits the parent's queue but not its thread
+            self._pending.clear()
+            threading.Thread(target=self._run, name="service-request-writer", daemon=True).start()
+            atexit.register(self.flush)
+            self._flusher_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            # no request cycle closes this thread's connection, so each flush opens and closes its own
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def get(self, number, guest):
+        """The request numbered ``number`` if it is ``guest``'s, as a dict of ``LIST_FIELDS``; one primary key lookup."""
+        from .models import ServiceRequest
+
+        if guest.room_number is None:
+            return None
+        with self._lock:
+            request = self._pending.get(number)
+        if request is not None:
+            row = {field: getattr(request, field) for field in LIST_FIELDS}
+        else:
+            row = ServiceRequest.objects.using(self.using).filter(pk=number).values(*LIST_FIELDS).first()
+        if row is None or (row["hotel"], row["room_number"]) != (guest.hotel.id, guest.room_number):
+            return None
+        return row
+
+    def recent(self, guest, limit=5):
+        """The latest requests of ``guest``'s room, newest first, queued ones included; none without a room."""
+        from .models import ServiceRequest
+
+        if guest.room_number is None:
+            return []
+        hotel, room_number = guest.hotel.id, guest.room_number
+        with self._lock:
+            rows = [{field: getattr(request, field) for field in LIST_FIELDS}
+                    for request in self._pending.values()
+                    if request.hotel == hotel and request.room_number == room_number]
+        rows += ServiceRequest.objects.using(self.using).filter(hotel=hotel, room_number=room_number) \
+            .order_by("-created_at").values(*LIST_FIELDS)[:limit]
+        rows = list({row["id"]: row for row in rows}.values())
+        rows.sort(key=lambda row: row["created_at"], reverse=True)
+        return rows[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {"buffered": self.buffered, "pending": len(self._pending), "recorded": self.recorded,
+                    "written": self.written, "flushes": self.flushes, "errors": self.errors,
+                    "dropped": self.dropped}
+
+
+def list_requests(hotel, statuses=("open",), room_number=None, after=0, limit=500, using="default"):
+    """A page of a hotel's requests in ``statuses`` by number, from the ``(hotel, status, id)`` index."""
+    from .models import ServiceRequest
+
+    rows = ServiceRequest.objects.using(using).filter(hotel=hotel, status__in=statuses, id__gt=after)
+    if room_number is not None:
+        rows = rows.filter(room_number=room_number)
+    return list(rows.order_by("id").values(*LIST_FIELDS)[:limit])
+
+
+def status_summary(row, guest):
+    label = row["service"].replace("_", " ")
+    placed = row["created_at"].astimezone(guest.hotel.time_zone).strftime("%d %b at %I:%M%p")
+    return f"Request #{row['id']} ({label}), placed {placed}, is {STATUS_LABELS.get(row['status'], row['status'])}."
+
+
+def load_service_request_writer(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_SERVICE_REQUESTS", {})
+    return ServiceRequestWriter(**{key.lower(): value for key, value in config.items()})
+
+
+service_request_writer = load_service_request_writer()
@@ -0,0 +1,313 @@
+"""
+Pluggable storage for per-session conversation memory.
+
+The backend is chosen with the ``LLM_SESSION_STORE`` setting, shaped like a
+``CACHES`` entry::
+
+    LLM_SESSION_STORE = {
+        "BACKEND": "research.sessions.LocalSessionStore",
+        "OPTIONS": {"MAX_ENTRIES": 10000, "TTL": 3600},
+    }
+
+``LocalSessionStore`` keeps sessions in the worker process. Use
+``CacheSessionStore`` or ``DatabaseSessionStore`` when several gunicorn workers
+have to see the same conversations.
+"""
+import datetime
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from langchain_core.messages import messages_from_dict, messages_to_dict
+
+from .memory import TokenBudgetMemory, memory_settings
+
+DEFAULT_SESSION_STORE = "research.sessions.LocalSessionStore"
+
+
+def new_memory(messages=None):
+    memory = TokenBudgetMemory(
+        return_messages=True, memory_key="chat_history",
+        max_tokens=memory_settings().get("MAX_TOKENS", 1500))
+    if messages:
+        memory.chat_memory.messages = messages
+    return memory
+
+
+def dump_messages(messages):
+    """Compact, zlib-compressed JSON form of a list of chat messages."""
+    return zlib.compress(
+        json.dumps(messages_to_dict(messages), separators=(",", ":")).encode())
+
+
+def load_messages(blob):
+    if not blob:
+        return []
+    return messages_from_dict(json.loads(zlib.decompress(blob)))
+
+
+class BaseSessionStore:
+    """
+    Hands out a ``TokenBudgetMemory`` per session id.
+
+    ``get`` returns the memory for a session, creating an empty one on a miss,
+    and ``save`` must be called once the turn has updated it.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, session_id):
+        raise NotImplementedError
+
+    def save(self, session_id, memory):
+        raise NotImplementedError
+
+    def get_many(self, session_ids):
+        """Return ``{session_id: memory}``; shared backends fetch them in one round trip."""
+        return {session_id: self.get(session_id) for session_id in session_ids}
+
+    def save_many(self, memories):
+        """Save a ``{session_id: memory}`` mapping; shared backends write it in one round trip."""
+        for session_id, memory in memories.items():
+            self.save(session_id, memory)
+
+    def stats(self):
+        return {"backend": type(self).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
+
+
+class _Entry:
+    __slots__ = ("memory", "blob", "accessed")
+
+    def __init__(self, memory, blob, accessed):
+        self.memory = memory
+        self.blob = blob
+        self.accessed = accessed
+
+
+class LocalSessionStore(BaseSessionStore):
+    """
+    In-process LRU store with idle-TTL expiry and entry and byte caps.
+
+    Only the ``hot_entries`` most recently used sessions keep a live memory
+    object; the rest are held as their compressed message blob and rebuilt on
+    the next hit. ``max_bytes`` is measured on the compressed blobs.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=60 * 60, hot_entries=256):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hot_entries = hot_entries
+        self._entries = OrderedDict()
+        self._hot = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                entry = self._entries[session_id] = _Entry(new_memory(), b"", now)
+                # sessions that never get saved, e.g. turns that failed, count against the cap too
+                self._evict(keep=session_id)
+            else:
+                self.hits += 1
+                self._entries.move_to_end(session_id)
+                entry.accessed = now
+                if entry.memory is None:
+                    entry.memory = new_memory(load_messages(entry.blob))
+            self._touch_hot(session_id)
+            return entry.memory
+
+    def save(self, session_id, memory):
+        blob = dump_messages(memory.chat_memory.messages)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                entry = self._entries[session_id] = _Entry(memory, blob, now)
+            else:
+                self._bytes -= len(entry.blob)
+                entry.memory, entry.blob, entry.accessed = memory, blob, now
+                self._entries.move_to_end(session_id)
+            self._bytes += len(blob)
+            self._touch_hot(session_id)
+            self._evict(keep=session_id)
+
+    def stats(self):
+        with self._lock:
+            return {**super().stats(),
+                    "entries": len(self._entries),
+                    "hot_entries": len(self._hot),
+                    "bytes": self._bytes}
+
+    def _touch_hot(self, session_id):
+        self._hot[session_id] = None
+        self._hot.move_to_end(session_id)
+        while len(self._hot) > self.hot_entries:
+            cold_id, _ = self._hot.popitem(last=False)
+            self._entries[cold_id].memory = None
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id)
+        self._hot.pop(session_id, None)
+        self._bytes -= len(entry.blob)
+
+    def _expire(self, now):
+        # entries are kept in access order, so the idle ones sit at the front
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+            if now - entry.accessed < self.ttl:
+                break
+            self._remove(session_id)
+            self.expirations += 1
+
+    def _evict(self, keep):
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            session_id = next(iter(self._entries))
+            if session_id == keep:
+                break
+            self._remove(session_id)
+            self.evictions += 1
+
+
+class CacheSessionStore(BaseSessionStore):
+    """
+    Session store on one of Django's ``CACHES`` aliases, shared by every worker.
+
+    Point ``cache`` at a ``RedisCache`` (needs the ``redis`` package) or a
+    ``FileBasedCache`` in production; a ``LocMemCache`` alias stands in for them
+    in tests. Each session is a single compressed blob, so a turn costs one
+    read and one write, and ``ttl`` becomes the cache timeout.
+    """
+
+    def __init__(self, cache="default", key_prefix="llm-session", ttl=60 * 60):
+        super().__init__()
+        self.cache_alias = cache
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        # cache handles are per thread, so look the alias up on every use
+        return caches[self.cache_alias]
+
+    def _key(self, session_id):
+        return f"{self.key_prefix}:{session_id}"
+
+    def get(self, session_id):
+        return self.get_many([session_id])[session_id]
+
+    def save(self, session_id, memory):
+        self.save_many({session_id: memory})
+
+    def get_many(self, session_ids):
+        keys = {self._key(session_id): session_id for session_id in session_ids}
+        blobs = self.cache.get_many(list(keys))
+        self.hits += len(blobs)
+        self.misses += len(keys) - len(blobs)
+        return {session_id: new_memory(load_messages(blobs.get(key)))
+                for key, session_id in keys.items()}
+
+    def save_many(self, memories):
+        self.cache.set_many(
+            {self._key(session_id): dump_messages(memory.chat_memory.messages)
+             for session_id, memory in memories.items()},
+            timeout=self.ttl)
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """``connection_created`` receiver, connected by ``ResearchConfig.ready``."""
+    # WAL lets readers in other worker processes carry on while one of them writes
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL;")
+            cursor.execute("PRAGMA synchronous=NORMAL;")
+
+
+class DatabaseSessionStore(BaseSessionStore):
+    """
+    Session store on the ``ChatSession`` table of the configured ``DATABASES``.
+
+    On SQLite every connection is switched to WAL journaling (``ResearchConfig.ready``)
+    so every worker can share the file. Sessions idle for longer than ``ttl`` are ignored on read
+    and purged every ``purge_every`` saves.
+    """
+
+    def __init__(self, using="default", ttl=60 * 60, purge_every=1000):
+        super().__init__()
+        self.using = using
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._saves = 0
+
+    def get(self, session_id):
+        return self.get_many([session_id])[session_id]
+
+    def save(self, session_id, memory):
+        self.save_many({session_id: memory})
+
+    def get_many(self, session_ids):
+        from .models import ChatSession
+
+        cutoff = timezone.now() - datetime.timedelta(seconds=self.ttl)
+        rows = dict(ChatSession.objects.using(self.using)
+                    .filter(session_id__in=[str(session_id) for session_id in session_ids],
+                            updated_at__gte=cutoff)
+                    .values_list("session_id", "messages"))
+        self.hits += len(rows)
+        self.misses += len(session_ids) - len(rows)
+        return {session_id: new_memory(load_messages(rows.get(str(session_id))))
+                for session_id in session_ids}
+
+    def save_many(self, memories):
+        from .models import ChatSession
+
+        now = timezone.now()
+        ChatSession.objects.using(self.using).bulk_create(
+            [ChatSession(session_id=str(session_id),
+                         messages=dump_messages(memory.chat_memory.messages),
+                         updated_at=now)
+             for session_id, memory in memories.items()],
+            update_conflicts=True,
+            unique_fields=["session_id"],
+            update_fields=["messages", "updated_at"])
+
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            self.purge_expired()
+
+    def purge_expired(self):
+        from .models import ChatSession
+
+        cutoff = timezone.now() - datetime.timedelta(seconds=self.ttl)
+        deleted, _ = ChatSession.objects.using(self.using).filter(updated_at__lt=cutoff).delete()
+        self.expirations += deleted
+
+
+def load_session_store(config=None):
+    """Build the session store described by ``config`` or ``settings.LLM_SESSION_STORE``."""
+    if config is None:
+        config = getattr(settings, "LLM_SESSION_STORE", {})
+    backend = import_string(config.get("BACKEND", DEFAULT_SESSION_STORE))
+    options = {key.lower(): value for key, value in config.get("OPTIONS", {}).items()}
+    return backend(**options)
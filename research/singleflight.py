@@ -0,0 +1,217 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+When several guests ask the same stateless question at the same moment, the
+first call (the leader) goes upstream and the others wait for its result
+instead of making their own. Nothing is kept once the leader finishes, the
+response cache and the weather cache handle repeats over time.
+
+``coalesce`` wraps the stateless tools and ``SingleFlightModel`` the agent's
+model. Tool calls that book or order anything are never shared: every
+request still runs its own tool calls, only identical model requests and
+stateless lookups are.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import Future
+from typing import Any
+
+import orjson
+from langchain_core.runnables import RunnableSerializable
+
+# every SingleFlight by name, for the stats view
+flights = {}
+
+
+class Abandoned(Exception):
+    """The leader stopped before finishing, so each follower makes the call itself."""
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time and hands its result to every caller that joined meanwhile.
+
+    Flights are ``concurrent.futures.Future`` objects, so threads and event
+    loops can wait on the same one. An error of the leader is raised to its
+    followers too.
+    """
+
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+        flights[name] = self
+
+    def join(self, key):
+        """``(future, leader)``; the leader has to ``finish`` the flight."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def finish(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def fail(self, key, future, error):
+        # cancellation or an abandoned generator is the leader's own business
+        self.finish(key, future, error=error if isinstance(error, Exception) else Abandoned())
+
+    def do(self, key, func, *args, **kwargs):
+        if not self.enabled:
+            return func(*args, **kwargs)
+        future, leader = self.join(key)
+        if not leader:
+            try:
+                return future.result()
+            except Abandoned:
+                return func(*args, **kwargs)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self.fail(key, future, e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    async def ado(self, key, func, *args, **kwargs):
+        """``do`` for a coroutine function."""
+        if not self.enabled:
+            return await func(*args, **kwargs)
+        future, leader = self.join(key)
+        if not leader:
+            try:
+                return await asyncio.wrap_future(future)
+            except Abandoned:
+                return await func(*args, **kwargs)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self.fail(key, future, e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "in_flight": len(self._calls),
+                    "leaders": self.leaders, "shared": self.shared}
+
+
+def single_flight_stats():
+    return {name: flight.stats() for name, flight in flights.items()}
+
+
+def coalesce(func):
+    """Share one call of ``func`` among identical concurrent calls; for stateless tools only."""
+    flight = SingleFlight(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, frozenset(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+        return flight.do(key, func, *args, **kwargs)
+
+    wrapper.flight = flight
+    return wrapper
+
+
+class SingleFlightModel(RunnableSerializable):
+    """
+    The agent's model behind a ``SingleFlight``: identical concurrent prompts share one request.
+
+    The leader streams as usual; the others get the complete message at once
+    when it is done. It runs no run of its own, so the model's callbacks see
+    the leader's call exactly as without it. Models bound to different tools
+    that share a flight set a different ``scope``.
+    """
+
+    bound: Any
+    flight: Any
+    scope: str = ""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __repr__(self):
+        # serialized on every chain start, keep it short
+        return f"SingleFlightModel({self.flight.name})"
+
+    def key(self, input):
+        messages = input.to_messages() if hasattr(input, "to_messages") else input
+        if isinstance(messages, str):
+            return (self.scope, messages.encode())
+        return (self.scope, orjson.dumps([(message.type, message.content, message.additional_kwargs)
+                                          for message in messages], default=str))
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.flight.do(self.key(input), self.bound.invoke, input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self.flight.ado(self.key(input), self.bound.ainvoke, input, config, **kwargs)
+
+    def stream(self, input, config=None, **kwargs):
+        if not self.flight.enabled:
+            yield from self.bound.stream(input, config, **kwargs)
+            return
+        key = self.key(input)
+        future, leader = self.flight.join(key)
+        if not leader:
+            try:
+                message = future.result()
+            except Abandoned:
+                yield from self.bound.stream(input, config, **kwargs)
+            else:
+                yield message
+            return
+        message = None
+        try:
+            for chunk in self.bound.stream(input, config, **kwargs):
+                message = chunk if message is None else message + chunk
+                yield chunk
+        except BaseException as e:
+            self.flight.fail(key, future, e)
+            raise
+        self.flight.finish(key, future, message)
+
+    async def astream(self, input, config=None, **kwargs):
+        if not self.flight.enabled:
+            async for chunk in self.bound.astream(input, config, **kwargs):
+                yield chunk
+            return
+        key = self.key(input)
+        future, leader = self.flight.join(key)
+        if not leader:
+            try:
+                message = await asyncio.wrap_future(future)
+            except Abandoned:
+                async for chunk in self.bound.astream(input, config, **kwargs):
+                    yield chunk
+            else:
+                yield message
+            return
+        message = None
+        try:
+            async for chunk in self.bound.astream(input, config, **kwargs):
+                message = chunk if message is None else message + chunk
+                yield chunk
+        except BaseException as e:
+            self.flight.fail(key, future, e)
+            raise
+        self.flight.finish(key, future, message)
@@ -0,0 +1,84 @@
+"""
+Lazy, background initialisation of the LLM stack built by ``views.llm_startup``.
+
+Nothing heavy runs at import time. ``wsgi.py`` / ``asgi.py`` call
+``start_warmup()`` so a serving process builds the clients in the background,
+management commands never pay for it, and the first request that needs the
+agent waits in ``ensure_llm_ready()`` for at most ``LLM_STARTUP_TIMEOUT``.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_done = threading.Event()
+_state = {"status": "idle", "error": None, "timings": {}}
+
+
+class LLMNotReady(Exception):
+    http_status = 503
+    retry_after = 5
+
+
+@contextmanager
+def timed(phase):
+    """Record how long ``phase`` of the startup takes."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _state["timings"][phase] = round(time.perf_counter() - start, 4)
+
+
+def warm_up():
+    """Run ``llm_startup`` in the calling thread and record the outcome."""
+    try:
+        with timed("total"):
+            from .views import llm_startup
+            llm_startup()
+    except Exception as e:
+        _state.update(status="failed", error=f"{type(e).__name__}: {e}")
+    else:
+        _state.update(status="ready", error=None)
+    finally:
+        _done.set()
+
+
+def start_warmup():
+    """Start ``warm_up`` on a daemon thread unless it is running or has succeeded."""
+    with _lock:
+        if _state["status"] in ("starting", "ready"):
+            return
+        _state.update(status="starting", error=None, timings={})
+        _done.clear()
+        threading.Thread(target=warm_up, name="llm-warmup", daemon=True).start()
+
+
+def ensure_llm_ready(timeout=None):
+    """Block until the LLM stack is up, starting it if needed."""
+    if _state["status"] != "ready":
+        start_warmup()
+        _done.wait(settings.LLM_STARTUP_TIMEOUT if timeout is None else timeout)
+    if _state["status"] != "ready":
+        raise LLMNotReady(_state["error"] or "The LLM engine is still starting, retry shortly")
+
+
+def status():
+    return {"status": _state["status"],
+            "error": _state["error"],
+            "timings": dict(_state["timings"])}
+
+
+def _reset_after_fork():
+    # a warm-up thread started before a fork (e.g. gunicorn --preload) does not
+    # exist in the child, so let the child start its own
+    global _lock
+    _lock = threading.Lock()
+    if _state["status"] == "starting":
+        _state["status"] = "idle"
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,107 @@
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import orjson
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+
+def format_sse(event, data):
+    """Encode one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {orjson.dumps(data, default=str).decode()}\n\n"
+
+
+class HeldTokens:
+    """Token events held back from their queues until ``release``; never released, they are dropped."""
+
+    def __init__(self):
+        self.events = []
+
+    async def release(self):
+        for queue, event in self.events:
+            await queue.put(event)
+        self.events = []
+
+    def release_nowait(self):
+        # the queues are unbounded, put_nowait is what put amounts to
+        for queue, event in self.events:
+            queue.put_nowait(event)
+        self.events = []
+
+
+held_tokens = ContextVar("held_tokens", default=None)
+
+
+@contextmanager
+def hold_tokens():
+    """Hold back the tokens ``QueueCallbackHandler`` sees in the enclosed block; yields the ``HeldTokens``."""
+    held = HeldTokens()
+    reset = held_tokens.set(held)
+    try:
+        yield held
+    finally:
+        held_tokens.reset(reset)
+
+
+class QueueCallbackHandler(AsyncCallbackHandler):
+    """
+    Push LLM tokens and tool calls of an agent run onto an ``asyncio.Queue``.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def on_llm_new_token(self, token, **kwargs):
+        # function-call deltas arrive as empty content tokens
+        if token:
+            event = {"event": "token", "data": {"token": token}}
+            held = held_tokens.get()
+            if held is not None:
+                held.events.append((self.queue, event))
+            else:
+                await self.queue.put(event)
+
+    async def on_tool_start(self, serialized, input_str, **kwargs):
+        await self.queue.put({"event": "tool_start",
+                              "data": {"tool": serialized.get("name"), "input": input_str}})
+
+    async def on_tool_end(self, output, **kwargs):
+        await self.queue.put({"event": "tool_end",
+                              "data": {"tool": kwargs.get("name"), "output": output}})
+
+
+async def stream_agent_events(agent_executor, question, memory, context=None, callbacks=()):
+    """
+    Run a ``SharedAgentExecutor`` with ``ainvoke`` and yield its events as they happen.
+
+    Yields ``{"event": ..., "data": ...}`` dicts: ``token``, ``tool_start`` and
+    ``tool_end`` while the agent runs, then a single ``result`` (the executor
+    output) or ``error`` (the raised exception). ``callbacks`` are added to
+    the run, for tracing.
+    """
+    queue = asyncio.Queue()
+    done = object()
+
+    async def run():
+        try:
+            output = await agent_executor.ainvoke(
+                question, memory, context=context,
+                config={"callbacks": [QueueCallbackHandler(queue), *callbacks]})
+            await queue.put({"event": "result", "data": output})
+        except Exception as e:
+            await queue.put({"event": "error", "data": e})
+        finally:
+            await queue.put(done)
+
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            event = await queue.get()
+            if event is done:
+                break
+            yield event
+    finally:
+        # the client went away before the agent finished
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,200 @@
+"""
+Which hotel and room a turn is for, and each hotel's agent.
+
+One deployment serves every property in the ``LLM_HOTELS`` setting. A request
+names its hotel and room, ``hotels.guest()`` turns them into a
+``GuestContext``, and the view runs the turn inside ``guest_context()``. The
+context lives in a ``ContextVar``, so the prompt and the tools read it with
+``current_guest()`` wherever they run: ``ParallelAgentExecutor`` copies it
+into its tool threads, ``asyncio`` tasks and ``sync_to_async`` into theirs.
+
+``HotelAgents`` builds a hotel's agent, with the tools that hotel offers, the
+first time one of its guests asks something, and drops it once it has sat
+idle for ``idle_ttl`` seconds.
+"""
+import datetime
+import threading
+import time
+import zoneinfo
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, FrozenSet, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from .singleflight import SingleFlight
+
+
+class InvalidGuest(Exception):
+    http_status = 400
+
+
+@dataclass(frozen=True)
+class Hotel:
+    id: str
+    name: str
+    time_zone: datetime.tzinfo
+    # names of the tools its agent may call, every tool when None
+    tools: Optional[FrozenSet[str]] = None
+
+    def offers(self, tool_name):
+        return self.tools is None or tool_name in self.tools
+
+
+@dataclass(frozen=True)
+class GuestContext:
+    """The hotel and room a turn is for, and the clock it reads the time from."""
+    hotel: Hotel
+    room_number: Optional[int] = None
+    clock: Callable[[], datetime.datetime] = field(default=timezone.now, compare=False)
+
+    def now(self):
+        """The time at the hotel."""
+        return self.clock().astimezone(self.hotel.time_zone)
+
+    def today(self):
+        return self.now().date()
+
+    def require_room(self):
+        """The room number, for what is done for or looked up by a room; ``InvalidGuest`` without one."""
+        if self.room_number is None:
+            raise InvalidGuest("Send the guest's room number with this request")
+        return self.room_number
+
+    @property
+    def key(self):
+        return f"{self.hotel.id}/{self.room_number}"
+
+
+class Hotels:
+    """The properties this deployment serves, by id."""
+
+    def __init__(self, hotels, default):
+        self.hotels = hotels
+        self.default = default
+
+    def get(self, hotel_id=None):
+        hotel = self.hotels.get(hotel_id or self.default)
+        if hotel is None:
+            raise InvalidGuest(f"Unknown hotel {hotel_id!r}")
+        return hotel
+
+    def guest(self, hotel_id=None, room_number=None):
+        """The ``GuestContext`` of a request's ``hotel`` and ``room``."""
+        if room_number not in (None, ""):
+            try:
+                room_number = int(room_number)
+            except (TypeError, ValueError):
+                raise InvalidGuest(f"Invalid room number {room_number!r}") from None
+        else:
+            room_number = None
+        return GuestContext(self.get(hotel_id), room_number)
+
+
+def load_hotels(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_HOTELS", {})
+    hotels = {hotel_id: Hotel(id=hotel_id,
+                              name=options.get("NAME", hotel_id),
+                              time_zone=zoneinfo.ZoneInfo(options.get("TIME_ZONE", settings.TIME_ZONE)),
+                              tools=frozenset(options["TOOLS"]) if options.get("TOOLS") is not None else None)
+              for hotel_id, options in config.get("HOTELS", {"default": {}}).items()}
+    return Hotels(hotels, config.get("DEFAULT", next(iter(hotels))))
+
+
+hotels = load_hotels()
+
+_current_guest = ContextVar("current_guest", default=None)
+
+
+def current_guest():
+    """The ``GuestContext`` of the running turn; the default hotel, without a room, outside one."""
+    guest = _current_guest.get()
+    if guest is None:
+        guest = GuestContext(hotels.get())
+    return guest
+
+
+def set_guest(guest):
+    """Set the guest for the rest of the current context, e.g. a response body iterated by its own task."""
+    return _current_guest.set(guest)
+
+
+@contextmanager
+def guest_context(guest):
+    token = _current_guest.set(guest)
+    try:
+        yield guest
+    finally:
+        _current_guest.reset(token)
+
+
+class HotelAgents:
+    """
+    Each hotel's agent, built by ``build(hotel)`` on first use and dropped after ``idle_ttl`` seconds unused.
+
+    Concurrent first requests for a hotel wait for one build. At most
+    ``max_agents`` are kept, the least recently used going first.
+    """
+
+    def __init__(self, build, idle_ttl=30 * 60, max_agents=64):
+        self.build = build
+        self.idle_ttl = idle_ttl
+        self.max_agents = max_agents
+        self._agents = OrderedDict()
+        self._lock = threading.Lock()
+        self._builds = SingleFlight("hotel_agents")
+        self._generation = 0
+        self.built = 0
+        self.evicted = 0
+
+    def get(self, hotel):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._agents.get(hotel.id)
+            if entry is not None:
+                entry[1] = now
+                self._agents.move_to_end(hotel.id)
+                self._evict(now)
+                return entry[0]
+        return self._builds.do(hotel.id, self._build, hotel)
+
+    def _build(self, hotel):
+        generation = self._generation
+        agent = self.build(hotel)
+        with self._lock:
+            self.built += 1
+            # an agent built before clear() is handed out once but not kept
+            if generation == self._generation:
+                self._agents[hotel.id] = [agent, time.monotonic()]
+                self._evict(time.monotonic())
+        return agent
+
+    def _evict(self, now):
+        # entries are in least recently used order, so the idle ones are at the front
+        while self._agents:
+            hotel_id, (_, last_used) = next(iter(self._agents.items()))
+            if len(self._agents) <= self.max_agents and now - last_used < self.idle_ttl:
+                break
+            del self._agents[hotel_id]
+            self.evicted += 1
+
+    def clear(self):
+        """Drop every agent, e.g. when the model they are built on changes."""
+        with self._lock:
+            self._agents.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {"agents": list(self._agents), "built": self.built, "evicted": self.evicted,
+                    "idle_ttl": self.idle_ttl, "max_agents": self.max_agents}
+
+
+def load_hotel_agents(build, config=None):
+    if config is None:
+        config = getattr(settings, "LLM_HOTELS", {})
+    return HotelAgents(build, idle_ttl=config.get("IDLE_TTL", 30 * 60), max_agents=config.get("MAX_AGENTS", 64))
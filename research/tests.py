@@ -1,3 +1,1433 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+import numpy as np
+from langchain.agents.format_scratchpad.openai_tools import format_to_openai_tool_messages
+from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser
+from langchain_core.messages import AIMessage, HumanMessage
+from openai.error import RateLimitError
+
+from . import methods, startup, views
+from .admission import GatedModel, LLMGate, Overloaded, RateLimited, RateLimiter
+from .batch import BatchRunner
+from .benchmarks import INTENT_FIXTURES, LOAD_RESPONSES, bench_load, fake_agent_chain
+from .fakes import FakeChatModel, FakeEmbeddings, FakeOpenMeteoServer
+from .handlers import ASGIDispatcher, PathDispatcher, WSGIDispatcher, api_asgi_application, api_wsgi_application
+from .ingest import Checkpoint, Ingestor
+from .memory import SUMMARY_PREFIX, MemorySummarizer
+from .models import ChatSession, ServiceRequest
+from .prompts import AgentPrompt
+from .response_cache import ResponseCache
+from .retrieval import BatchedEmbeddings, Retriever
+from .router import IntentRouter
+from .service_requests import ServiceRequestWriter, service_request_writer
+from .sessions import CacheSessionStore, DatabaseSessionStore, LocalSessionStore, dump_messages, new_memory
+from .singleflight import SingleFlight, SingleFlightModel, coalesce
+from .tenancy import InvalidGuest, guest_context, hotels
+from .tiering import ModelTiers, TieredModel
+from .tracing import REQUEST_SECONDS, Histogram
+from .vectorstores import InMemoryVectorIndex, MemmapVectorIndex
+from .weather import WeatherClient
+
+
+def sse_events(body):
+    """``[(event, data), ...]`` of a Server-Sent Events body."""
+    events = []
+    for frame in body.decode().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.splitlines() if not line.startswith(":"))
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class StreamEndpointTests(TestCase):
+
+    async def test_stream_through_the_url(self):
+        # through the URLconf and the full middleware stack, csrf_exempt included
+        with fake_agent_chain(responses=["Hello! How can I help you today?"]):
+            response = await self.async_client.post(
+                "/research/llm-engine/stream", {"query": "hello", "session_id": "stream-url", "room": 101},
+                content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            events = sse_events(b"".join([chunk async for chunk in response.streaming_content]))
+
+        self.assertIn("token", [event for event, _ in events])
+        event, data = events[-1]
+        self.assertEqual(event, "result")
+        self.assertTrue(data["success"])
+        self.assertEqual(data["data"]["answer"], "Hello! How can I help you today?")
+
+
+async def asgi_post(application, path, body):
+    """POST ``body`` to ``application`` as an ASGI server would, and return its status and body."""
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": b"", "client": ("127.0.0.1", 0), "server": ("testserver", 80),
+             "headers": [(b"host", b"testserver"), (b"content-type", b"application/json"),
+                         (b"content-length", str(len(body)).encode())]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    finished = asyncio.Event()
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if message["type"] == "http.response.body" and not message.get("more_body"):
+            finished.set()
+
+    await application(scope, receive, send)
+    finished.set()
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+class BatchEndpointTests(SimpleTestCase):
+
+    def test_a_disconnect_saves_every_turn_that_ran(self):
+        items = [{"query": f"question {turn}", "session_id": f"batch-{session}", "room": 101}
+                 for turn in range(3) for session in "ab"]
+        saved = []
+        save_many = views.session_store.save_many
+
+        def recording_save_many(memories):
+            saved.append({session_id: len(memory.chat_memory.messages) for session_id, memory in memories.items()})
+            save_many(memories)
+
+        with fake_agent_chain(responses=["An answer."], latency=0.2) as model, \
+                mock.patch.object(views.session_store, "save_many", recording_save_many):
+            response = self.client.post("/research/llm-engine/batch", items, content_type="application/json")
+            next(iter(response.streaming_content))
+            # the client goes away after the first line, with turns still running
+            response.close()
+            calls = model.i
+            time.sleep(0.3)
+
+        # the turns running at the disconnect finished before the save, no turn started after it
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(sum(saved[0].values()), 2 * calls)
+        self.assertLess(calls, len(items))
+        self.assertEqual(model.i, calls)
+
+    def test_pooled_sessions_close_their_connections(self):
+        closed = []
+        runner = BatchRunner(concurrency=2)
+        self.addCleanup(runner.executor.shutdown)
+        with mock.patch("research.batch.close_old_connections",
+                        lambda: closed.append(threading.current_thread().name)):
+            results = runner.run({"a": [(0, {})], "b": [(1, {})]}, lambda session_id, item: session_id)
+            self.assertEqual(sorted(result for _, result, _ in results), ["a", "b"])
+
+        # once as each session starts and once as it ends, on the pool's threads
+        self.assertEqual(len(closed), 4)
+        self.assertTrue(all(name.startswith("llm-batch") for name in closed))
+
+    def post_batch(self, items, limiter):
+        with mock.patch.object(views, "rate_limiter", limiter), fake_agent_chain(rate_limit=True):
+            response = self.client.post("/research/llm-engine/batch", items, content_type="application/json")
+            lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        return {line["index"]: line for line in lines}
+
+    def test_items_are_charged_to_their_session(self):
+        items = [{"query": f"question {turn}", "session_id": "batch-limited", "room": 101} for turn in range(4)]
+        lines = self.post_batch(items, RateLimiter(session_rate=0.001, session_burst=2))
+
+        self.assertEqual([lines[index]["success"] for index in range(4)], [True, True, False, False])
+        self.assertEqual(lines[2]["status"], 429)
+        self.assertGreater(lines[2]["error"]["retry_after"], 0)
+
+    def test_items_are_charged_to_the_process(self):
+        items = [{"query": "hello", "session_id": f"batch-process-{n}", "room": 101} for n in range(3)]
+        lines = self.post_batch(items, RateLimiter(process_rate=0.001, process_burst=2))
+
+        self.assertEqual(sorted(line["success"] for line in lines.values()), [False, True, True])
+        self.assertEqual([line["status"] for line in lines.values() if not line["success"]], [429])
+
+
+class HandlerTests(TransactionTestCase):
+    """llm-engine through the servers' entry points, as the load benchmark drives it."""
+
+    body = {"query": "can you recommend me a room under 1000 per day", "session_id": "handler", "room": 101}
+    responses = [LOAD_RESPONSES[1], "Here are the rooms under 1000 per day."]
+
+    def assert_room_recommendation(self, data):
+        self.assertTrue(data["success"])
+        self.assertEqual(data["data"]["query"], self.body["query"])
+        self.assertTrue(data["function-call-status"])
+        self.assertEqual(data["function"]["function-name"], "room_recommendation")
+        self.assertEqual([function["function-name"] for function in data["functions"]], ["room_recommendation"])
+
+    def tearDown(self):
+        # the load benchmark records reminders; written at exit, they would land in the real database
+        service_request_writer.flush()
+
+    def test_wsgi_handler(self):
+        environ = RequestFactory().post("/research/llm-engine", {**self.body, "session_id": "handler-wsgi"},
+                                        content_type="application/json").environ
+        status = []
+        with fake_agent_chain(responses=self.responses):
+            response = api_wsgi_application()(
+                environ, lambda status_line, headers, exc_info=None: status.append((status_line, dict(headers))))
+            try:
+                body = b"".join(response)
+            finally:
+                response.close()
+
+        status_line, headers = status[0]
+        self.assertEqual(status_line, "200 OK")
+        self.assertEqual(headers["Content-Type"], "application/json")
+        self.assertIn("Server-Timing", headers)
+        self.assert_room_recommendation(json.loads(body))
+
+    def test_asgi_handler(self):
+        body = json.dumps({**self.body, "session_id": "handler-asgi"}).encode()
+        with fake_agent_chain(responses=self.responses):
+            status, content = asyncio.run(asgi_post(api_asgi_application(), "/research/llm-engine", body))
+
+        self.assertEqual(status, 200)
+        self.assert_room_recommendation(json.loads(content))
+
+    def test_load_benchmark_runs_without_errors(self):
+        result = bench_load(requests=8, concurrency=2, latency=0.0, turns=4)
+
+        self.assertEqual(result["sessions"], 2)
+        for driver in ("wsgi", "asgi", "asgi_stream"):
+            self.assertEqual(result[driver]["errors"], 0, driver)
+            self.assertGreater(result[driver]["requests_per_second"], 0)
+            self.assertLessEqual(result[driver]["p50_ms"], result[driver]["p99_ms"])
+
+
+class ParallelToolCallTests(SimpleTestCase):
+    calls = [{"name": "get_current_temperature", "arguments": {"latitude": 23.8, "longitude": 90.4}},
+             {"name": "room_recommendation", "arguments": {"budget_highest": 1000}}]
+
+    def post(self, session_id, weather, rooms):
+        with fake_agent_chain(responses=[self.calls]) as model, \
+                mock.patch.object(views.intent_router, "enabled", False), \
+                mock.patch.object(methods.get_current_temperature, "func", weather), \
+                mock.patch.object(methods.room_recommendation, "func", rooms):
+            response = self.client.post("/research/llm-engine",
+                                        {"query": "weather and rooms", "session_id": session_id, "room": 101},
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(model.i, 1)
+        return response.json()
+
+    def test_tool_calls_run_concurrently_and_answer_in_call_order(self):
+        # each tool waits for the other to start, and the first to be called finishes last
+        started = threading.Barrier(2, timeout=2)
+
+        def weather(latitude, longitude):
+            started.wait()
+            time.sleep(0.05)
+            return methods.ToolResult("get_current_temperature", "It is 30C.", {"latitude": latitude})
+
+        def rooms(budget_highest):
+            started.wait()
+            return methods.ToolResult("room_recommendation", "Room 12 is free.", {"budget_highest": budget_highest})
+
+        data = self.post("parallel-tools", weather, rooms)
+
+        self.assertEqual([function["function-name"] for function in data["functions"]],
+                         ["get_current_temperature", "room_recommendation"])
+        self.assertEqual(data["data"]["answer"], "It is 30C.\nRoom 12 is free.")
+
+    def test_a_failing_tool_becomes_an_error_result(self):
+        def weather(latitude, longitude):
+            raise ConnectionError("weather service unreachable")
+
+        def rooms(budget_highest):
+            return methods.ToolResult("room_recommendation", "Room 12 is free.", {"budget_highest": budget_highest})
+
+        with self.assertLogs("research.agent", "ERROR"):
+            data = self.post("failing-tool", weather, rooms)
+
+        self.assertTrue(data["success"])
+        failed, found = data["functions"]
+        self.assertEqual(failed["function-name"], "get_current_temperature")
+        self.assertEqual(failed["parameters"], self.calls[0]["arguments"])
+        self.assertEqual(failed["error"], "weather service unreachable")
+        self.assertEqual(found, {"function-name": "room_recommendation", "parameters": {"budget_highest": 1000}})
+        self.assertIn("Room 12 is free.", data["data"]["answer"])
+
+
+class AgentPromptTests(SimpleTestCase):
+
+    def tool_calls(self, *calls):
+        message = AIMessage(content="", additional_kwargs={"tool_calls": FakeChatModel._tool_calls(list(calls))})
+        return OpenAIToolsAgentOutputParser().invoke(message)
+
+    def test_the_scratchpad_matches_langchains_formatting(self):
+        first = self.tool_calls({"name": "request_room_amenity", "arguments": {"requested_amenity": "towel"}},
+                                {"name": "order_resturant_item",
+                                 "arguments": {"item_name": "pizza", "item_quantity": 2, "dine_in_type": "room"}})
+        second = self.tool_calls({"name": "service_status_checker", "arguments": {}})
+        prompt = AgentPrompt()
+        # the executor grows one list through the run, the prompt formats only what was added
+        steps = [(action, f"Result of {action.tool}") for action in first]
+        self.assertEqual(prompt.scratchpad(steps), format_to_openai_tool_messages(steps))
+        steps.append((second[0], methods.ToolResult("service_status_checker", "Your towel is on its way.")))
+
+        scratchpad = prompt.scratchpad(steps)
+        self.assertEqual(scratchpad, format_to_openai_tool_messages(steps))
+        self.assertEqual([message.type for message in scratchpad], ["ai", "tool", "tool", "ai", "tool"])
+        self.assertEqual(AgentPrompt().scratchpad(list(steps)), scratchpad)
+
+
+class ToolResultPayloadTests(TransactionTestCase):
+    # book_room records a service request through the buffered writer
+
+    booking = {"room_type": "AC", "class_type": "Business", "check_in_date": "2026-11-02",
+               "check_out_date": "2026-11-05", "mobile_no": "01700000000"}
+
+    def post(self, session_id):
+        with mock.patch.object(views.intent_router, "enabled", False):
+            response = self.client.post("/research/llm-engine",
+                                        {"query": "book me a room", "session_id": session_id, "room": 101},
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_a_tool_call_is_passed_through_with_typed_parameters(self):
+        with fake_agent_chain(responses=[{"name": "book_room", "arguments": self.booking}]):
+            data = self.post("payload-booked")
+        service_request_writer.flush()
+
+        request = ServiceRequest.objects.get(service="book_room", room_number=101)
+        self.assertTrue(data["function-call-status"])
+        self.assertEqual(data["function"], {"function-name": "book_room",
+                                            "parameters": {**self.booking, "request_id": request.id}})
+        self.assertEqual(data["functions"], [data["function"]])
+        self.assertEqual(data["data"]["answer"],
+                         "Room has been booked for AC Business class from 2026-11-02 to 2026-11-05. "
+                         f"Your request number is {request.id}.")
+
+    def test_a_failing_tool_call_carries_its_error(self):
+        def unavailable(*args, **kwargs):
+            raise RuntimeError("booking system unavailable")
+
+        with fake_agent_chain(responses=[{"name": "book_room", "arguments": self.booking}]), \
+                mock.patch.object(methods.book_room, "func", unavailable), self.assertLogs("research.agent", "ERROR"):
+            data = self.post("payload-failed")
+
+        self.assertTrue(data["success"])
+        self.assertTrue(data["function-call-status"])
+        self.assertEqual(data["function"], {"function-name": "book_room", "parameters": self.booking,
+                                            "error": "booking system unavailable"})
+        self.assertEqual(data["functions"], [data["function"]])
+        self.assertEqual(data["data"]["answer"], "Sorry, that request could not be completed, please try again.")
+
+
+class SharedAgentExecutorTests(SimpleTestCase):
+
+    def post(self, query, session_id):
+        response = self.client.post("/research/llm-engine", {"query": query, "session_id": session_id, "room": 101},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]["answer"]
+
+    def test_one_executor_serves_every_session(self):
+        with fake_agent_chain(responses=["First answer.", "Second answer.", "Third answer."]), \
+                mock.patch.object(views.intent_router, "enabled", False):
+            built = views.hotel_agents.built
+            answers = [self.post("first question", "shared-a"), self.post("second question", "shared-b"),
+                       self.post("third question", "shared-a")]
+            executor = views.get_agent_executor(hotels.get(None))
+
+        self.assertEqual(answers, ["First answer.", "Second answer.", "Third answer."])
+        self.assertEqual(views.hotel_agents.built, built + 1)
+        self.assertIsNone(executor.executor.memory)
+        # each turn saw and saved its own session's memory
+        self.assertEqual([message.content for message in views.session_store.get("shared-b").chat_memory.messages],
+                         ["second question", "Second answer."])
+        self.assertEqual(len(views.session_store.get("shared-a").chat_memory.messages), 4)
+
+
+class StartupTests(SimpleTestCase):
+
+    def setUp(self):
+        state = mock.patch.dict(startup._state, {"status": "idle", "error": None, "timings": {}})
+        state.start()
+        self.addCleanup(state.stop)
+
+    def test_readiness_answers_503_until_ready(self):
+        startup._state["status"] = "starting"
+        response = self.client.get("/research/ready")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertEqual(response.json()["status"], "starting")
+
+        startup._state["status"] = "ready"
+        response = self.client.get("/research/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Retry-After", response)
+
+    def test_warm_up_runs_once_in_the_background(self):
+        threads = []
+
+        def llm_startup():
+            threads.append(threading.current_thread().name)
+            time.sleep(0.05)
+
+        with mock.patch("research.views.llm_startup", llm_startup):
+            startup.start_warmup()
+            startup.start_warmup()
+            self.assertEqual(startup.status()["status"], "starting")
+            startup.ensure_llm_ready(timeout=2)
+            startup.start_warmup()
+
+        self.assertEqual(threads, ["llm-warmup"])
+        state = startup.status()
+        self.assertEqual((state["status"], state["error"]), ("ready", None))
+        self.assertIn("total", state["timings"])
+
+    @override_settings(OPENAI_API_KEY="")
+    def test_a_failed_warm_up_is_a_503_with_retry_after(self):
+        with mock.patch.object(views, "agent_model", None), \
+                mock.patch.object(views.intent_router, "enabled", False):
+            response = self.client.post("/research/llm-engine",
+                                        {"query": "hello", "session_id": "not-ready", "room": 101},
+                                        content_type="application/json")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertEqual(response.json()["error"]["message"], "ImproperlyConfigured: Provide OPENAI API KEY")
+        self.assertEqual(startup.status()["status"], "failed")
+
+
+class PathDispatcherTests(SimpleTestCase):
+
+    def wsgi_get(self, application, path):
+        headers = []
+        response = application(RequestFactory().get(path).environ,
+                               lambda status, response_headers, exc_info=None: headers.extend(response_headers))
+        try:
+            b"".join(response)
+        finally:
+            response.close()
+        return dict(headers)
+
+    def test_the_prefix_less_the_excluded_paths_is_api(self):
+        dispatcher = PathDispatcher(None, None, "/research/", ["/research/admin/", "/research/service-requests"])
+        for path in ("/research/llm-engine", "/research/llm-engine/stream", "/research/ready"):
+            self.assertTrue(dispatcher.is_api(path), path)
+        for path in ("/research/admin/", "/research/admin/login/", "/research/service-requests", "/admin/",
+                     "/research", "/"):
+            self.assertFalse(dispatcher.is_api(path), path)
+
+    def test_requests_reach_the_application_of_their_path(self):
+        calls = []
+
+        def application(name):
+            def wsgi(environ, start_response):
+                calls.append((name, environ["PATH_INFO"]))
+                return []
+
+            async def asgi(scope, receive, send):
+                calls.append((name, scope.get("path", scope["type"])))
+
+            return wsgi, asgi
+
+        (full_wsgi, full_asgi), (api_wsgi, api_asgi) = application("full"), application("api")
+        wsgi = WSGIDispatcher(full_wsgi, api_wsgi, "/research/", ["/research/admin/"])
+        asgi = ASGIDispatcher(full_asgi, api_asgi, "/research/", ["/research/admin/"])
+        wsgi({"PATH_INFO": "/research/llm-engine"}, None)
+        wsgi({"PATH_INFO": "/research/admin/"}, None)
+        asyncio.run(asgi({"type": "http", "path": "/research/llm-engine"}, None, None))
+        asyncio.run(asgi({"type": "http", "path": "/research/admin/"}, None, None))
+        asyncio.run(asgi({"type": "lifespan"}, None, None))
+
+        self.assertEqual(calls, [("api", "/research/llm-engine"), ("full", "/research/admin/"),
+                                 ("api", "/research/llm-engine"), ("full", "/research/admin/"),
+                                 ("full", "lifespan")])
+
+    def test_only_non_api_paths_run_the_full_middleware_chain(self):
+        middleware = list(settings.MIDDLEWARE)
+        application = api_wsgi_application()
+        self.assertEqual(settings.MIDDLEWARE, middleware)
+
+        admin = self.wsgi_get(application, "/research/admin/login/")
+        self.assertEqual(admin["X-Frame-Options"], "DENY")
+        self.assertIn("csrftoken=", admin["Set-Cookie"])
+        self.assertIn("Server-Timing", admin)
+
+        api = self.wsgi_get(application, "/research/ready")
+        self.assertNotIn("X-Frame-Options", api)
+        self.assertNotIn("Set-Cookie", api)
+        self.assertIn("Server-Timing", api)
+
+
+class FlakyModel:
+    """A model whose first ``failures`` calls are rate limited, noting how many gate slots were taken meanwhile."""
+
+    def __init__(self, gate, failures=1):
+        self.gate = gate
+        self.failures = failures
+        self.active = []
+
+    def attempt(self):
+        self.active.append(self.gate.stats()["active"])
+        if self.failures:
+            self.failures -= 1
+            raise RateLimitError("rate limited")
+
+    def invoke(self, input, config=None, **kwargs):
+        self.attempt()
+        return "answer"
+
+    def stream(self, input, config=None, **kwargs):
+        self.attempt()
+        yield "ans"
+        yield "wer"
+
+
+class GatedModelTests(SimpleTestCase):
+
+    def setUp(self):
+        self.gate = LLMGate(max_calls=1, max_tries=3, max_retry_time=5.0)
+        self.backoff_active = []
+        on_backoff = self.gate._on_backoff
+        self.gate._on_backoff = lambda details: (self.backoff_active.append(self.gate.stats()["active"]),
+                                                 on_backoff(details))
+
+    def test_the_slot_is_given_back_between_attempts(self):
+        model = FlakyModel(self.gate)
+        self.assertEqual(GatedModel(bound=model, gate=self.gate).invoke("hi"), "answer")
+
+        self.assertEqual(model.active, [1, 1])
+        self.assertEqual(self.backoff_active, [0])
+        self.assertEqual(self.gate.stats()["retries"], 1)
+        self.assertEqual(self.gate.stats()["active"], 0)
+
+    def test_a_stream_keeps_its_slot_until_the_last_chunk(self):
+        model = FlakyModel(self.gate)
+        chunks = GatedModel(bound=model, gate=self.gate).stream("hi")
+        self.assertEqual(next(chunks), "ans")
+        self.assertEqual(self.backoff_active, [0])
+        self.assertEqual(self.gate.stats()["active"], 1)
+        self.assertEqual(list(chunks), ["wer"])
+        self.assertEqual(self.gate.stats()["active"], 0)
+
+    def test_the_summarizer_goes_through_the_gate(self):
+        with fake_agent_chain() as model:
+            self.assertIsInstance(views.memory_summarizer.llm, GatedModel)
+            self.assertIs(views.memory_summarizer.llm.bound, model)
+            self.assertIs(views.memory_summarizer.llm.gate, views.llm_gate)
+
+
+class ServiceRequestTests(TransactionTestCase):
+    # the writer runs in autocommit, a failed INSERT would poison TestCase's transaction
+
+    def setUp(self):
+        self.writer = ServiceRequestWriter(buffered=False)
+        self.rooms = [self.writer.record("default", "book_room", 101, {"mobile_no": f"0170000000{n}"})
+                      for n in range(3)]
+
+    def get(self, **params):
+        return self.client.get("/research/service-requests", params)
+
+    def test_only_staff_see_the_list(self):
+        self.assertEqual(self.get().status_code, 403)
+        self.client.force_login(User.objects.create_user("guest"))
+        self.assertEqual(self.get().status_code, 403)
+        self.client.force_login(User.objects.create_user("desk", is_staff=True))
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["id"] for row in response.json()["requests"]], [room.id for room in self.rooms])
+
+    def test_the_list_is_served_outside_api_mode(self):
+        api = settings.LLM_API_MODE
+        dispatcher = PathDispatcher(None, None, api["PREFIX"], api["EXCLUDE"])
+        self.assertFalse(dispatcher.is_api("/research/service-requests"))
+        self.assertTrue(dispatcher.is_api("/research/llm-engine"))
+
+    def test_limits_are_clamped_and_checked(self):
+        self.client.force_login(User.objects.create_user("desk", is_staff=True))
+        for limit in ("0", "-1"):
+            data = self.get(limit=limit).json()
+            self.assertEqual([row["id"] for row in data["requests"]], [self.rooms[0].id])
+            self.assertEqual(data["next"], self.rooms[0].id)
+        self.assertEqual(self.get(limit="all").status_code, 400)
+
+    def test_a_failing_batch_is_written_row_by_row(self):
+        writer = ServiceRequestWriter(buffered=True)
+        # the first is already written, so the batch's INSERT fails on it
+        batch = [self.rooms[0]] + [ServiceRequest(id=writer.next_id(), service="extra_towel", room_number=101,
+                                                  created_at=timezone.now()) for _ in range(2)]
+        writer._pending.update((request.id, request) for request in batch)
+
+        with self.assertLogs("research.service_requests", "ERROR"):
+            self.assertEqual(writer.flush(), 2)
+
+        self.assertEqual(ServiceRequest.objects.filter(service="extra_towel").count(), 2)
+        stats = writer.stats()
+        self.assertEqual((stats["pending"], stats["written"], stats["errors"], stats["dropped"]), (0, 2, 1, 1))
+
+    def test_background_flushes_close_their_connection(self):
+        writer = ServiceRequestWriter(buffered=True, flush_interval=0.01)
+        # the flusher thread outlives the test, let it sleep
+        self.addCleanup(setattr, writer, "flush_interval", 3600)
+        closed = []
+        with mock.patch("research.service_requests.close_old_connections",
+                        lambda: closed.append(threading.current_thread().name)):
+            request = writer.record("default", "extra_towel", 101, {})
+            wait_until(lambda: writer.stats()["written"] == 1 and len(closed) >= 2)
+
+        self.assertTrue(ServiceRequest.objects.filter(pk=request.id).exists())
+        self.assertEqual(set(closed), {"service-request-writer"})
+
+
+class RoomlessGuestTests(TestCase):
+
+    def setUp(self):
+        self.writer = ServiceRequestWriter(buffered=False)
+        # a row without a room, as the ledger could hold before rooms were required
+        self.roomless = ServiceRequest.objects.create(id=self.writer.next_id(), service="request_room_amenity",
+                                                      details={"requested_amenity": "towel"},
+                                                      created_at=timezone.now())
+
+    def test_tools_acting_for_a_room_are_refused(self):
+        recorded = service_request_writer.stats()["recorded"]
+        with guest_context(hotels.guest(None, None)):
+            with self.assertRaises(InvalidGuest):
+                methods.request_room_amenity.invoke({"requested_amenity": "towel"})
+            with self.assertRaises(InvalidGuest):
+                methods.service_status_checker.invoke({})
+            with self.assertRaises(InvalidGuest):
+                methods.service_status_checker.invoke({"service_id": self.roomless.id})
+        self.assertEqual(service_request_writer.stats()["recorded"], recorded)
+
+    def test_roomless_guests_do_not_see_each_others_requests(self):
+        guest = hotels.guest(None, None)
+        self.assertIsNone(self.writer.get(self.roomless.id, guest))
+        self.assertEqual(self.writer.recent(guest), [])
+
+    def test_a_routed_request_without_a_room_is_a_bad_request(self):
+        rows = ServiceRequest.objects.count()
+        with fake_agent_chain():
+            response = self.client.post("/research/llm-engine", {"query": "send a towel", "session_id": "roomless"},
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()["success"])
+        service_request_writer.flush()
+        self.assertEqual(ServiceRequest.objects.count(), rows)
+
+
+def conversation(*turns):
+    memory = new_memory()
+    for question, answer in turns:
+        memory.save_context({"question": question}, {"output": answer})
+    return memory
+
+
+class LocalSessionStoreTests(SimpleTestCase):
+
+    def test_least_recently_used_session_is_evicted(self):
+        store = LocalSessionStore(max_entries=2)
+        for session_id in ("a", "b"):
+            store.save(session_id, conversation(("hi", session_id)))
+        store.get("a")
+        store.save("c", conversation(("hi", "c")))
+
+        self.assertEqual(list(store._entries), ["a", "c"])
+        self.assertEqual(store.stats()["evictions"], 1)
+        self.assertEqual(store.get("b").chat_memory.messages, [])
+
+    def test_sessions_that_are_never_saved_are_capped_too(self):
+        store = LocalSessionStore(max_entries=3)
+        for n in range(100):
+            store.get(f"unsaved-{n}")
+        self.assertEqual(store.stats()["entries"], 3)
+        self.assertEqual(store.stats()["evictions"], 97)
+
+    def test_idle_sessions_expire(self):
+        store = LocalSessionStore(ttl=60)
+        with mock.patch("research.sessions.time.monotonic", return_value=1000.0):
+            store.save("idle", conversation(("hi", "hello")))
+        with mock.patch("research.sessions.time.monotonic", return_value=1059.0):
+            self.assertEqual(len(store.get("idle").chat_memory.messages), 2)
+        with mock.patch("research.sessions.time.monotonic", return_value=1120.0):
+            self.assertEqual(store.get("idle").chat_memory.messages, [])
+        self.assertEqual(store.stats()["expirations"], 1)
+
+    def test_byte_cap_counts_the_compressed_conversations(self):
+        blob = len(dump_messages(conversation(("hi", "a")).chat_memory.messages))
+        store = LocalSessionStore(max_bytes=2 * blob)
+        for session_id in "abc":
+            store.save(session_id, conversation(("hi", session_id)))
+
+        self.assertEqual(list(store._entries), ["b", "c"])
+        self.assertEqual(store.stats()["bytes"], 2 * blob)
+
+    def test_cold_sessions_are_rebuilt_from_their_blob(self):
+        store = LocalSessionStore(hot_entries=1)
+        first = conversation(("when is breakfast", "From 7 to 10."))
+        store.save("cold", first)
+        store.save("hot", conversation(("hi", "hello")))
+
+        self.assertIsNone(store._entries["cold"].memory)
+        rebuilt = store.get("cold")
+        self.assertIsNot(rebuilt, first)
+        self.assertEqual(rebuilt.chat_memory.messages, first.chat_memory.messages)
+        self.assertEqual(store.stats()["hot_entries"], 1)
+        self.assertIsNone(store._entries["hot"].memory)
+
+
+class CacheSessionStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.store = CacheSessionStore(key_prefix="test-session", ttl=60)
+
+    def tearDown(self):
+        caches["default"].clear()
+
+    def test_sessions_round_trip_in_one_call_each_way(self):
+        self.store.save_many({"a": conversation(("hi", "a")), "b": conversation(("hi", "b"), ("and?", "b2"))})
+        with mock.patch.object(caches["default"], "get_many", wraps=caches["default"].get_many) as get_many:
+            memories = self.store.get_many(["a", "b", "new"])
+
+        get_many.assert_called_once()
+        self.assertEqual([len(memories[key].chat_memory.messages) for key in ("a", "b", "new")], [2, 4, 0])
+        self.assertEqual(memories["b"].chat_memory.messages[-1].content, "b2")
+        self.assertEqual((self.store.hits, self.store.misses), (2, 1))
+
+    def test_the_ttl_is_the_cache_timeout(self):
+        with mock.patch("time.time", return_value=1000.0):
+            self.store.save("idle", conversation(("hi", "hello")))
+        with mock.patch("time.time", return_value=1059.0):
+            self.assertEqual(len(self.store.get("idle").chat_memory.messages), 2)
+        with mock.patch("time.time", return_value=1061.0):
+            self.assertEqual(self.store.get("idle").chat_memory.messages, [])
+
+
+class DatabaseSessionStoreTests(TestCase):
+
+    def setUp(self):
+        self.store = DatabaseSessionStore(ttl=60, purge_every=2)
+
+    def test_sessions_round_trip_in_one_query_each_way(self):
+        with self.assertNumQueries(1):
+            self.store.save_many({"a": conversation(("hi", "a")), "b": conversation(("hi", "b"))})
+        self.store.save("a", conversation(("hi", "a"), ("and?", "a2")))
+        with self.assertNumQueries(1):
+            memories = self.store.get_many(["a", "b", "new"])
+
+        self.assertEqual([len(memories[key].chat_memory.messages) for key in ("a", "b", "new")], [4, 2, 0])
+        self.assertEqual(memories["a"].chat_memory.messages[-1].content, "a2")
+
+    def test_idle_sessions_are_ignored_then_purged(self):
+        self.store.save("idle", conversation(("hi", "idle")))
+        ChatSession.objects.filter(session_id="idle").update(
+            updated_at=timezone.now() - datetime.timedelta(seconds=61))
+        self.assertEqual(self.store.get("idle").chat_memory.messages, [])
+        self.assertTrue(ChatSession.objects.filter(session_id="idle").exists())
+
+        # the second save purges
+        self.store.save("active", conversation(("hi", "active")))
+        self.assertFalse(ChatSession.objects.filter(session_id="idle").exists())
+        self.assertEqual(self.store.stats()["expirations"], 1)
+        self.assertEqual(len(self.store.get("active").chat_memory.messages), 2)
+
+    def test_every_sqlite_connection_is_switched_to_wal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            default = connections["default"]
+            connection = type(default)({**default.settings_dict, "NAME": str(Path(directory) / "wal.sqlite3")},
+                                       alias="wal-test")
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode")
+                    self.assertEqual(cursor.fetchone()[0], "wal")
+            finally:
+                connection.close()
+
+
+class BlockingSummaryModel:
+    """Summarizes once ``release`` is set, noting the threads it was called on."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.threads = []
+
+    def invoke(self, input, config=None, **kwargs):
+        self.threads.append(threading.current_thread().name)
+        self.release.wait(5)
+        return AIMessage(content="The guest asked about breakfast and the pool.")
+
+
+class TokenBudgetMemoryTests(SimpleTestCase):
+    turns = [("When is breakfast?", "From 7 to 10."),
+             ("When does the pool close?", "At 9 in the evening."),
+             ("Is parking free?", "Yes, in the basement garage.")]
+
+    def test_the_window_keeps_the_latest_messages_within_budget(self):
+        memory = conversation(*self.turns)
+        messages = memory.chat_memory.messages
+        memory.max_tokens = sum(memory.tokens(message) for message in messages[-2:])
+
+        summary, overflow, window = memory.split()
+        self.assertIsNone(summary)
+        self.assertEqual((overflow, window), (messages[:4], messages[4:]))
+        self.assertEqual(memory.buffer_as_messages, messages[4:])
+
+        # room for one more message would open the window on an answer, so it is left out
+        memory.max_tokens += memory.tokens(messages[3])
+        self.assertEqual(memory.split()[2], messages[4:])
+        memory.max_tokens = 1
+        self.assertEqual(memory.split()[2], messages[5:])
+
+    def test_a_folded_summary_leads_the_prompt(self):
+        memory = conversation(*self.turns)
+        messages = list(memory.chat_memory.messages)
+        memory.max_tokens = sum(memory.tokens(message) for message in messages[-2:])
+        _, overflow, _ = memory.split()
+
+        self.assertTrue(memory.fold(overflow, "Breakfast and pool hours were given."))
+        summary = memory.summary
+        self.assertEqual(summary.content, SUMMARY_PREFIX + "Breakfast and pool hours were given.")
+        self.assertEqual(memory.chat_memory.messages, [summary] + messages[4:])
+        # the summary takes its share of the budget, the latest message is still kept
+        self.assertEqual(memory.buffer_as_messages, [summary, messages[5]])
+        self.assertFalse(memory.fold(overflow, "Stale."))
+        self.assertIs(memory.summary, summary)
+
+
+class MemorySummarizerTests(SimpleTestCase):
+
+    def test_compact_summarizes_off_the_request_path(self):
+        memory = conversation(*TokenBudgetMemoryTests.turns)
+        messages = list(memory.chat_memory.messages)
+        memory.max_tokens = sum(memory.tokens(message) for message in messages[-2:])
+        model = BlockingSummaryModel()
+        summarizer = MemorySummarizer(llm=model)
+        self.addCleanup(summarizer._executor.shutdown)
+
+        # the model is still blocked, yet neither save waits for it or queues a second summary
+        summarizer.compact("summarized", memory)
+        summarizer.compact("summarized", memory)
+        self.assertEqual(memory.chat_memory.messages, messages)
+        self.assertEqual(summarizer.stats()["pending"], 1)
+
+        model.release.set()
+        summarizer._executor.submit(lambda: None).result()
+        summarizer.compact("summarized", memory)
+
+        self.assertEqual(memory.summary.content, SUMMARY_PREFIX + "The guest asked about breakfast and the pool.")
+        self.assertEqual(memory.chat_memory.messages[1:], messages[4:])
+        # the summary takes part of the budget, so the question left out is queued in turn
+        summarizer._executor.submit(lambda: None).result()
+        stats = summarizer.stats()
+        self.assertEqual((stats["summaries"], stats["folds"], stats["pending"]), (2, 1, 0))
+        self.assertEqual(len(model.threads), 2)
+        self.assertTrue(all(name.startswith("memory-summarizer") for name in model.threads))
+
+    def test_without_a_model_the_overflow_is_capped(self):
+        memory = conversation(*TokenBudgetMemoryTests.turns)
+        messages = list(memory.chat_memory.messages)
+        memory.max_tokens = 1
+        summarizer = MemorySummarizer(max_pending=2)
+        self.addCleanup(summarizer._executor.shutdown)
+
+        summarizer.compact("unsummarized", memory)
+        self.assertEqual(memory.chat_memory.messages, messages[3:])
+        self.assertEqual(summarizer.stats()["dropped"], 3)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_unresolved_urls_share_one_series(self):
+        for path in ("/research/nope-1", "/research/nope-2"):
+            self.assertEqual(self.client.get(path).status_code, 404)
+        views = {dict(key)["view"] for key in REQUEST_SECONDS._series}
+        self.assertIn("unmatched", views)
+        self.assertFalse([view for view in views if "nope" in view])
+
+    def test_label_values_are_escaped(self):
+        histogram = Histogram("test_seconds", "Test.")
+        histogram.observe(0.1, tool='say "hi"\\now\n')
+        self.assertIn('tool="say \\"hi\\"\\\\now\\n",le="+Inf"} 1', histogram.render())
+
+
+class BreakingChatModel(FakeChatModel):
+    """``FakeChatModel`` whose streams fail after their last token."""
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+            yield chunk
+        raise ValueError("connection reset")
+
+
+class StubModel:
+    """Answers every call with ``answer``, or raises ``error``, counting the calls."""
+
+    def __init__(self, answer="The answer.", error=None):
+        self.answer = answer
+        self.error = error
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return AIMessage(content=self.answer)
+
+    def stream(self, input, config=None, **kwargs):
+        yield self.invoke(input, config, **kwargs)
+
+
+class TieredModelTests(SimpleTestCase):
+
+    def tiered(self, fast):
+        self.strong = StubModel("The strong answer.")
+        self.tiers = ModelTiers(enabled=True)
+        return TieredModel(fast=fast, strong=self.strong, tiers=self.tiers, tools={})
+
+    def test_a_failed_fast_call_is_escalated(self):
+        model = self.tiered(StubModel(error=ValueError("connection reset")))
+        self.assertEqual(model.invoke([HumanMessage(content="hello")]).content, "The strong answer.")
+        self.assertEqual(list(model.stream([HumanMessage(content="hello")]))[-1].content, "The strong answer.")
+        self.assertEqual(self.tiers.stats()["escalations"], {"error": 2})
+
+    def test_calls_the_gate_turned_away_are_not_escalated(self):
+        for error in (Overloaded("The assistant is busy", 1.0), RateLimited("Slow down", 1.0)):
+            model = self.tiered(StubModel(error=error))
+            with self.subTest(type(error).__name__):
+                with self.assertRaises(type(error)):
+                    model.invoke([HumanMessage(content="hello")])
+                with self.assertRaises(type(error)):
+                    list(model.stream([HumanMessage(content="hello")]))
+                self.assertEqual(self.strong.calls, 0)
+                self.assertEqual(self.tiers.stats()["escalations"], {})
+
+
+class TieredStreamTests(TestCase):
+
+    async def stream(self, fast):
+        with mock.patch.object(views, "model_tiers", ModelTiers(enabled=True)), \
+                fake_agent_chain(responses=["The strong answer."]) as strong:
+            views.set_agent_model(strong, fast)
+            response = await self.async_client.post(
+                "/research/llm-engine/stream", {"query": "hello", "session_id": "tiered-stream", "room": 101},
+                content_type="application/json")
+            events = sse_events(b"".join([chunk async for chunk in response.streaming_content]))
+            return events, views.model_tiers.stats()
+
+    async def test_an_escalated_fast_answer_never_reaches_the_guest(self):
+        events, stats = await self.stream(BreakingChatModel(responses=["The fast answer."]))
+
+        self.assertEqual("".join(data["token"] for event, data in events if event == "token"), "The strong answer.")
+        self.assertEqual(events[-1][1]["data"]["answer"], "The strong answer.")
+        self.assertEqual(stats["escalations"], {"error": 1})
+
+    async def test_a_fast_answer_that_stands_is_streamed(self):
+        events, stats = await self.stream(FakeChatModel(responses=["The fast answer."]))
+
+        self.assertEqual("".join(data["token"] for event, data in events if event == "token"), "The fast answer.")
+        self.assertEqual(events[-1][1]["data"]["answer"], "The fast answer.")
+        self.assertEqual(stats["escalations"], {})
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting")
+        time.sleep(0.005)
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def test_identical_concurrent_calls_share_one(self):
+        release = threading.Event()
+        calls = []
+
+        @coalesce
+        def lookup(budget):
+            calls.append(budget)
+            release.wait(2)
+            return f"rooms under {budget}"
+
+        with ThreadPoolExecutor(4) as pool:
+            same = [pool.submit(lookup, 1000) for _ in range(3)]
+            wait_until(lambda: lookup.flight.stats()["shared"] == 2)
+            other = pool.submit(lookup, 500)
+            wait_until(lambda: len(calls) == 2)
+            release.set()
+            self.assertEqual([future.result() for future in same], ["rooms under 1000"] * 3)
+            self.assertEqual(other.result(), "rooms under 500")
+
+        self.assertEqual(sorted(calls), [500, 1000])
+        self.assertEqual(lookup.flight.stats()["in_flight"], 0)
+
+    def test_the_leaders_error_reaches_its_followers(self):
+        flight = SingleFlight("test-errors")
+        release = threading.Event()
+        calls = []
+
+        def fail():
+            calls.append(1)
+            release.wait(2)
+            raise ConnectionError("upstream down")
+
+        with ThreadPoolExecutor(3) as pool:
+            futures = [pool.submit(flight.do, "key", fail) for _ in range(3)]
+            wait_until(lambda: flight.stats()["shared"] == 2)
+            release.set()
+            for future in futures:
+                with self.assertRaisesMessage(ConnectionError, "upstream down"):
+                    future.result()
+        self.assertEqual(len(calls), 1)
+
+    def test_identical_model_calls_share_one_request(self):
+        model = FakeChatModel(responses=["Breakfast is from 7 to 10."], latency=0.2)
+        shared = SingleFlightModel(bound=model, flight=SingleFlight("test-model"))
+
+        with ThreadPoolExecutor(2) as pool:
+            answers = list(pool.map(shared.invoke, ["When is breakfast?"] * 2))
+
+        self.assertEqual([answer.content for answer in answers], ["Breakfast is from 7 to 10."] * 2)
+        self.assertEqual(model.i, 1)
+
+    def test_followers_call_for_themselves_when_the_leader_abandons(self):
+        model = FakeChatModel(responses=["Breakfast is from 7 to 10."], token_latency=0.01)
+        shared = SingleFlightModel(bound=model, flight=SingleFlight("test-abandoned"))
+
+        stream = shared.stream("When is breakfast?")
+        next(stream)
+        with ThreadPoolExecutor(1) as pool:
+            follower = pool.submit(shared.invoke, "When is breakfast?")
+            wait_until(lambda: shared.flight.stats()["shared"] == 1)
+            # the client went away mid-stream
+            stream.close()
+            self.assertEqual(follower.result(timeout=2).content, "Breakfast is from 7 to 10.")
+
+        self.assertEqual(model.i, 2)
+        self.assertEqual(shared.flight.stats()["in_flight"], 0)
+
+
+class RecordingEmbeddings(FakeEmbeddings):
+    """``FakeEmbeddings`` that records the batches it is sent and can be held or made to fail."""
+
+    def __init__(self, size=64, error=None):
+        super().__init__(size)
+        self.batches = []
+        self.error = error
+        self.release = threading.Event()
+        self.release.set()
+
+    def embed_documents(self, texts):
+        self.release.wait(5)
+        self.batches.append(list(texts))
+        if self.error is not None:
+            raise self.error
+        return super().embed_documents(texts)
+
+
+class BatchedEmbeddingsTests(SimpleTestCase):
+
+    def test_concurrent_misses_are_sent_together(self):
+        model = RecordingEmbeddings()
+        embeddings = BatchedEmbeddings(model, batch_size=64, batch_wait=0.2)
+        texts = [f"question {i}" for i in range(20)]
+        with ThreadPoolExecutor(20) as pool:
+            vectors = list(pool.map(embeddings.embed_query, texts))
+
+        self.assertEqual(vectors, FakeEmbeddings(64).embed_documents(texts))
+        self.assertLess(len(model.batches), len(texts))
+        self.assertEqual(sorted(text for batch in model.batches for text in batch), sorted(texts))
+
+    def test_a_text_being_embedded_is_sent_once(self):
+        model = RecordingEmbeddings()
+        model.release.clear()
+        embeddings = BatchedEmbeddings(model, batch_wait=0.0)
+        with ThreadPoolExecutor(5) as pool:
+            futures = [pool.submit(embeddings.embed_query, "late checkout") for _ in range(5)]
+            model.release.set()
+            vectors = [future.result() for future in futures]
+
+        self.assertEqual(len({tuple(vector) for vector in vectors}), 1)
+        self.assertEqual([text for batch in model.batches for text in batch], ["late checkout"])
+
+    def test_least_recently_used_vector_is_evicted(self):
+        model = RecordingEmbeddings()
+        embeddings = BatchedEmbeddings(model, cache_size=2, batch_wait=0.0)
+        for text in ["a", "b", "a", "c", "a", "b"]:
+            embeddings.embed_query(text)
+
+        # "a" stayed cached as it was used, "b" went when "c" came in
+        self.assertEqual(model.batches, [["a"], ["b"], ["c"], ["b"]])
+        self.assertEqual(embeddings.stats(), {"hits": 2, "misses": 4, "batches": 4, "cached": 2})
+
+    def test_an_error_reaches_every_caller_of_the_batch_and_is_not_cached(self):
+        model = RecordingEmbeddings(error=RuntimeError("embedding service down"))
+        model.release.clear()
+        embeddings = BatchedEmbeddings(model, batch_wait=0.1)
+        with ThreadPoolExecutor(3) as pool:
+            futures = [pool.submit(embeddings.embed_query, text) for text in ["a", "b", "a"]]
+            model.release.set()
+            for future in futures:
+                with self.assertRaisesMessage(RuntimeError, "embedding service down"):
+                    future.result()
+
+        model.error = None
+        self.assertEqual(embeddings.embed_query("a"), FakeEmbeddings(64).embed_query("a"))
+        self.assertEqual(embeddings.stats()["cached"], 1)
+
+
+class BlockingIndex(InMemoryVectorIndex):
+    """An ``InMemoryVectorIndex`` whose queries wait for ``release``."""
+
+    def __init__(self, dimension):
+        super().__init__(dimension)
+        self.release = threading.Event()
+        self.queries = 0
+
+    def query(self, vector, k=3):
+        self.queries += 1
+        self.release.wait(5)
+        return super().query(vector, k)
+
+
+class RetrieverTests(SimpleTestCase):
+    passages = ["Breakfast is served from 7 to 10 in the garden restaurant.",
+                "The pool on the roof is open until 9 in the evening.",
+                "Parking is free for guests in the basement garage."]
+
+    def retriever(self, index=None, **kwargs):
+        embeddings = FakeEmbeddings(64)
+        index = InMemoryVectorIndex(64) if index is None else index
+        index.upsert(range(len(self.passages)), embeddings.embed_documents(self.passages), self.passages)
+        return Retriever(embeddings, index, **kwargs)
+
+    def test_passages_under_min_score_are_dropped(self):
+        retriever = self.retriever(top_k=3, min_score=0.3)
+        self.assertEqual(retriever.prefetch("When is breakfast served?").passages(), [self.passages[0]])
+        self.assertEqual(len(self.retriever(top_k=3, min_score=0.0).search("When is breakfast served?")), 3)
+
+    def test_a_slow_index_times_out_to_no_passages(self):
+        index = BlockingIndex(64)
+        retriever = self.retriever(index, timeout=0.05)
+        try:
+            with self.assertLogs("research.retrieval", "WARNING"):
+                self.assertEqual(retriever.prefetch("Is there parking?").passages(), [])
+        finally:
+            index.release.set()
+
+    def test_cancelled_prefetch_never_queries_the_index(self):
+        index = BlockingIndex(64)
+        retriever = self.retriever(index, max_workers=1)
+        running = retriever.prefetch("Is there parking?")
+        queued = retriever.prefetch("When does the pool close?")
+        queued.cancel()
+        index.release.set()
+
+        self.assertEqual(running.passages()[0], self.passages[2])
+        self.assertTrue(queued.future.cancelled())
+        with self.assertLogs("research.retrieval", "WARNING"):
+            self.assertEqual(queued.passages(), [])
+        self.assertEqual(index.queries, 1)
+
+
+class MemmapVectorIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        rng = np.random.default_rng(1)
+        self.centers = rng.normal(size=(20, 32))
+        self.vectors = self.clustered(rng, 2000)
+        self.queries = self.clustered(rng, 50)
+
+    def clustered(self, rng, count):
+        return self.centers[rng.integers(0, 20, count)] + 0.3 * rng.normal(size=(count, 32))
+
+    def index(self, n_probe=4):
+        index = MemmapVectorIndex(self.directory, dimension=32, n_probe=n_probe)
+        if not len(index):
+            index.upsert([f"id{i}" for i in range(len(self.vectors))], self.vectors,
+                         [f"text{i}" for i in range(len(self.vectors))])
+        return index
+
+    def top_texts(self, index, k=10):
+        return [{text for text, _ in index.query(query, k=k)} for query in self.queries]
+
+    def test_ivf_recall_is_close_to_exact_search(self):
+        index = self.index()
+        exact = self.top_texts(index)
+        index.build_ivf(n_lists=40)
+
+        recall = np.mean([len(found & wanted) / 10 for found, wanted in zip(self.top_texts(index), exact)])
+        self.assertGreaterEqual(recall, 0.9)
+        index.n_probe = 40
+        self.assertEqual(self.top_texts(index), exact)
+
+    def test_rows_upserted_after_the_build_are_found(self):
+        index = self.index()
+        index.build_ivf(n_lists=40)
+        index.upsert(["new", "id7"], self.queries[:2], ["new text", "replaced text"])
+
+        self.assertEqual(len(index), len(self.vectors) + 1)
+        self.assertEqual(len(index._assignments), len(index))
+        self.assertEqual(index.query(self.queries[0], k=1)[0][0], "new text")
+        self.assertEqual(index.query(self.queries[1], k=1)[0][0], "replaced text")
+        self.assertNotIn("text7", {text for text, _ in index.query(self.vectors[7], k=5)})
+
+    def test_a_second_instance_sees_writes_made_through_another(self):
+        writer = self.index()
+        reader = MemmapVectorIndex(self.directory, dimension=32)
+        self.assertEqual(len(reader), len(self.vectors))
+
+        writer.build_ivf(n_lists=40)
+        writer.upsert(["new"], self.queries[:1], ["new text"])
+
+        self.assertEqual(reader.query(self.queries[0], k=1)[0][0], "new text")
+        self.assertEqual(len(reader), len(self.vectors) + 1)
+        self.assertEqual(len(reader._centroids), 40)
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = ResponseCache(ttl=60)
+        cache.put("When is breakfast?", "ctx", "From 7 to 10.")
+        self.assertEqual(cache.get_exact("when is breakfast", "ctx"), "From 7 to 10.")
+        with mock.patch("research.response_cache.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get_exact("When is breakfast?", "ctx"))
+
+    def test_the_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put("breakfast", "ctx", "From 7 to 10.")
+        cache.put("pool", "ctx", "Until 9.")
+        cache.get_exact("breakfast", "ctx")
+        cache.put("parking", "ctx", "In the basement.")
+
+        self.assertIsNone(cache.get_exact("pool", "ctx"))
+        self.assertEqual(cache.get_exact("breakfast", "ctx"), "From 7 to 10.")
+        self.assertEqual(cache.get_exact("parking", "ctx"), "In the basement.")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_the_semantic_tier_respects_its_threshold(self):
+        # bags of words: 4 shared words out of 4 and 5, a cosine of 0.894
+        question, rephrased = "When is breakfast served?", "When is breakfast served today?"
+        for threshold, hit in ((0.85, True), (0.9, False)):
+            cache = ResponseCache(similarity_threshold=threshold, embedder=FakeEmbeddings(1024))
+            _, vector = cache.get(question, "ctx")
+            cache.put(question, "ctx", "From 7 to 10.", vector)
+
+            self.assertEqual(cache.get(rephrased, "ctx")[0], "From 7 to 10." if hit else None, threshold)
+            self.assertIsNone(cache.get(rephrased, "other ctx")[0])
+
+
+class ResponseCacheTurnTests(TransactionTestCase):
+    # stateful tools record a service request through the buffered writer
+
+    def post(self, query, session_id):
+        response = self.client.post("/research/llm-engine", {"query": query, "session_id": session_id, "room": 404},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_turns_calling_stateful_tools_are_never_cached(self):
+        amenity = {"name": "request_room_amenity", "arguments": {"requested_amenity": "pillow"}}
+        with fake_agent_chain(response_cache=True, responses=[amenity]) as model, \
+                mock.patch.object(views.intent_router, "enabled", False):
+            for n in range(2):
+                data = self.post("one more pillow for the cache test", f"cache-stateful-{n}")
+                self.assertEqual(data["function"]["function-name"], "request_room_amenity")
+        service_request_writer.flush()
+
+        self.assertEqual(model.i, 2)
+        self.assertEqual(ServiceRequest.objects.filter(service="request_room_amenity", room_number=404).count(), 2)
+
+    def test_stateless_lookups_are_cached(self):
+        with fake_agent_chain(response_cache=True, responses=[LOAD_RESPONSES[1]]) as model, \
+                mock.patch.object(views.intent_router, "enabled", False):
+            for n in range(2):
+                data = self.post("rooms under 1000 for the cache test", f"cache-stateless-{n}")
+                self.assertEqual(data["function"]["function-name"], "room_recommendation")
+
+        self.assertEqual(model.i, 1)
+
+
+class IngestTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.documents = self.directory / "documents"
+        self.documents.mkdir()
+        (self.documents / "pool.txt").write_text("The pool is open until 9pm.")
+        (self.documents / "faq.jsonl").write_text(
+            json.dumps({"chunk": "Breakfast is served from 7 to 10."}) + "\n"
+            + json.dumps({"chunk": "The pool is open until 9pm."}) + "\n")
+
+    def ingest(self, embeddings=None, checkpoint="checkpoint.txt", **kwargs):
+        index = InMemoryVectorIndex(64)
+        ingestor = Ingestor(index, embeddings or RecordingEmbeddings(), Checkpoint(self.directory / checkpoint),
+                            requests_per_minute=0, **kwargs)
+        return index, ingestor.run([self.documents])
+
+    def test_duplicate_and_checkpointed_chunks_are_skipped(self):
+        index, stats = self.ingest()
+        self.assertEqual((stats["documents"], stats["chunks"], stats["skipped"], stats["upserted"]), (3, 3, 1, 2))
+        self.assertEqual(sorted(index.texts), ["Breakfast is served from 7 to 10.", "The pool is open until 9pm."])
+
+        (self.documents / "spa.md").write_text("The spa opens at 10am.")
+        index, stats = self.ingest()
+        self.assertEqual((stats["skipped"], stats["upserted"]), (3, 1))
+        self.assertEqual(index.texts, ["The spa opens at 10am."])
+
+    def test_rate_limits_are_retried(self):
+        from openai import error
+
+        class RateLimitedOnce(RecordingEmbeddings):
+            def embed_documents(self, texts):
+                if not self.batches:
+                    self.batches.append(None)
+                    raise error.RateLimitError("slow down")
+                return super().embed_documents(texts)
+
+        index, stats = self.ingest(RateLimitedOnce())
+        self.assertEqual(stats["upserted"], 2)
+
+    def test_other_errors_are_not_retried(self):
+        from openai import error
+
+        embeddings = RecordingEmbeddings(error=error.AuthenticationError("bad key"))
+        with self.assertRaises(error.AuthenticationError):
+            self.ingest(embeddings, max_tries=6)
+        self.assertEqual(len(embeddings.batches), 1)
+        self.assertFalse((self.directory / "checkpoint.txt").exists())
+
+    def test_command_checkpoint_goes_with_the_local_index(self):
+        config = {"BACKEND": "memmap", "INDEX_NAME": "hotel", "PATH": self.directory / "vectorstore",
+                  "DIMENSION": 64, "N_PROBE": 8}
+
+        def run():
+            out = StringIO()
+            call_command("ingest_documents", str(self.documents), "--fake-embeddings", stdout=out)
+            return json.loads(out.getvalue())
+
+        with override_settings(LLM_VECTORSTORE=config):
+            self.assertEqual(run()["upserted"], 2)
+            self.assertEqual(run()["upserted"], 0)
+            self.assertTrue((config["PATH"] / "ingest-checkpoint.txt").exists())
+            # a deleted index is rebuilt in full, not skipped by a leftover checkpoint
+            shutil.rmtree(config["PATH"])
+            self.assertEqual(run()["upserted"], 2)
+
+
+class WeatherClientTests(SimpleTestCase):
+
+    def server(self, **kwargs):
+        server = FakeOpenMeteoServer(**kwargs).__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        return server
+
+    def test_forecasts_are_cached_per_rounded_location(self):
+        server = self.server()
+        client = WeatherClient(base_url=server.url, precision=2)
+        first = client.forecast(6.92711, 79.86121)
+        # a few metres away rounds to the same location
+        self.assertEqual(client.forecast(6.92714, 79.86118), first)
+        client.forecast(7.2906, 80.6337)
+
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(client.stats(), {"hits": 1, "misses": 2, "cached": 2})
+
+    def test_expired_forecasts_are_fetched_again(self):
+        server = self.server()
+        client = WeatherClient(base_url=server.url, ttl=0.05)
+        client.forecast(6.93, 79.86)
+        client.forecast(6.93, 79.86)
+        time.sleep(0.1)
+        client.forecast(6.93, 79.86)
+        self.assertEqual(server.requests, 2)
+
+    def test_least_recently_used_location_is_evicted(self):
+        server = self.server()
+        client = WeatherClient(base_url=server.url, max_entries=2)
+        for latitude in (1, 2, 1, 3, 1):
+            client.forecast(latitude, 0)
+        self.assertEqual(server.requests, 3)
+        client.forecast(2, 0)
+        self.assertEqual(server.requests, 4)
+
+    def test_current_temperature_is_the_closest_hour(self):
+        server = self.server()
+        client = WeatherClient(base_url=server.url)
+        times, temperatures = client.forecast(10, 20)
+        hour = min(range(len(times)), key=lambda i: abs(times[i] - time.time()))
+        self.assertEqual(client.current_temperature(10, 20), temperatures[hour])
+        self.assertEqual(temperatures[hour], round(20 + 10 / 10 + hour / 4, 1))
+
+    def test_server_errors_are_retried(self):
+        server = self.server(failures=2)
+        client = WeatherClient(base_url=server.url, retries=3)
+        self.assertEqual(len(client.forecast(6.93, 79.86)[0]), 24)
+        self.assertEqual(server.requests, 3)
+
+    def test_errors_outlasting_the_retries_are_raised_and_not_cached(self):
+        server = self.server(failures=1)
+        client = WeatherClient(base_url=server.url, retries=0)
+        with self.assertRaises(Exception):
+            client.forecast(6.93, 79.86)
+        self.assertEqual(client.stats()["cached"], 0)
+        self.assertEqual(len(client.forecast(6.93, 79.86)[0]), 24)
+
+    def test_concurrent_misses_share_one_request(self):
+        server = self.server(latency=0.2)
+        client = WeatherClient(base_url=server.url)
+        with ThreadPoolExecutor(8) as pool:
+            forecasts = list(pool.map(lambda _: client.forecast(6.93, 79.86), range(8)))
+
+        self.assertEqual(server.requests, 1)
+        self.assertTrue(all(forecast == forecasts[0] for forecast in forecasts))
+
+
+class IntentRouterTests(SimpleTestCase):
+
+    def test_fixtures_are_never_routed_to_the_wrong_tool(self):
+        router = IntentRouter()
+        with open(INTENT_FIXTURES) as f:
+            fixtures = [json.loads(line) for line in f if line.strip()]
+        for fixture in fixtures:
+            route = router.route(fixture["text"])
+            with self.subTest(fixture["text"]):
+                if route is not None:
+                    self.assertEqual(route.tool, fixture["tool"])
+                    self.assertIn(fixture["arguments"], (None, route.arguments))
+
+    def test_statements_and_requests_with_more_to_them_go_to_the_agent(self):
+        router = IntentRouter()
+        for text in ["I have a towel", "I already have enough towels, thanks", "I got the towels",
+                     "Get me a new room, the AC is broken", "send a towel and call me a taxi",
+                     # qualifiers the tools have no slot for
+                     "send a towel to room 305", "clean my room tomorrow at 10am",
+                     "I need more towels for my friend in room 210"]:
+            with self.subTest(text):
+                self.assertIsNone(router.route(text))
+        for text in ["send a towel, thanks", "hi, can someone bring an iron and ironing board please",
+                     "please bring another blanket to my room"]:
+            with self.subTest(text):
+                self.assertEqual(router.route(text).tool, "request_room_amenity")
@@ -0,0 +1,285 @@
+"""
+Model tiers: a fast, cheap model for simple turns and a strong one for the rest.
+
+``ModelTiers.pick`` chooses the tier a turn starts on from the guest's
+message. A short reply to a question the agent just asked (filling in a
+slot) or a short, single request goes to the fast model; long messages and
+ones asking for several things at once go to the strong model.
+
+``TieredModel`` takes the place of the agent's model. A fast-tier response is
+checked before the agent sees it and the turn is escalated to the strong
+model when its tool calls do not parse, name a tool the hotel does not offer,
+fail the tool's argument schema or call several tools at once, or when it is
+empty or the model call failed. A call the ``LLMGate`` turned away is raised,
+not escalated. The fast model's tokens are held back from the guest's stream
+until its response has been checked, so an escalated answer never reaches
+the guest; a text answer that stands is then sent at once.
+
+Calls, latency and estimated token cost are kept per tier for
+``/research/tier-stats``. Configured with the ``LLM_MODEL_TIERS`` setting.
+"""
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any
+
+import orjson
+from django.conf import settings
+from langchain.agents.output_parsers.openai_tools import parse_ai_message_to_openai_tool_action
+from langchain_core.agents import AgentFinish
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import RunnableSerializable
+from pydantic import ValidationError
+
+from .admission import Overloaded, RateLimited
+from .memory import count_tokens
+from .streaming import hold_tokens
+
+FAST, STRONG = "fast", "strong"
+
+# the gate shedding load; trying the strong tier as well would only add to it
+ADMISSION_ERRORS = (Overloaded, RateLimited)
+
+# "towels and a sandwich", "book a taxi, then wake me up at 6"
+SEVERAL_REQUESTS = re.compile(r"\b(?:and|also|as well as|plus|then)\b|[;&]", re.I)
+
+
+def question_and_previous(messages):
+    """The guest's message of the turn, and the conversation message before it, if any."""
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].type == "human":
+            previous = next((message for message in reversed(messages[:i]) if message.type in ("human", "ai")),
+                            None)
+            return str(messages[i].content), previous
+    return "", None
+
+
+def message_tokens(message):
+    # plus the few tokens of per-message framing the chat API adds
+    tokens = count_tokens(str(message.content)) + 4
+    tool_calls = message.additional_kwargs.get("tool_calls")
+    if tool_calls:
+        tokens += count_tokens(orjson.dumps(tool_calls).decode())
+    return tokens
+
+
+class ModelTiers:
+    """
+    Which tier a turn starts on and whether a fast-tier response stands, with per-tier counters.
+
+    ``fast`` and ``strong`` are each tier's ``MODEL`` name and its
+    ``INPUT_COST`` and ``OUTPUT_COST`` in dollars per 1000 tokens.
+    """
+
+    def __init__(self, enabled=True, fast_max_words=24, fast=None, strong=None):
+        self.enabled = enabled
+        self.fast_max_words = fast_max_words
+        self.options = {FAST: fast or {}, STRONG: strong or {}}
+        self._lock = threading.Lock()
+        self.picked = Counter()
+        self.escalations = Counter()
+        self.calls = Counter()
+        self.seconds = Counter()
+        self.prompt_tokens = Counter()
+        self.completion_tokens = Counter()
+
+    def model(self, tier):
+        # ChatOpenAI's own default when the setting leaves it out
+        return self.options[tier].get("MODEL", "gpt-3.5-turbo")
+
+    def pick(self, messages):
+        """``(tier, reason)`` for the turn whose prompt is ``messages``."""
+        if not self.enabled:
+            return STRONG, "disabled"
+        question, previous = question_and_previous(messages)
+        words = len(question.split())
+        if words <= self.fast_max_words and previous is not None and previous.type == "ai" \
+                and str(previous.content).rstrip().endswith("?"):
+            return FAST, "follow_up"
+        if words > self.fast_max_words:
+            return STRONG, "long"
+        if SEVERAL_REQUESTS.search(question) or question.count("?") > 1:
+            return STRONG, "several_requests"
+        return FAST, "simple"
+
+    def check(self, message, tools):
+        """Why the fast tier's ``message`` has to go to the strong tier, or ``None`` when it stands."""
+        if message is None or (not message.content and not message.additional_kwargs.get("tool_calls")):
+            return "empty"
+        try:
+            actions = parse_ai_message_to_openai_tool_action(message)
+        except OutputParserException:
+            return "parse_error"
+        if isinstance(actions, AgentFinish):
+            return None
+        if len(actions) > 1:
+            return "several_tools"
+        tool = tools.get(actions[0].tool)
+        if tool is None:
+            return "unknown_tool"
+        if tool.args_schema is not None:
+            try:
+                tool.args_schema.parse_obj(actions[0].tool_input)
+            except ValidationError:
+                return "invalid_arguments"
+        return None
+
+    def started(self, tier, reason):
+        with self._lock:
+            self.picked[f"{tier}:{reason}"] += 1
+
+    def escalated(self, reason):
+        with self._lock:
+            self.escalations[reason] += 1
+
+    def record(self, tier, seconds, prompt_tokens, message):
+        completion_tokens = message_tokens(message) if message is not None else 0
+        with self._lock:
+            self.calls[tier] += 1
+            self.seconds[tier] += seconds
+            self.prompt_tokens[tier] += prompt_tokens
+            self.completion_tokens[tier] += completion_tokens
+
+    def cost(self, tier):
+        """Estimated dollars spent on ``tier``, from counted tokens; the caller holds the lock."""
+        options = self.options[tier]
+        return (self.prompt_tokens[tier] * options.get("INPUT_COST", 0)
+                + self.completion_tokens[tier] * options.get("OUTPUT_COST", 0)) / 1000
+
+    def stats(self):
+        with self._lock:
+            tiers = {tier: {"model": self.model(tier), "calls": self.calls[tier],
+                            "mean_ms": round(self.seconds[tier] / self.calls[tier] * 1000, 3)
+                            if self.calls[tier] else None,
+                            "prompt_tokens": self.prompt_tokens[tier],
+                            "completion_tokens": self.completion_tokens[tier],
+                            "cost": round(self.cost(tier), 6)}
+                     for tier in (FAST, STRONG)}
+            return {"enabled": self.enabled, "tiers": tiers, "picked": dict(self.picked),
+                    "escalations": dict(self.escalations)}
+
+
+class TieredModel(RunnableSerializable):
+    """
+    The agent's model: ``fast`` for the turns ``tiers`` picks it for, ``strong`` for the others and escalations.
+
+    Both are the tool-bound models of ``build_agent_chain``. ``tools`` are
+    the agent's tools by name, to check the fast tier's calls against, and
+    ``schema_tokens`` what their schemas add to every prompt.
+    """
+
+    fast: Any
+    strong: Any
+    tiers: Any
+    tools: dict
+    schema_tokens: int = 0
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def __repr__(self):
+        # serialized on every chain start, keep it short
+        return "TieredModel()"
+
+    def _start(self, input):
+        messages = input.to_messages() if hasattr(input, "to_messages") else input
+        tier, reason = self.tiers.pick(messages)
+        self.tiers.started(tier, reason)
+        return tier, self.schema_tokens + sum(message_tokens(message) for message in messages)
+
+    def _escalate(self, message, error=None):
+        reason = "error" if error is not None else self.tiers.check(message, self.tools)
+        if reason is not None:
+            self.tiers.escalated(reason)
+        return reason is not None
+
+    def invoke(self, input, config=None, **kwargs):
+        tier, prompt_tokens = self._start(input)
+        if tier == FAST:
+            message, error, start = None, None, time.perf_counter()
+            try:
+                message = self.fast.invoke(input, config, **kwargs)
+            except ADMISSION_ERRORS:
+                raise
+            except Exception as e:
+                error = e
+            self.tiers.record(FAST, time.perf_counter() - start, prompt_tokens, message)
+            if not self._escalate(message, error):
+                return message
+        start = time.perf_counter()
+        message = self.strong.invoke(input, config, **kwargs)
+        self.tiers.record(STRONG, time.perf_counter() - start, prompt_tokens, message)
+        return message
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        tier, prompt_tokens = self._start(input)
+        if tier == FAST:
+            message, error, start = None, None, time.perf_counter()
+            try:
+                message = await self.fast.ainvoke(input, config, **kwargs)
+            except ADMISSION_ERRORS:
+                raise
+            except Exception as e:
+                error = e
+            self.tiers.record(FAST, time.perf_counter() - start, prompt_tokens, message)
+            if not self._escalate(message, error):
+                return message
+        start = time.perf_counter()
+        message = await self.strong.ainvoke(input, config, **kwargs)
+        self.tiers.record(STRONG, time.perf_counter() - start, prompt_tokens, message)
+        return message
+
+    def stream(self, input, config=None, **kwargs):
+        tier, prompt_tokens = self._start(input)
+        if tier == FAST:
+            # the callbacks would pass the tokens on to the guest as they come,
+            # hold them until the complete message has been checked
+            message, error, start = None, None, time.perf_counter()
+            with hold_tokens() as held:
+                try:
+                    for chunk in self.fast.stream(input, config, **kwargs):
+                        message = chunk if message is None else message + chunk
+                except ADMISSION_ERRORS:
+                    raise
+                except Exception as e:
+                    error = e
+            self.tiers.record(FAST, time.perf_counter() - start, prompt_tokens, message)
+            if not self._escalate(message, error):
+                held.release_nowait()
+                yield message
+                return
+        message, start = None, time.perf_counter()
+        for chunk in self.strong.stream(input, config, **kwargs):
+            message = chunk if message is None else message + chunk
+            yield chunk
+        self.tiers.record(STRONG, time.perf_counter() - start, prompt_tokens, message)
+
+    async def astream(self, input, config=None, **kwargs):
+        tier, prompt_tokens = self._start(input)
+        if tier == FAST:
+            message, error, start = None, None, time.perf_counter()
+            with hold_tokens() as held:
+                try:
+                    async for chunk in self.fast.astream(input, config, **kwargs):
+                        message = chunk if message is None else message + chunk
+                except ADMISSION_ERRORS:
+                    raise
+                except Exception as e:
+                    error = e
+            self.tiers.record(FAST, time.perf_counter() - start, prompt_tokens, message)
+            if not self._escalate(message, error):
+                await held.release()
+                yield message
+                return
+        message, start = None, time.perf_counter()
+        async for chunk in self.strong.astream(input, config, **kwargs):
+            message = chunk if message is None else message + chunk
+            yield chunk
+        self.tiers.record(STRONG, time.perf_counter() - start, prompt_tokens, message)
+
+
+def load_model_tiers(config=None):
+    if config is None:
+        config = getattr(settings, "LLM_MODEL_TIERS", {})
+    return ModelTiers(**{key.lower(): value for key, value in config.items()})
@@ -0,0 +1,244 @@
+"""
+Per-request latency tracing for the llm-engine pipeline.
+
+``TracingMiddleware`` (research/middleware.py) opens a ``Trace`` for every
+request. The views time their own phases with ``span("parse")``, ``span("session")``
+and so on, and ``TracingCallbackHandler`` times the LangChain side: prompt
+build, every LLM call and every tool run. Each phase is observed into a
+histogram, which ``render_metrics`` exports in the Prometheus text format at
+``/research/metrics``.
+
+A sample of finished traces, plus every trace slower than
+``SLOW_REQUEST_SECONDS``, is logged to the ``research.trace`` logger. Logging
+goes through a queue drained by a background thread, so the request never
+waits on the log handler. Configured with the ``LLM_TRACING`` setting.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+from django.conf import settings
+from langchain_core.callbacks import BaseCallbackHandler
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+trace_logger = logging.getLogger("research.trace")
+current_trace = ContextVar("current_trace", default=None)
+
+
+def label_value(value):
+    """``value`` escaped for a label in the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def tracing_settings():
+    return getattr(settings, "LLM_TRACING", {})
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in seconds."""
+
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(counts), count, total) for key, (counts, count, total) in self._series.items()]
+        for key, counts, count, total in sorted(series):
+            labels = ",".join(f'{name}="{label_value(value)}"' for name, value in key)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return "\n".join(lines)
+
+
+REQUEST_SECONDS = Histogram("llm_engine_request_seconds", "Request duration per view and status, to the last chunk for streams.")
+PHASE_SECONDS = Histogram("llm_engine_phase_seconds", "Time spent in each phase of a request.")
+TOOL_SECONDS = Histogram("llm_engine_tool_seconds", "Time spent running each tool.")
+HISTOGRAMS = [REQUEST_SECONDS, PHASE_SECONDS, TOOL_SECONDS]
+
+# the runnables that build the prompt, timed as the "prompt" phase
+PROMPT_RUNS = ("AgentPrompt", "ChatPromptTemplate")
+
+
+def render_metrics():
+    return "\n".join(histogram.render() for histogram in HISTOGRAMS) + "\n"
+
+
+class Trace:
+    """The spans of one request, as ``(phase, seconds, detail)``."""
+
+    __slots__ = ("path", "start", "spans")
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, phase, seconds, detail=None):
+        self.spans.append((phase, seconds, detail))
+        PHASE_SECONDS.observe(seconds, phase=phase)
+        if phase == "tool":
+            TOOL_SECONDS.observe(seconds, tool=detail)
+
+    def totals(self):
+        totals = {}
+        for phase, seconds, _ in self.spans:
+            totals[phase] = totals.get(phase, 0.0) + seconds
+        return totals
+
+    def server_timing(self):
+        """``Server-Timing`` header value, so browsers and curl show the breakdown."""
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.totals().items())
+
+
+def record(phase, seconds, trace=None):
+    trace = trace or current_trace.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+    else:
+        PHASE_SECONDS.observe(seconds, phase=phase)
+
+
+@contextmanager
+def span(phase, trace=None):
+    """
+    Time the enclosed block as ``phase`` of the current request.
+
+    Code running after the view has returned, like a streaming body, passes
+    the ``trace`` it captured.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start, trace)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Times the prompt build, LLM calls and tool runs of an agent run into ``trace``."""
+
+    # only reads the clock, so it runs on the caller's thread even in async runs
+    run_inline = True
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._starts = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs):
+        if kwargs.get("name") in PROMPT_RUNS:
+            self._starts[run_id] = (time.perf_counter(), "prompt", None)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._starts[run_id] = (time.perf_counter(), "llm", None)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._starts[run_id] = (time.perf_counter(), "llm", None)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._starts[run_id] = (time.perf_counter(), "tool", serialized.get("name"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def _finish(self, run_id):
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            start, phase, detail = started
+            self.trace.add(phase, time.perf_counter() - start, detail)
+
+
+def trace_callbacks(trace=None):
+    """Callbacks to pass to an agent run so it is traced into the request."""
+    trace = trace or current_trace.get()
+    return [TracingCallbackHandler(trace)] if trace is not None else []
+
+
+_queue_pid = None
+_queue_lock = threading.Lock()
+
+
+def _start_log_queue():
+    """Route ``research.trace`` through a queue drained by a thread, once per worker process."""
+    global _queue_pid
+    with _queue_lock:
+        if _queue_pid == os.getpid():
+            return
+        log_queue = queue.SimpleQueue()
+        handlers = [handler for handler in trace_logger.handlers if not isinstance(handler, QueueHandler)]
+        if not handlers:
+            handlers = [logging.StreamHandler()]
+            handlers[0].setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        # a forked worker inherits the parent's handlers but not its listener thread
+        trace_logger.handlers = [QueueHandler(log_queue)]
+        trace_logger.propagate = False
+        if trace_logger.level == logging.NOTSET:
+            trace_logger.setLevel(logging.INFO)
+        _queue_pid = os.getpid()
+
+
+def finish_trace(trace, status, view=None):
+    """Observe the request and log it when sampled or slow."""
+    elapsed = time.perf_counter() - trace.start
+    # one series for every URL that did not resolve, not one per path probed
+    REQUEST_SECONDS.observe(elapsed, view=view or "unmatched", status=str(status))
+
+    config = tracing_settings()
+    slow = elapsed >= config.get("SLOW_REQUEST_SECONDS", 5.0)
+    if not slow and random.random() >= config.get("SAMPLE_RATE", 0.01):
+        return
+    _start_log_queue()
+    trace_logger.info(orjson.dumps({
+        "path": trace.path,
+        "status": status,
+        "ms": round(elapsed * 1000, 3),
+        "slow": slow,
+        "spans": [{"phase": phase, "ms": round(seconds * 1000, 3), "detail": detail}
+                  for phase, seconds, detail in trace.spans],
+    }).decode())
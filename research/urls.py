@@ -6,7 +6,15 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     # path("llm-test", llmResponse),
     path("llm-engine", chatbot_engine),
+    path("llm-engine/stream", chatbot_engine_stream),
+    path("llm-engine/batch", chatbot_engine_batch),
+    path("session-stats", session_stats),
+    path("cache-stats", cache_stats),
+    path("router-stats", router_stats),
+    path("hotel-stats", hotel_stats),
+    path("admission-stats", admission_stats),
+    path("tier-stats", tier_stats),
+    path("service-requests", service_requests),
+    path("metrics", metrics),
+    path("ready", readiness),
 ]
-
-llm_startup()
-# my_startup_code()
\ No newline at end of file
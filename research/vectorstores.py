@@ -0,0 +1,309 @@
+"""
+Vector indexes used by ``research.retrieval.Retriever``.
+
+An index answers ``query(vector, k)`` with ``[(text, score), ...]`` best first
+and accepts ``upsert(ids, vectors, texts)``. ``LLM_VECTORSTORE["BACKEND"]`` picks
+between the hosted Pinecone index and the local ``MemmapVectorIndex``.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Indices of the ``k`` highest ``scores``, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+
+class InMemoryVectorIndex:
+    """
+    Cosine-similarity index held in a NumPy array; a stand-in for Pinecone in
+    tests and for small corpora.
+    """
+
+    def __init__(self, dimension=1536):
+        self.dimension = dimension
+        self.ids = []
+        self.texts = []
+        self._positions = {}
+        self._vectors = np.empty((0, dimension), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def upsert(self, ids, vectors, texts):
+        vectors = normalize_rows(vectors)
+        new_rows = []
+        for id_, vector, text in zip(ids, vectors, texts):
+            position = self._positions.get(id_)
+            if position is None:
+                self._positions[id_] = len(self.ids) + len(new_rows)
+                new_rows.append(vector)
+                self.ids.append(id_)
+                self.texts.append(text)
+            else:
+                self._vectors[position] = vector
+                self.texts[position] = text
+        if new_rows:
+            self._vectors = np.vstack([self._vectors, np.stack(new_rows)])
+
+    def query(self, vector, k=3):
+        if not self.ids:
+            return []
+        scores = self._vectors @ normalize_rows(vector)[0]
+        return [(self.texts[i], float(scores[i])) for i in top_k(scores, k)]
+
+
+class PineconeVectorIndex:
+    """Adapter for a ``pinecone.Index`` whose records keep their text in ``text_field`` metadata."""
+
+    def __init__(self, index, text_field="text"):
+        self.index = index
+        self.text_field = text_field
+
+    def upsert(self, ids, vectors, texts):
+        self.index.upsert(vectors=[
+            (id_, list(map(float, vector)), {self.text_field: text})
+            for id_, vector, text in zip(ids, vectors, texts)])
+
+    def query(self, vector, k=3):
+        response = self.index.query(vector=list(map(float, vector)), top_k=k, include_metadata=True)
+        return [(match.metadata.get(self.text_field, ""), match.score) for match in response.matches]
+
+
+def spherical_kmeans(vectors, n_lists, iterations=10, seed=0):
+    """Unit-length centroids of ``n_lists`` clusters of the unit rows of ``vectors``."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(vectors, centroids)
+        for i in range(n_lists):
+            members = vectors[assignments == i]
+            if len(members):
+                centroids[i] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+def nearest_centroids(vectors, centroids, chunk_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = np.argmax(
+            vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+
+class MemmapVectorIndex:
+    """
+    Local cosine-similarity index kept in a directory and memory-mapped.
+
+    ``vectors.f32`` holds the unit-length float32 rows and is mapped with
+    ``np.memmap``, so opening it costs nothing and every worker process on the
+    host shares the same page-cache pages. ``records.jsonl`` is an append-only
+    log of ``{"row", "id", "text"}``; an upsert appends to both files, so other
+    processes pick new rows up on their next query.
+
+    ``build_ivf(n_lists)`` partitions the rows with spherical k-means. Queries
+    then only score the ``n_probe`` lists whose centroids are closest, which
+    keeps large corpora fast at a small cost in recall. Rows upserted later are
+    assigned to their nearest existing centroid.
+    """
+
+    def __init__(self, path, dimension=1536, n_probe=8):
+        self.path = Path(path)
+        self.dimension = dimension
+        self.n_probe = n_probe
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._vectors_path = self.path / "vectors.f32"
+        self._records_path = self.path / "records.jsonl"
+        self._ivf_path = self.path / "ivf.npz"
+        self._lock = threading.Lock()
+        self.ids = []
+        self.texts = []
+        self._positions = {}
+        self._records_offset = 0
+        self._vectors = None
+        self._ivf_mtime = None
+        self._centroids = None
+        self._assignments = None
+        self._list_order = None
+        self._list_offsets = None
+        self._vectors_path.touch(exist_ok=True)
+        self._records_path.touch(exist_ok=True)
+        self.refresh()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def refresh(self):
+        """Pick up rows appended by other processes since the last call."""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        if self._records_path.stat().st_size != self._records_offset:
+            with open(self._records_path, "rb") as f:
+                f.seek(self._records_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # a writer is half way through this record
+                    self._records_offset += len(line)
+                    self._apply_record(json.loads(line))
+        if self._vectors is None or len(self._vectors) < len(self.ids):
+            self._map_vectors()
+        if self._ivf_path.exists() and self._ivf_path.stat().st_mtime != self._ivf_mtime:
+            self._load_ivf()
+
+    def _apply_record(self, record):
+        row = record["row"]
+        if row == len(self.ids):
+            self.ids.append(record["id"])
+            self.texts.append(record["text"])
+        else:
+            self.texts[row] = record["text"]
+        self._positions[record["id"]] = row
+
+    def _map_vectors(self):
+        rows = self._vectors_path.stat().st_size // (self.dimension * 4)
+        self._vectors = (np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                   shape=(rows, self.dimension))
+                         if rows else np.empty((0, self.dimension), dtype=np.float32))
+
+    def upsert(self, ids, vectors, texts):
+        vectors = normalize_rows(vectors)
+        with self._lock:
+            self._refresh()
+            rows, records, new_rows = [], [], {}
+            for id_, text in zip(ids, texts):
+                row = self._positions.get(id_, new_rows.get(id_))
+                if row is None:
+                    row = new_rows[id_] = len(self.ids) + len(new_rows)
+                records.append({"row": row, "id": id_, "text": text})
+                rows.append(row)
+            if not rows:
+                return
+
+            size = (len(self.ids) + len(new_rows)) * self.dimension * 4
+            with open(self._vectors_path, "r+b") as f:
+                if f.seek(0, os.SEEK_END) < size:
+                    f.truncate(size)
+            writer = np.memmap(self._vectors_path, dtype=np.float32, mode="r+",
+                               shape=(len(self.ids) + len(new_rows), self.dimension))
+            writer[rows] = vectors
+            writer.flush()
+            del writer
+
+            # vectors go first, so a reader never sees a record without its row
+            with open(self._records_path, "ab") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records).encode())
+            self._refresh()
+
+            if self._centroids is not None:
+                assignments = np.resize(self._assignments, len(self.ids))
+                assignments[rows] = nearest_centroids(vectors, self._centroids)
+                self._save_ivf(self._centroids, assignments)
+
+    def query(self, vector, k=3):
+        with self._lock:
+            if self._records_path.stat().st_size != self._records_offset:
+                self._refresh()
+            count = len(self.ids)
+            if not count:
+                return []
+            vector = normalize_rows(vector)[0]
+            vectors = self._vectors[:count]
+
+            if self._centroids is None or len(self._assignments) != count:
+                scores = vectors @ vector
+                return [(self.texts[i], float(scores[i])) for i in top_k(scores, k)]
+
+            probes = top_k(self._centroids @ vector, self.n_probe)
+            candidates = np.concatenate([
+                self._list_order[self._list_offsets[i]:self._list_offsets[i + 1]] for i in probes])
+            candidates.sort()  # sequential reads through the memory map
+            scores = vectors[candidates] @ vector
+            return [(self.texts[candidates[i]], float(scores[i])) for i in top_k(scores, k)]
+
+    def build_ivf(self, n_lists=None, sample_size=100000, iterations=10):
+        """Partition the rows into ``n_lists`` (default ``sqrt(rows)``) for probed search."""
+        with self._lock:
+            self._refresh()
+            count = len(self.ids)
+            if not count:
+                return
+            n_lists = min(count, n_lists or max(1, int(np.sqrt(count))))
+            vectors = self._vectors[:count]
+            sample = vectors[np.random.default_rng(0).choice(
+                count, size=min(count, sample_size), replace=False)]
+            centroids = spherical_kmeans(np.asarray(sample), n_lists, iterations=iterations)
+            self._save_ivf(centroids, nearest_centroids(vectors, centroids))
+
+    def _save_ivf(self, centroids, assignments):
+        tmp_path = self.path / "ivf.tmp.npz"
+        np.savez(tmp_path, centroids=centroids, assignments=assignments)
+        os.replace(tmp_path, self._ivf_path)
+        self._load_ivf()
+
+    def _load_ivf(self):
+        self._ivf_mtime = self._ivf_path.stat().st_mtime
+        with np.load(self._ivf_path) as ivf:
+            self._centroids = ivf["centroids"]
+            self._assignments = ivf["assignments"]
+        # rows grouped by list, with the start of every list, for slicing at query time
+        self._list_order = np.argsort(self._assignments, kind="stable")
+        self._list_offsets = np.searchsorted(
+            self._assignments[self._list_order], np.arange(len(self._centroids) + 1))
+
+
+def pinecone_index(index_name, dimension):
+    import pinecone
+
+    if not settings.PINECONE_API_KEY:
+        raise ImproperlyConfigured("Provide PINECONE API KEY")
+
+    pinecone.init(
+        api_key=settings.PINECONE_API_KEY,
+        environment="gcp-starter"
+    )
+
+    if index_name not in pinecone.list_indexes():
+        pinecone.create_index(
+            index_name,
+            dimension=dimension,
+            metric='cosine'
+        )
+        # wait for index to finish initialization
+        while not pinecone.describe_index(index_name).status['ready']:
+            time.sleep(1)
+
+    return pinecone.Index(index_name)
+
+
+def load_vectorstore(config=None):
+    """Open the index described by ``config`` or ``settings.LLM_VECTORSTORE``."""
+    if config is None:
+        config = settings.LLM_VECTORSTORE
+    if config["BACKEND"] == "memmap":
+        return MemmapVectorIndex(config["PATH"], dimension=config["DIMENSION"], n_probe=config["N_PROBE"])
+    if config["BACKEND"] == "pinecone":
+        return PineconeVectorIndex(pinecone_index(config["INDEX_NAME"], config["DIMENSION"]), "text")
+    raise ImproperlyConfigured(f"Unknown LLM_VECTORSTORE backend {config['BACKEND']!r}")
@@ -1,102 +1,173 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.exceptions import ImproperlyConfigured
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from langchain.memory import ConversationBufferMemory
 from langchain.schema.runnable import RunnablePassthrough, RunnableLambda
 from langchain.agents import AgentExecutor
-from langchain.agents.format_scratchpad import format_to_openai_functions
-from .methods import tools,ROOM_NUMBER
-import pinecone
+from .methods import tools,ToolResult,ToolResults
+from .admission import GatedModel, RateLimited, load_llm_gate, load_rate_limiter, retry_after_header
+from .agent import SharedAgentExecutor
+from .batch import group_by_session, load_batch_runner
+from .memory import count_tokens, load_memory_summarizer, load_tokenizer
+from .prompts import AgentPrompt, load_tool_schemas
+from .response_cache import conversation_context, is_cacheable, load_response_cache
+from .retrieval import BatchedEmbeddings, Retriever
+from .router import load_intent_router
+from .service_requests import list_requests, service_request_writer
+from .sessions import load_session_store
+from .singleflight import SingleFlight, SingleFlightModel, single_flight_stats
+from .startup import LLMNotReady, ensure_llm_ready, status as startup_status, timed
+from .streaming import format_sse, stream_agent_events
+from .tenancy import InvalidGuest, current_guest, guest_context, hotels, load_hotel_agents, set_guest
+from .tiering import FAST, STRONG, TieredModel, load_model_tiers
+from .tracing import current_trace, render_metrics, span, trace_callbacks
+from .vectorstores import load_vectorstore
 import time
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Pinecone
-from langchain.tools.render import format_tool_to_openai_function
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
-from langchain.prompts import MessagesPlaceholder
-from langchain.agents.output_parsers import OpenAIFunctionsAgentOutputParser
-from langchain.schema.runnable import RunnableMap
+from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser
 from langchain_core.messages import HumanMessage
 from langchain_core.utils.function_calling import convert_to_openai_function
 from langchain_community.tools import MoveFileTool
 import json
+import orjson
 
 
 from .methods import tools
 
 from tqdm.auto import tqdm
 
-global_session = {}
-global_agent_chain = None
+session_store = load_session_store()
+response_cache = load_response_cache()
+intent_router = load_intent_router()
+memory_summarizer = load_memory_summarizer()
+rate_limiter = load_rate_limiter()
+batch_runner = load_batch_runner()
+llm_gate = load_llm_gate()
+model_tiers = load_model_tiers()
+agent_model = None
+fast_model = None
+# shared by every hotel's agent, each under the scope of its tool set
+model_flight = SingleFlight("model")
+retriever = None
 
-index_name = 'llama-2-rag'
+
+class OrjsonResponse(HttpResponse):
+    """``JsonResponse`` encoded with orjson, which also handles the dates in tool parameters."""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(orjson.dumps(data), **kwargs)
+
+
+# the answer to every request body that is not JSON, encoded once
+INVALID_JSON = orjson.dumps({"status": "error", "message": "Invalid JSON data"})
+
+
+def invalid_json_response():
+    return HttpResponse(INVALID_JSON, status=400, content_type="application/json")
+
+
+def build_agent_chain(model, tools=tools, fast_model=None):
+    """
+    Wire the hotel tools, prompt and output parser around ``model``.
+
+    ``model`` is any LangChain chat model, so the OpenAI client can be swapped
+    for ``research.fakes.FakeChatModel`` when running offline. With a
+    ``fast_model`` the simple turns go to it instead, see research/tiering.py.
+    """
+    # tools rather than functions, so one response can call several of them;
+    # the schemas are precomputed in tool_schemas.json
+    schemas = load_tool_schemas(tools)
+    scope = ",".join(tool.name for tool in tools)
+
+    def bind(model, tier):
+        model = model.bind(tools=schemas)
+        # bounded concurrency and backoff retries for the calls that reach the model
+        model = GatedModel(bound=model, gate=llm_gate)
+        # guests asking the same thing at the same moment share one completion
+        return SingleFlightModel(bound=model, flight=model_flight, scope=f"{tier}:{scope}")
+
+    model = bind(model, STRONG)
+    if fast_model is not None:
+        model = TieredModel(fast=bind(fast_model, FAST), strong=model, tiers=model_tiers,
+                            tools={tool.name: tool for tool in tools},
+                            schema_tokens=count_tokens(orjson.dumps(schemas).decode()))
+
+    agent_chain = AgentPrompt() | model | OpenAIToolsAgentOutputParser()
+
+    return agent_chain
+
+
+def build_hotel_agent(hotel):
+    """The worker's shared executor for ``hotel``, with the tools it offers."""
+    hotel_tools = [tool for tool in tools if hotel.offers(tool.name)]
+    # per-request timings come from research.tracing, not verbose stdout logging
+    return SharedAgentExecutor(build_agent_chain(agent_model, hotel_tools, fast_model), hotel_tools)
+
+
+hotel_agents = load_hotel_agents(build_hotel_agent)
+
+
+def set_agent_model(model, fast=None):
+    """Build every hotel's agent around ``model``, and ``fast`` for the simple turns, from now on."""
+    global agent_model, fast_model
+    agent_model, fast_model = model, fast
+    hotel_agents.clear()
+    # summarizing is no harder than a simple turn; it shares the gate and its retries
+    summary_model = fast or model
+    memory_summarizer.llm = GatedModel(bound=summary_model, gate=llm_gate) if summary_model is not None else None
 
 
 def llm_startup():
+    OPENAI_API_KEY = settings.OPENAI_API_KEY
 
     # throw exception
     if not OPENAI_API_KEY or OPENAI_API_KEY == "":
-        return JsonResponse({"status": "error", "message": "Provide OPENAI API KEY"}, status=400)
-    if not PINECONE_API_KEY or PINECONE_API_KEY == "":
-        return JsonResponse({"status": "error", "message": "Provide PINECONE API KEY"}, status=400)
-    
-    pinecone.init(
-        api_key=PINECONE_API_KEY,
-        environment="gcp-starter"
-    )
-
-    if index_name not in pinecone.list_indexes():
-        pinecone.create_index(
-            index_name,
-            dimension=1536,
-            metric='cosine'
-        )
-        # wait for index to finish initialization
-        while not pinecone.describe_index(index_name).status['ready']:
-            time.sleep(1)
-
-    index = pinecone.Index(index_name)
-
-    embed_model = OpenAIEmbeddings(
-        model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY)
-
-    text_field = "text"  # the metadata field that contains our text
-
-    # initialize the vector store object
-    vectorstore = Pinecone(
-        index, embed_model.embed_query, text_field
-    )
-
-    functions = [format_tool_to_openai_function(f) for f in tools]
-   
-    model = ChatOpenAI(openai_api_key=OPENAI_API_KEY).bind(
-        functions=functions)
-    
-
-    prompt_model = ChatPromptTemplate.from_messages([
-        ("system",
-            "only call the function(s) if all the parameters are procided from the users request, else start follow-up questions to clarify missing parameters. Never guess any parameters. "),
-        ("human", "{question}")
-    ])
-
-    prompt = ChatPromptTemplate.from_messages([
-        MessagesPlaceholder(variable_name="chat_history"),
-        prompt_model,
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ])
-
-    chain = RunnableMap({
-        "agent_scratchpad": lambda x: x["agent_scratchpad"],
-        "chat_history": lambda x: x["chat_history"],
-        "question": lambda x: x["question"]
-    }) | prompt | model | OpenAIFunctionsAgentOutputParser()
-
-    agent_chain = RunnablePassthrough.assign(
-            agent_scratchpad=lambda x: format_to_openai_functions(
-                x["intermediate_steps"]),
-    ) | chain
-    
-    global global_agent_chain 
-    global_agent_chain = agent_chain
+        raise ImproperlyConfigured("Provide OPENAI API KEY")
+
+    # the client libraries are only needed here, keep them off the import path
+    with timed("imports"):
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        from langchain.chat_models import ChatOpenAI
+
+    # token counts are estimated until the encoding is loaded
+    with timed("tokenizer"):
+        load_tokenizer()
+
+    # the hosted Pinecone index or the local memory-mapped one, see LLM_VECTORSTORE
+    with timed("vectorstore"):
+        vectorstore = load_vectorstore()
+
+    with timed("embeddings"):
+        retrieval_settings = settings.LLM_RETRIEVAL
+
+        # query embeddings are cached and sent to OpenAI in batches
+        embed_model = BatchedEmbeddings(
+            OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY),
+            cache_size=retrieval_settings["EMBEDDING_CACHE_SIZE"],
+            batch_size=retrieval_settings["EMBEDDING_BATCH_SIZE"],
+            batch_wait=retrieval_settings["EMBEDDING_BATCH_WAIT"])
+
+        response_cache.embedder = embed_model
+
+        global retriever
+        if retrieval_settings["ENABLED"]:
+            retriever = Retriever(
+                embed_model, vectorstore,
+                top_k=retrieval_settings["TOP_K"],
+                min_score=retrieval_settings["MIN_SCORE"],
+                timeout=retrieval_settings["TIMEOUT"])
+
+    with timed("agent"):
+        # a single attempt per call, the retries are GatedModel's backoff
+        model = ChatOpenAI(openai_api_key=OPENAI_API_KEY, max_retries=1, model=model_tiers.model(STRONG))
+        fast = None
+        if model_tiers.enabled:
+            fast = ChatOpenAI(openai_api_key=OPENAI_API_KEY, max_retries=1, model=model_tiers.model(FAST))
+
+        set_agent_model(model, fast)
 
     # tools1 = [MoveFileTool()]
     # functions1= [convert_to_openai_function(t) for t in tools]
@@ -107,69 +178,353 @@ def llm_startup():
     # print(message)
 
 
+def get_agent_executor(hotel=None):
+    """The executor of ``hotel``, by default the current guest's."""
+    if agent_model is None:
+        ensure_llm_ready()
+    return hotel_agents.get(hotel or current_guest().hotel)
+
+
+def get_session_memory(session_id):
+    return session_store.get(session_id)
+
+
+def save_session_memory(session_id, memory):
+    # keeps the prompt within LLM_MEMORY["MAX_TOKENS"], summarizing in the background
+    memory_summarizer.compact(session_id, memory)
+    session_store.save(session_id, memory)
+
+
+def prepare_turn(question, context, memory):
+    """
+    Try the intent router and the response cache, and start the retrieval for the turn.
+
+    Returns ``(output, query_vector, retrieval)``; ``output`` is set when the
+    turn was answered without the agent. Retrieval starts after an exact-cache
+    miss, so it shares the question's embedding with the semantic tier and runs
+    alongside it. A routed or cached answer is recorded in ``memory`` as if the
+    agent had answered it.
+    """
+    output = intent_router.dispatch(question, memory.chat_memory.messages)
+    if output is not None:
+        memory.save_context({"question": question}, {"output": str(output)})
+        return output, None, None
+
+    retrieval = None
+    output, query_vector = response_cache.get_exact(question, context), None
+    if output is None:
+        if retriever is not None:
+            retrieval = retriever.prefetch(question)
+        output, query_vector = response_cache.get_similar(question, context)
+
+    if output is not None:
+        if retrieval is not None:
+            retrieval.cancel()
+        memory.save_context({"question": question}, {"output": str(output)})
+    return output, query_vector, retrieval
+
+
+def build_response_data(question, output):
+    """
+    ``output`` is the agent's answer: plain text, the ``ToolResult`` of the tool
+    it called, or the ``ToolResults`` of the tools it called together.
+
+    ``function`` is the first tool called, ``functions`` every one of them.
+    """
+    results = output if isinstance(output, ToolResults) else [output]
+    functions = [result.function_info() for result in results if isinstance(result, ToolResult)]
+    function_info = functions[0] if functions else None
+    answer = str(output) if isinstance(output, (ToolResult, ToolResults)) else output
+
+    return {
+        "success": True,
+        "message": "Response received successfully",
+        "function-call-status": function_info is not None,
+        "data": {
+            "query": question,
+            "answer": answer
+        },
+        "function": function_info,
+        "functions": functions
+    }
+
+
+def build_error_data(e):
+    data = {"success": False,
+            "error": {
+                "message": str(e),
+                "type": type(e).__name__ if hasattr(e, "__name__") else "Internal Server Error"
+            }
+            }
+    if getattr(e, "retry_after", None) is not None:
+        data["error"]["retry_after"] = float(e.retry_after)
+    return data
+
+
+def error_response(e):
+    response = OrjsonResponse(build_error_data(e), status=getattr(e, "http_status", 500))
+    if getattr(e, "retry_after", None) is not None:
+        response["Retry-After"] = retry_after_header(e.retry_after)
+    return response
+
+
+def run_turn(question, guest, memory):
+    """
+    Answer ``question`` for ``guest`` in the conversation ``memory`` and return the response data.
+
+    The memory is updated but not saved, that is up to the caller.
+    """
+    # the hotel and room reach the prompt and the tools through the context
+    with guest_context(guest):
+        context = conversation_context(guest, memory.chat_memory.messages)
+
+        with span("prepare"):
+            output, query_vector, retrieval = prepare_turn(question, context, memory)
+        cache_hit = output is not None
+        if not cache_hit:
+            agent_executor = get_agent_executor(guest.hotel)
+            llm_response = agent_executor.invoke(
+                question, memory, context=retrieval, config={"callbacks": trace_callbacks()})
+            output = llm_response['output']
+
+    response_data = build_response_data(question, output)
+    if not cache_hit and is_cacheable(response_data):
+        response_cache.put(question, context, output, query_vector)
+    return response_data
+
+
 @csrf_exempt
 def chatbot_engine(request):
     try:
-        data = json.loads(request.body)
+        with span("parse"):
+            data = orjson.loads(request.body)
         question = data.get("query")
         session_id = data.get("session_id")
-        room_number = data.get("room")
-        
-        # memory = ConversationBufferMemory(
-        #     return_messages=True, memory_key="chat_history")
-
-        # user_memory_dict = {}
-        if session_id not in global_session:
-            global_session[session_id] = ConversationBufferMemory(
-                return_messages=True, memory_key="chat_history")
+        guest = hotels.guest(data.get("hotel"), data.get("room"))
+        rate_limiter.check(session_id)
 
-        
-        memory = global_session[session_id]
+        with span("session"):
+            memory = get_session_memory(session_id)
+        response_data = run_turn(question, guest, memory)
+        with span("save"):
+            save_session_memory(session_id, memory)
 
-        agent_executor = AgentExecutor(
-            agent=global_agent_chain, tools=tools, verbose=True, memory=memory)
+        with span("serialize"):
+            return OrjsonResponse(response_data)
+    except Exception as e:
+        return error_response(e)
 
-        llm_response = agent_executor.invoke({"question": question})
 
-        print(llm_response)
+async def chatbot_engine_stream(request):
+    """
+    Async twin of ``chatbot_engine`` that answers with Server-Sent Events.
 
-        if 'function-name' in llm_response['output']:
-            function_info = json.loads(llm_response['output'])
-            answer = function_info['answer']
-            del function_info['answer']
-        else:
-            function_info = None
-            answer = llm_response['output']
+    Tokens and tool calls are pushed as they happen and the last ``result``
+    event carries the same payload ``chatbot_engine`` would have returned.
+    """
+    # the body is streamed after the middleware has returned, so keep the trace at hand
+    trace = current_trace.get()
+    try:
+        with span("parse"):
+            data = orjson.loads(request.body)
+    except orjson.JSONDecodeError:
+        return invalid_json_response()
 
-        response_data = {
-            "success": True,
-            "message": "Response received successfully",
-            "function-call-status": True if 'function-name' in llm_response['output'] else False,
-            "data": {
-                "query": question,
-                "answer": answer
-            },
-            "function": function_info
-        }
-        global_session[session_id].chat_memory.messages = memory.chat_memory.messages[-14:]
-        # print("=========================")
-        # print(global_session)
-        # print("=========================")
-        # print(len(memory.chat_memory.messages))
-        # print("===========================")
-        # print(global_session[session_id])
+    question = data.get("query")
+    session_id = data.get("session_id")
+    try:
+        guest = hotels.guest(data.get("hotel"), data.get("room"))
+        rate_limiter.check(session_id)
+    except (InvalidGuest, RateLimited) as e:
+        return error_response(e)
+    with guest_context(guest):
+        # shared session stores hit the cache or database, which must not run on the event loop
+        with span("session"):
+            memory = await sync_to_async(get_session_memory)(session_id)
+        context = conversation_context(guest, memory.chat_memory.messages)
+        # the semantic tier may call the embedding API, the intent router runs tools
+        with span("prepare"):
+            cached_output, query_vector, retrieval = await sync_to_async(prepare_turn, thread_sensitive=False)(
+                question, context, memory)
+
+    if cached_output is None:
+        try:
+            agent_executor = await sync_to_async(get_agent_executor, thread_sensitive=False)(guest.hotel)
+        except LLMNotReady as e:
+            if retrieval is not None:
+                retrieval.cancel()
+            return error_response(e)
+
+    async def event_stream():
+        # iterated by the handler's own task once the view has returned, which
+        # the agent run below inherits the guest from
+        set_guest(guest)
+        # flush headers straight away so clients see the first byte before the LLM answers
+        yield ": connected\n\n"
+        if cached_output is not None:
+            yield format_sse("result", build_response_data(question, cached_output))
+            with span("save", trace):
+                await sync_to_async(save_session_memory)(session_id, memory)
+            return
+
+        async for event in stream_agent_events(agent_executor, question, memory, context=retrieval,
+                                               callbacks=trace_callbacks(trace)):
+            if event["event"] == "result":
+                output = event["data"]["output"]
+                event["data"] = build_response_data(question, output)
+                if is_cacheable(event["data"]):
+                    response_cache.put(question, context, output, query_vector)
+            elif event["event"] == "error":
+                event["data"] = build_error_data(event["data"])
+            yield format_sse(event["event"], event["data"])
+        with span("save", trace):
+            await sync_to_async(save_session_memory)(session_id, memory)
+
+    response = StreamingHttpResponse(
+        event_stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # stop nginx style proxies from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+# Django 4.2's csrf_exempt wraps views in a sync function, which would hide
+# that this one is async from the handler; mark it exempt directly instead
+chatbot_engine_stream.csrf_exempt = True
 
 
-        return JsonResponse(response_data)
+@csrf_exempt
+def chatbot_engine_batch(request):
+    """
+    Answer a JSON array of ``{query, session_id, room, hotel}`` items, streamed back as NDJSON.
+
+    Each line is what ``chatbot_engine`` would have answered for one item, or
+    its error, plus the item's ``index`` and ``session_id``. Lines come as the
+    turns finish, those of one session in the order they were sent. Each item
+    is charged to ``rate_limiter`` as its turn starts, like a request of its
+    own, and one turned away is a line with its 429 error. ``LLM_BATCH``
+    bounds the batch and the ``LLM_CONCURRENCY`` gate its model calls.
+    """
+    try:
+        with span("parse"):
+            items = orjson.loads(request.body)
+        batch_runner.check(items)
+        sessions = group_by_session(items)
+        # one round trip for every conversation of the batch
+        with span("session"):
+            memories = session_store.get_many(list(sessions))
+    except orjson.JSONDecodeError:
+        return invalid_json_response()
     except Exception as e:
-        return JsonResponse(
-            {"success": False,
-             "error": {
-                 "message": str(e),
-                 "type": type(e).__name__ if hasattr(e, "__name__") else "Internal Server Error"
-             }
-             },
-            status=e.http_status if hasattr(e, "http_status") else 500)
+        return error_response(e)
+
+    trace = current_trace.get()
+    answered = set()
+
+    def turn(session_id, item):
+        guest = hotels.guest(item.get("hotel"), item.get("room"))
+        rate_limiter.check(session_id)
+        answered.add(session_id)
+        return run_turn(item.get("query"), guest, memories[session_id])
+
+    results = batch_runner.run(sessions, turn)
+
+    def lines():
+        for index, response_data, error in results:
+            if error is not None:
+                response_data = {**build_error_data(error), "status": getattr(error, "http_status", 500)}
+            yield orjson.dumps({"index": index, "session_id": items[index].get("session_id"),
+                                **response_data}) + b"\n"
+
+    def save():
+        # after a disconnect, waits for the sessions still in a turn to finish it
+        results.close()
+        with span("save", trace):
+            for session_id in answered:
+                memory_summarizer.compact(session_id, memories[session_id])
+            session_store.save_many({session_id: memories[session_id] for session_id in answered})
+
+    if isinstance(request, ASGIRequest):
+        # an ASGI server would read a sync iterator to the end before sending any of it
+        async def content():
+            sync_lines = lines()
+            try:
+                while (line := await sync_to_async(next, thread_sensitive=False)(sync_lines, None)) is not None:
+                    yield line
+            finally:
+                # on the request's own thread, whose database connection Django closes after the response
+                await sync_to_async(save, thread_sensitive=True)()
+    else:
+        def content():
+            try:
+                yield from lines()
+            finally:
+                save()
+
+    response = StreamingHttpResponse(content(), content_type="application/x-ndjson")
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def readiness(request):
+    state = startup_status()
+    response = JsonResponse(state, status=200 if state["status"] == "ready" else 503)
+    if state["status"] != "ready":
+        response["Retry-After"] = "1"
+    return response
+
+
+def session_stats(request):
+    return JsonResponse({**session_store.stats(), "summarizer": memory_summarizer.stats(),
+                         "batch": batch_runner.stats()})
+
+
+def cache_stats(request):
+    return JsonResponse({**response_cache.stats(), "single_flight": single_flight_stats()})
+
+
+def hotel_stats(request):
+    return JsonResponse({"hotels": sorted(hotels.hotels), "default": hotels.default, **hotel_agents.stats()})
+
+
+def router_stats(request):
+    return JsonResponse(intent_router.stats())
+
+
+def admission_stats(request):
+    return JsonResponse({"rate_limit": rate_limiter.stats(), "llm_gate": llm_gate.stats()})
+
+
+def tier_stats(request):
+    return JsonResponse(model_tiers.stats())
+
+
+def service_requests(request):
+    """
+    Service requests for the front desk, paged by number.
+
+    ``?hotel=default&status=open,in_progress&room=101&after=<last id seen>&limit=500``;
+    ``next`` is the ``after`` of the following page, ``null`` on the last one.
+    Staff only: the details hold guests' phone numbers. It is left out of API
+    mode (``LLM_API_MODE["EXCLUDE"]``) for the session and auth middleware.
+    """
+    user = getattr(request, "user", None)
+    if user is None or not user.is_staff:
+        return JsonResponse({"status": "error", "message": "Staff only"}, status=403)
+    try:
+        guest = hotels.guest(request.GET.get("hotel"), request.GET.get("room"))
+        after = int(request.GET.get("after", 0))
+        limit = min(max(int(request.GET.get("limit", 500)), 1), 5000)
+    except (InvalidGuest, ValueError) as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=400)
+    rows = list_requests(guest.hotel.id, request.GET.get("status", "open").split(","),
+                         room_number=guest.room_number, after=after, limit=limit)
+    return OrjsonResponse({"requests": rows, "next": rows[-1]["id"] if len(rows) == limit else None,
+                           "writer": service_request_writer.stats()})
+
+
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4")
 
 
 @csrf_exempt
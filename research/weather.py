@@ -0,0 +1,99 @@
+"""
+Pooled, cached client for the Open-Meteo forecast used by ``get_current_temperature``.
+
+Forecasts are cached per location rounded to ``precision`` decimals (about a
+kilometre at 2), for ``ttl`` seconds, so every room of a hotel asking about
+its weather within the hour is answered from memory. Concurrent misses for
+the same location share one upstream request.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .singleflight import SingleFlight
+
+OPEN_METEO_URL = os.environ.get("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+
+
+class WeatherClient:
+
+    def __init__(self, base_url=OPEN_METEO_URL, ttl=60 * 60, precision=2, max_entries=1024,
+                 timeout=(3.05, 10), retries=3, pool_size=20):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.precision = precision
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=0.3,
+                              status_forcelist=(429, 500, 502, 503, 504),
+                              allowed_methods=("GET",)))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight("open_meteo")
+        self.hits = 0
+        self.misses = 0
+
+    def forecast(self, latitude, longitude):
+        """Hourly ``(unix_times, temperatures)`` for the rounded location."""
+        key = (round(latitude, self.precision), round(longitude, self.precision))
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > now:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        forecast = self._flights.do(key, self._fetch, *key)
+        with self._lock:
+            self._cache[key] = (now + self.ttl, forecast)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return forecast
+
+    def _fetch(self, latitude, longitude):
+        params = {
+            'latitude': latitude,
+            'longitude': longitude,
+            'hourly': 'temperature_2m',
+            'forecast_days': 1,
+            # epoch seconds instead of ISO strings, so nothing has to be parsed
+            'timeformat': 'unixtime',
+        }
+        response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+
+        if response.status_code != 200:
+            raise Exception(
+                f"API Request failed with status code: {response.status_code}")
+
+        hourly = response.json()['hourly']
+        return hourly['time'], hourly['temperature_2m']
+
+    def current_temperature(self, latitude, longitude):
+        times, temperatures = self.forecast(latitude, longitude)
+        now = time.time()
+        # times are sorted, so the closest hour is next to the insertion point
+        i = bisect_left(times, now)
+        if i == len(times) or (i > 0 and now - times[i - 1] <= times[i] - now):
+            i -= 1
+        return temperatures[i]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cached": len(self._cache)}
+
+
+weather_client = WeatherClient()